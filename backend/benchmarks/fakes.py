@@ -0,0 +1,159 @@
+"""In-memory stand-ins for running displays without Redis and without network access"""
+
+from typing import Any, Dict, List, Optional
+import asyncio
+import json
+import os
+
+
+FIXTURES_PATH = os.path.join(os.path.dirname(__file__), "fixtures")
+
+
+def load_fixture(name: str) -> Any:
+    with open(os.path.join(FIXTURES_PATH, name), "r") as f:
+        return json.load(f)
+
+
+def _encode(value) -> bytes:
+    if isinstance(value, bytes):
+        return value
+    return str(value).encode("utf-8")
+
+
+class MemoryPubSub:
+
+    def __init__(self, redis: "MemoryRedis"):
+        self.redis = redis
+        self.queue: asyncio.Queue = asyncio.Queue()
+        self.channels: List[str] = []
+
+    async def subscribe(self, *channels: str):
+        for channel in channels:
+            self.channels.append(channel)
+            self.redis.subscribers.setdefault(channel, []).append(self.queue)
+
+    async def listen(self):
+        while True:
+            yield await self.queue.get()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        for channel in self.channels:
+            self.redis.subscribers[channel].remove(self.queue)
+
+
+def _list_range(values: List[bytes], start: int, stop: int) -> slice:
+    # inclusive, possibly negative indexes as in LRANGE and LTRIM
+    start = max(0, len(values) + start if start < 0 else start)
+    stop = len(values) + stop if stop < 0 else stop
+    return slice(start, max(start, stop + 1))
+
+
+class MemoryPipeline:
+    """Queues list commands and runs them together, like a MULTI/EXEC transaction."""
+
+    def __init__(self, redis: "MemoryRedis"):
+        self.redis = redis
+        self.commands = []
+
+    def lrange(self, key: str, start: int, stop: int):
+        self.commands.append(lambda: self.redis.lists.get(key, [])[_list_range(self.redis.lists.get(key, []), start, stop)])
+        return self
+
+    def rpush(self, key: str, *values):
+        def rpush():
+            self.redis.lists.setdefault(key, []).extend(_encode(value) for value in values)
+            return len(self.redis.lists[key])
+        self.commands.append(rpush)
+        return self
+
+    def ltrim(self, key: str, start: int, stop: int):
+        def ltrim():
+            values = self.redis.lists.get(key, [])
+            self.redis.lists[key] = values[_list_range(values, start, stop)]
+            return True
+        self.commands.append(ltrim)
+        return self
+
+    async def execute(self):
+        self.redis.commands += 1
+        results = [command() for command in self.commands]
+        self.commands = []
+        return results
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        pass
+
+
+class MemoryRedis:
+    """Implements the subset of redis.asyncio.Redis used by RedisKeyValueStore and RedisInvalidationListener."""
+
+    def __init__(self):
+        self.values: Dict[str, bytes] = {}
+        self.hashes: Dict[str, Dict[str, bytes]] = {}
+        self.lists: Dict[str, List[bytes]] = {}
+        self.subscribers: Dict[str, List[asyncio.Queue]] = {}
+        self.commands = 0
+
+    async def ping(self):
+        return True
+
+    async def get(self, key: str) -> Optional[bytes]:
+        self.commands += 1
+        return self.values.get(key)
+
+    async def mget(self, keys: List[str]) -> List[Optional[bytes]]:
+        self.commands += 1
+        return [self.values.get(key) for key in keys]
+
+    async def mset(self, mapping: Dict[str, Any]):
+        self.commands += 1
+        self.values.update({ key: _encode(value) for key, value in mapping.items() })
+        return True
+
+    async def delete(self, *keys: str):
+        self.commands += 1
+        return sum(self.values.pop(key, None) is not None for key in keys)
+
+    async def hget(self, key: str, field: str) -> Optional[bytes]:
+        self.commands += 1
+        return self.hashes.get(key, {}).get(field)
+
+    async def hmget(self, key: str, fields: List[str]) -> List[Optional[bytes]]:
+        self.commands += 1
+        return [self.hashes.get(key, {}).get(field) for field in fields]
+
+    async def hset(self, key: str, mapping: Dict[str, Any]):
+        self.commands += 1
+        self.hashes.setdefault(key, {}).update({ field: _encode(value) for field, value in mapping.items() })
+
+    async def hdel(self, key: str, *fields: str):
+        self.commands += 1
+        return sum(self.hashes.get(key, {}).pop(field, None) is not None for field in fields)
+
+    async def publish(self, channel: str, message: str):
+        self.commands += 1
+        queues = self.subscribers.get(channel, [])
+        for queue in queues:
+            queue.put_nowait({ "type": "message", "channel": channel.encode(), "data": _encode(message) })
+        return len(queues)
+
+    def pubsub(self) -> MemoryPubSub:
+        return MemoryPubSub(self)
+
+    def pipeline(self, transaction: bool = True) -> MemoryPipeline:
+        return MemoryPipeline(self)
+
+
+def replay_fixtures(datasources: Dict[str, Any], fixtures: Dict[str, Any]):
+    """Replaces the update() of each datasource by storing its recorded fixture."""
+    for datasource in datasources.values():
+        fixture = fixtures.get(datasource.__class__.__name__)
+        async def update(datasource=datasource, fixture=fixture):
+            await datasource.set_data(fixture)
+        datasource.update = update
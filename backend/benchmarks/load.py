@@ -0,0 +1,283 @@
+"""Load test of the image endpoint
+
+Starts the server in-process with an in-memory Redis and recorded datasource
+fixtures and simulates a fleet of displays polling their image like the
+ESP32 client: request with the ETag of the last image in If-None-Match,
+then sleep for the max-age of Cache-Control. Client sleeps are scaled by
+--time-scale so hours of polling fit into a short run. The datasources
+change every --change-every seconds, which re-renders the displays and
+makes the following requests return 200 instead of 304.
+
+Wake storms are simulated by starting all clients at once and, with
+--storm-every, by waking all sleeping clients at the same moment, as after
+a power outage or with clients aligned to the same update time. Each
+client polls its own alias, so the client_stagger_window_s setting spreads
+them like a real fleet.
+
+    python -m backend.benchmarks.load --clients 500 --duration 30 --output load.json
+
+With --transport asgi, requests are passed to the application without
+sockets, which measures the serving path alone; --transport http serves
+with uvicorn on localhost and connects each request anew like the devices.
+Clients and server share the event loop and the CPU, so the latencies are
+an upper bound of what a device would see.
+"""
+
+from typing import Any, Dict, List
+import argparse
+import asyncio
+import copy
+import datetime
+import json
+import platform
+import random
+import re
+import socket
+import statistics
+import sys
+import time
+from loguru import logger
+
+from .fakes import MemoryRedis, replay_fixtures
+from .render import FIXTURES, git_revision
+
+
+MAX_AGE = re.compile(r"max-age=(\d+)")
+
+
+class Stats:
+
+    def __init__(self):
+        self.latencies: List[float] = []
+        self.statuses: Dict[int, int] = {}
+        self.bytes = 0
+        self.errors = 0
+
+    def add(self, status: int, latency_s: float, size: int):
+        self.latencies.append(latency_s)
+        self.statuses[status] = self.statuses.get(status, 0) + 1
+        self.bytes += size
+
+    def summary(self, duration_s: float) -> Dict[str, Any]:
+        latencies = sorted(self.latencies)
+        percentiles = statistics.quantiles(latencies, n=100, method="inclusive") if len(latencies) > 1 else latencies * 99
+        return {
+            "requests": len(latencies),
+            "errors": self.errors,
+            "throughput_rps": len(latencies) / duration_s,
+            "statuses": { str(status): count for status, count in sorted(self.statuses.items()) },
+            "ratio_200_304": self.statuses.get(200, 0) / max(1, self.statuses.get(304, 0)),
+            "bytes": self.bytes,
+            "latency_ms": {
+                "p50": percentiles[49] * 1000 if latencies else None,
+                "p99": percentiles[98] * 1000 if latencies else None,
+                "max": latencies[-1] * 1000 if latencies else None,
+            },
+        }
+
+
+class Fleet:
+    """Simulated displays, each polling one display id or alias."""
+
+    def __init__(self, request, ids: List[str], clients: int, time_scale: float, jitter: float, start_spread_s: float):
+        self.request = request          # async (url, headers) -> (status, headers, size)
+        self.ids = ids
+        self.clients = clients
+        self.time_scale = time_scale
+        self.jitter = jitter
+        self.start_spread_s = start_spread_s
+        self.storm = asyncio.Event()
+        self.stats = Stats()
+        self.random = random.Random(0)
+
+    def wake_all(self):
+        self.storm.set()
+        self.storm = asyncio.Event()
+
+    async def sleep(self, delay_s: float):
+        """Sleeps until the delay passed or a wake storm starts."""
+        try:
+            await asyncio.wait_for(self.storm.wait(), delay_s)
+        except asyncio.TimeoutError:
+            pass
+
+    async def client(self, index: int):
+        url = f"/api/displays/{self.ids[index % len(self.ids)]}/image"
+        etag = None
+        await self.sleep(self.random.uniform(0, self.start_spread_s))
+        while True:
+            headers = { "If-None-Match": etag } if etag else {}
+            start = time.perf_counter()
+            try:
+                status, response_headers, size = await self.request(url, headers)
+            except Exception as e:
+                logger.warning(f"Request {url} failed: {e}")
+                self.stats.errors += 1
+                await self.sleep(1)
+                continue
+            self.stats.add(status, time.perf_counter() - start, size)
+            etag = response_headers.get("etag", etag)
+            match = MAX_AGE.search(response_headers.get("cache-control", ""))
+            max_age = int(match.group(1)) if match else 60
+            # device clocks are not exact, spread the wake ups by the jitter
+            await self.sleep(max_age * self.time_scale * self.random.uniform(1 - self.jitter, 1 + self.jitter))
+
+    async def run(self, duration_s: float, storm_every_s: float) -> float:
+        tasks = [asyncio.ensure_future(self.client(i)) for i in range(self.clients)]
+        start = time.perf_counter()
+        try:
+            while time.perf_counter() - start < duration_s:
+                remaining = duration_s - (time.perf_counter() - start)
+                await asyncio.sleep(min(storm_every_s or remaining, remaining))
+                if storm_every_s and time.perf_counter() - start < duration_s:
+                    self.wake_all()
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+        return time.perf_counter() - start
+
+
+async def change_datasources(context, change_every_s: float):
+    """Stores modified fixture data periodically and re-renders the displays using it, like the datasource scheduler."""
+    step = 0
+    while True:
+        await asyncio.sleep(change_every_s)
+        step += 1
+        for datasource in context.datasources.values():
+            data = copy.deepcopy(FIXTURES.get(datasource.__class__.__name__))
+            if isinstance(data, dict) and isinstance(data.get("current"), dict) and "temp" in data["current"]:
+                data["current"]["temp"] += step
+            elif isinstance(data, dict):
+                data["step"] = step
+            await datasource.set_data(data)
+            for epaper in context.epapers.values():
+                if datasource.id in epaper.get_datasource_ids():
+                    context.render_scheduler.trigger(epaper.id)
+
+
+def patch_app(main, redis: MemoryRedis):
+    """Connects the app to the in-memory Redis and replaces datasource updates by the fixtures."""
+    async def from_url(url, **kwargs):
+        return redis
+    main.redis.from_url = from_url
+    create_datasources = main.create_datasources
+    def create_datasources_with_fixtures(glob_pattern, _redis):
+        datasources = create_datasources(glob_pattern, _redis)
+        replay_fixtures(datasources, FIXTURES)
+        return datasources
+    main.create_datasources = create_datasources_with_fixtures
+
+
+async def wait_for_first_render(context, timeout_s: float = 60):
+    start = time.perf_counter()
+    while not all([(await epaper.get_metadata()).version for epaper in context.epapers.values()]):
+        if time.perf_counter() - start > timeout_s:
+            raise TimeoutError("Displays were not rendered")
+        await asyncio.sleep(0.05)
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+async def run(args) -> Dict[str, Any]:
+    from .. import main
+    from ..core.stagger import client_stagger
+    logger.remove()
+    logger.add(sys.stderr, level="WARNING")
+    redis = MemoryRedis()
+    patch_app(main, redis)
+
+    if args.transport == "asgi":
+        import httpx
+        await main.app.router.startup()
+        client = httpx.AsyncClient(transport=httpx.ASGITransport(app=main.app), base_url="http://epaper")
+        async def request(url, headers):
+            response = await client.get(url, headers=headers)
+            return response.status_code, response.headers, len(response.content)
+        async def stop():
+            await client.aclose()
+            await main.app.router.shutdown()
+    else:
+        import aiohttp
+        import uvicorn
+        port = free_port()
+        server = uvicorn.Server(uvicorn.Config(main.app, host="127.0.0.1", port=port, lifespan="on", log_level="warning"))
+        server.install_signal_handlers = lambda: None
+        serving = asyncio.ensure_future(server.serve())
+        while not server.started:
+            await asyncio.sleep(0.01)
+        # a new connection per request, the devices sleep between requests
+        session = aiohttp.ClientSession(f"http://127.0.0.1:{port}", connector=aiohttp.TCPConnector(force_close=True, limit=0))
+        async def request(url, headers):
+            async with session.get(url, headers=headers) as response:
+                return response.status, { k.lower(): v for k, v in response.headers.items() }, len(await response.read())
+        async def stop():
+            await session.close()
+            server.should_exit = True
+            await serving
+
+    context = main.app.context
+    await wait_for_first_render(context)
+    # one alias per simulated device, like a fleet with an alias per ESP32
+    display_ids = list(context.epapers)
+    ids = [f"load-device-{i:05d}" for i in range(args.clients)]
+    context.aliases.update({ alias: display_ids[i % len(display_ids)] for i, alias in enumerate(ids) })
+    fleet = Fleet(request, ids, args.clients, args.time_scale, args.jitter, args.start_spread)
+    changing = asyncio.ensure_future(change_datasources(context, args.change_every))
+    commands_before, cpu_before = redis.commands, time.process_time()
+    try:
+        duration_s = await fleet.run(args.duration, args.storm_every)
+    finally:
+        changing.cancel()
+        await stop()
+    cpu_s = time.process_time() - cpu_before
+    summary = fleet.stats.summary(duration_s)
+    requests = max(1, summary["requests"])
+    summary.update({
+        "duration_s": duration_s,
+        "cpu_s": cpu_s,
+        "cpu_ms_per_request": cpu_s * 1000 / requests,
+        "redis_commands_per_request": (redis.commands - commands_before) / requests,
+        "renders": sum(epaper.renders for epaper in context.epapers.values()),
+        "client_stagger": client_stagger.stats(),
+    })
+    return {
+        "created_at": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        "revision": git_revision(),
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "parameters": vars(args),
+        "result": summary,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--clients", type=int, default=200)
+    parser.add_argument("--duration", type=float, default=20, help="seconds of the run")
+    parser.add_argument("--transport", choices=["asgi", "http"], default="asgi")
+    parser.add_argument("--time-scale", type=float, default=0.001, help="real seconds per max-age second the clients sleep")
+    parser.add_argument("--jitter", type=float, default=0.02, help="relative spread of the client sleeps")
+    parser.add_argument("--start-spread", type=float, default=0, help="seconds over which the clients start, 0 for a wake storm")
+    parser.add_argument("--storm-every", type=float, default=0, help="seconds between wake storms of all clients, 0 for none")
+    parser.add_argument("--change-every", type=float, default=5, help="seconds between datasource changes")
+    parser.add_argument("--output", default="benchmark-load.json")
+    args = parser.parse_args()
+
+    report = asyncio.run(run(args))
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2)
+    result = report["result"]
+    print(f"{result['requests']} requests in {result['duration_s']:.1f}s, {result['throughput_rps']:.0f} requests/s, {result['errors']} errors")
+    print(f"latency p50 {result['latency_ms']['p50']:.2f} ms, p99 {result['latency_ms']['p99']:.2f} ms, max {result['latency_ms']['max']:.2f} ms")
+    print(f"statuses {result['statuses']}, 200/304 ratio {result['ratio_200_304']:.3f}, {result['renders']} renders")
+    print(f"{result['cpu_ms_per_request']:.3f} ms CPU and {result['redis_commands_per_request']:.2f} Redis commands per request")
+    print(f"Results written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,184 @@
+"""Rendering benchmark
+
+Renders the displays configured by config/ep_*.yml from recorded datasource
+fixtures and an in-memory Redis, and times the phases of a render. Each
+layout is scaled to several panel sizes. The results are written as JSON
+to compare them across changes:
+
+    python -m backend.benchmarks.render --sizes 400x300,800x480 --output render.json
+"""
+
+from typing import Any, Dict, List, Tuple
+import argparse
+import asyncio
+import datetime
+import glob
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import yaml
+from loguru import logger
+
+from ..core import datasources
+from ..core.epaper import Epaper
+from ..core.settings import global_settings
+from ..core.utils import RedisKeyValueStore
+from .fakes import MemoryRedis, load_fixture, replay_fixtures
+
+
+FIXTURES = {
+    "WeatherDatasource": load_fixture("onecall.json"),
+    "WebScraperDatasource": load_fixture("webscraper.json"),
+}
+
+
+def parse_size(size: str) -> Tuple[int, int]:
+    width, height = size.lower().split("x")
+    return int(width), int(height)
+
+
+def scale_layout(config: Dict[str, Any], size: Tuple[int, int]) -> Dict[str, Any]:
+    """Scales the widget positions and sizes of a display config to another panel size, fonts keep their size."""
+    sx, sy = size[0] / config["size"][0], size[1] / config["size"][1]
+    scaled = dict(config, size=list(size), aliases=[])
+    scaled["widgets"] = [
+        dict(widget,
+             position=[round(widget["position"][0] * sx), round(widget["position"][1] * sy)],
+             size=[round(widget["size"][0] * sx), round(widget["size"][1] * sy)])
+        for widget in config.get("widgets", [])
+    ]
+    return scaled
+
+
+def create_datasources(redis: MemoryRedis):
+    result = {}
+    for filename in sorted(glob.glob(global_settings.datasource_config_file_pattern)):
+        with open(filename, "r") as f:
+            class_name = yaml.safe_load(f)["datasource_class"]
+        datasource = getattr(datasources, class_name)(filename, RedisKeyValueStore(redis, class_name))
+        result[datasource.id] = datasource
+    replay_fixtures(result, FIXTURES)
+    return result
+
+
+def timed(timings: Dict[str, List[float]], phase: str, func, *args):
+    start = time.perf_counter()
+    result = func(*args)
+    timings.setdefault(phase, []).append(time.perf_counter() - start)
+    return result
+
+
+async def forget_image(epaper: Epaper):
+    """Drops the last image of the display in process and in Redis, the next update draws, encodes and stores a new version."""
+    epaper._fingerprint, epaper._tiles = None, {}
+    epaper._last_image, epaper._last_image_version = None, None
+    epaper._image_buffer_version, epaper._image_buffers = None, {}
+    await epaper.kv_store.delete_kv(["image"])
+
+
+async def benchmark_epaper(epaper: Epaper, repeat: int) -> Dict[str, List[float]]:
+    timings: Dict[str, List[float]] = {}
+    previous = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        widgets_data = await asyncio.gather(*(w.get_data() for w in epaper.widgets))
+        fingerprints = [w.get_fingerprint(data) for w, data in zip(epaper.widgets, widgets_data)]
+        timings.setdefault("data", []).append(time.perf_counter() - start)
+
+        # draw every tile, then compose from the drawn tiles
+        epaper._tiles = {}
+        for index, (widget, data, fp) in enumerate(zip(epaper.widgets, widgets_data, fingerprints)):
+            timed(timings, f"draw:{widget.settings.widget_class}#{index}", epaper._get_tile, index, widget, data, fp)
+        image = timed(timings, "compose", epaper._compose_image, widgets_data, fingerprints)
+        rotated = timed(timings, "rotate", image.rotate, epaper.settings.rotation, True)
+        quantized = timed(timings, "quantize", epaper.quantizer.quantize, rotated)
+        if previous is not None:
+            timed(timings, "diff", epaper._image_is_different, previous, quantized)
+        timed(timings, "encode:png", epaper._encode_image, quantized, "png")
+        timed(timings, "encode:all", epaper._encode_images, quantized)
+        previous = quantized
+
+        # complete updates through the in-memory Redis, with and without changed inputs
+        await forget_image(epaper)
+        start = time.perf_counter()
+        await epaper._update()
+        timings.setdefault("update:cold", []).append(time.perf_counter() - start)
+        start = time.perf_counter()
+        await epaper._update()
+        timings.setdefault("update:skipped", []).append(time.perf_counter() - start)
+    return timings
+
+
+def summarize(timings: Dict[str, List[float]]) -> Dict[str, Dict[str, float]]:
+    return {
+        phase: {
+            "median_ms": statistics.median(values) * 1000,
+            "min_ms": min(values) * 1000,
+            "max_ms": max(values) * 1000,
+            "runs": len(values),
+        }
+        for phase, values in timings.items()
+    }
+
+
+def git_revision() -> str:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+    except Exception:
+        return ""
+
+
+async def run(sizes: List[Tuple[int, int]], repeat: int) -> Dict[str, Any]:
+    redis = MemoryRedis()
+    _datasources = create_datasources(redis)
+    results = []
+    with tempfile.TemporaryDirectory() as tmp:
+        for filename in sorted(glob.glob(global_settings.epaper_config_file_pattern)):
+            with open(filename, "r") as f:
+                config = yaml.safe_load(f)
+            for size in [tuple(config["size"])] + [s for s in sizes if s != tuple(config["size"])]:
+                # the file name is the display id
+                directory = os.path.join(tmp, f"{size[0]}x{size[1]}")
+                os.makedirs(directory, exist_ok=True)
+                scaled_filename = os.path.join(directory, os.path.basename(filename))
+                with open(scaled_filename, "w") as f:
+                    yaml.safe_dump(scale_layout(config, size), f)
+                epaper = Epaper(scaled_filename, RedisKeyValueStore(redis, f"Epaper{size[0]}x{size[1]}"), _datasources, {})
+                timings = await benchmark_epaper(epaper, repeat)
+                results.append({ "display": epaper.id, "size": list(size), "phases": summarize(timings) })
+    return {
+        "created_at": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        "revision": git_revision(),
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "repeat": repeat,
+        "results": results,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", default="400x300,800x480,1304x984", help="comma separated panel sizes in addition to the configured one")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--output", default="benchmark-render.json")
+    args = parser.parse_args()
+    logger.remove()
+    logger.add(sys.stderr, level="WARNING")
+
+    report = asyncio.run(run([parse_size(s) for s in args.sizes.split(",") if s], args.repeat))
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2)
+    for result in report["results"]:
+        print(f"{result['display']} {result['size'][0]}x{result['size'][1]}")
+        for phase, stats in result["phases"].items():
+            print(f"  {phase:<40} {stats['median_ms']:9.2f} ms")
+    print(f"Results written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,35 @@
+"""Raw bitmaps in the native layout of epaper panels
+
+Rows are padded to full bytes, the leftmost pixel is stored in the most
+significant bit(s) of a byte.
+"""
+
+from typing import List, Tuple
+import numpy as np
+from PIL import Image
+
+
+def color_indices(image: Image.Image, colors: List[Tuple[int, int, int]]) -> np.ndarray:
+    """Maps each pixel of a palette image to the index of the nearest of the given colors."""
+    palette = np.array(image.getpalette(), dtype=np.int32).reshape(-1, 3)
+    distances = ((palette[:, None, :] - np.array(colors, dtype=np.int32)[None, :, :]) ** 2).sum(axis=2)
+    lut = np.zeros(256, dtype=np.uint8)
+    lut[:len(palette)] = distances.argmin(axis=1)
+    return lut[np.asarray(image)]
+
+
+def pack_indices(indices: np.ndarray, bits_per_pixel: int) -> bytes:
+    """Packs color indices with bits_per_pixel bits each."""
+    shifts = np.arange(bits_per_pixel - 1, -1, -1, dtype=np.uint8)
+    bits = (indices[:, :, None] >> shifts) & 1
+    return np.packbits(bits.reshape(indices.shape[0], -1), axis=1).tobytes()
+
+
+def pack_planes(indices: np.ndarray, color_count: int) -> bytes:
+    """
+    Packs one 1-bpp plane for each color except the background color 0, e.g.
+    black and red for bwr panels. As in GxEPD2 bitmaps, a bit is 0 where the
+    pixel has the color of the plane and 1 elsewhere.
+    """
+    planes = [np.packbits(indices != color, axis=1).tobytes() for color in range(1, color_count)]
+    return b"".join(planes)
@@ -0,0 +1,116 @@
+"""Small chart renderer drawing directly with a DrawingContext
+
+Charts are drawn without anti-aliasing in the colors of the widget, which
+suits 1-bit and 3-color panels. Data is transformed to pixel coordinates
+with numpy; x values are usually UNIX timestamps.
+"""
+
+from typing import List, Optional, Sequence, Tuple
+import math
+import datetime
+import numpy as np
+from .drawingcontext import DrawingContext
+
+
+# candidate distances of time ticks in seconds, from 15 minutes to one day
+TIME_TICK_STEPS = [900, 1800, 3600, 2 * 3600, 3 * 3600, 6 * 3600, 12 * 3600, 24 * 3600]
+
+
+def time_ticks(x_min: float, x_max: float, max_ticks: int, tz: Optional[datetime.tzinfo] = None) -> np.ndarray:
+    """Returns ticks at full multiples of the smallest step giving at most max_ticks ticks, in local time."""
+    offset = datetime.datetime.fromtimestamp(x_min, tz).utcoffset() if tz else None
+    offset_s = offset.total_seconds() if offset else 0
+    for step in TIME_TICK_STEPS:
+        if (x_max - x_min) / step <= max_ticks:
+            break
+    first = math.ceil((x_min + offset_s) / step) * step - offset_s
+    return np.arange(first, x_max + 1, step)
+
+
+def value_ticks(y_min: float, y_max: float, max_ticks: int) -> np.ndarray:
+    """Returns ticks at multiples of 1, 2 or 5 times a power of ten."""
+    raw_step = (y_max - y_min) / max(1, max_ticks)
+    magnitude = 10 ** math.floor(math.log10(raw_step)) if raw_step > 0 else 1
+    step = next(m * magnitude for m in (1, 2, 5, 10) if m * magnitude >= raw_step)
+    return np.arange(math.ceil(y_min / step) * step, y_max + step / 2, step)
+
+
+class Chart:
+    """
+    Plot area inside a box of the drawing context, given relative to its
+    origin as (x, y, width, height), with fixed data ranges.
+    """
+
+    def __init__(self, ctx: DrawingContext, box: Tuple[int, int, int, int],
+                 x_range: Tuple[float, float], y_range: Tuple[float, float], color=DrawingContext.FOREGROUND):
+        self.ctx = ctx
+        self.x0, self.y0, self.width, self.height = box
+        self.x_range = x_range
+        self.y_range = y_range
+        self.color = tuple(color)
+
+    def transform(self, xs: Sequence[float], ys: Sequence[float]) -> Tuple[np.ndarray, np.ndarray]:
+        """Maps data to pixel coordinates of the image, values outside the ranges are clipped to the box."""
+        xs = np.asarray(xs, dtype=np.float64)
+        ys = np.asarray(ys, dtype=np.float64)
+        sx = (self.width - 1) / ((self.x_range[1] - self.x_range[0]) or 1)
+        sy = (self.height - 1) / ((self.y_range[1] - self.y_range[0]) or 1)
+        px = np.clip(np.rint((xs - self.x_range[0]) * sx), 0, self.width - 1) + self.x0 + self.ctx.origin[0]
+        py = np.clip(np.rint((self.y_range[1] - ys) * sy), 0, self.height - 1) + self.y0 + self.ctx.origin[1]
+        return px.astype(np.int32), py.astype(np.int32)
+
+    def _points(self, xs, ys) -> List[Tuple[int, int]]:
+        px, py = self.transform(xs, ys)
+        return list(zip(px.tolist(), py.tolist()))
+
+    def line(self, xs, ys, color=None, width: int = 1):
+        self.ctx.draw.line(self._points(xs, ys), fill=tuple(color or self.color), width=width)
+
+    def area(self, xs, ys, color=None, baseline: float = 0):
+        points = self._points(xs, ys)
+        if not points:
+            return
+        _, (base_y,) = self.transform([self.x_range[0]], [baseline])
+        polygon = [(points[0][0], int(base_y))] + points + [(points[-1][0], int(base_y))]
+        self.ctx.draw.polygon(polygon, fill=tuple(color or self.color))
+
+    def bars(self, xs, ys, bar_width: float, color=None, baseline: float = 0):
+        """Draws bars of bar_width in data units centered at xs."""
+        xs = np.asarray(xs, dtype=np.float64)
+        left, top = self.transform(xs - bar_width / 2, ys)
+        right, bottom = self.transform(xs + bar_width / 2, np.full(len(xs), baseline))
+        for x0, y0, x1, y1 in zip(left.tolist(), top.tolist(), right.tolist(), bottom.tolist()):
+            if y0 != y1:
+                self.ctx.draw.rectangle([(x0, min(y0, y1)), (max(x0, x1 - 1), max(y0, y1))], fill=tuple(color or self.color))
+
+    def grid(self, x_ticks=(), y_ticks=(), dash: int = 2):
+        """Draws dotted grid lines, every dash-th pixel is set."""
+        px, _ = self.transform(x_ticks, np.zeros(len(x_ticks)))
+        _, py = self.transform(np.zeros(len(y_ticks)), y_ticks)
+        left, top = self.x0 + self.ctx.origin[0], self.y0 + self.ctx.origin[1]
+        for x in px.tolist():
+            self.ctx.draw.point([(x, y) for y in range(top, top + self.height, dash)], fill=self.color)
+        for y in py.tolist():
+            self.ctx.draw.point([(x, y) for x in range(left, left + self.width, dash)], fill=self.color)
+
+    def frame(self):
+        left, top = self.x0 + self.ctx.origin[0], self.y0 + self.ctx.origin[1]
+        self.ctx.draw.rectangle([(left, top), (left + self.width - 1, top + self.height - 1)], outline=self.color)
+
+    def x_labels(self, ticks, labels: List[str], font):
+        """Draws labels centered below the plot area, skipping labels which would leave the box."""
+        px, _ = self.transform(ticks, np.zeros(len(ticks)))
+        for x, label in zip(px.tolist(), labels):
+            width, _ = self.ctx.textsize(label, font)
+            x = x - self.ctx.origin[0]
+            if x - width / 2 < self.x0 or x + width / 2 > self.x0 + self.width:
+                continue
+            self.ctx.draw_text_xy((math.floor(x - width / 2), self.y0 + self.height + 1), label, font, fill=self.color)
+
+    def y_labels(self, ticks, labels: List[str], font):
+        """Draws labels right-aligned left of the plot area."""
+        _, py = self.transform(np.zeros(len(ticks)), ticks)
+        for y, label in zip(py.tolist(), labels):
+            width, height = self.ctx.textsize(label, font)
+            y = y - self.ctx.origin[1]
+            self.ctx.draw_text_xy((self.x0 - width - 2, math.floor(y - height / 2)), label, font, fill=self.color)
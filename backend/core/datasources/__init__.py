@@ -1,4 +1,19 @@
-from .weather import WeatherDatasource
-from .webscraper import WebScraperDatasource
+"""Datasources by class name, imported when first accessed"""
 
-__all__ = ["WeatherDatasource", "WebScraperDatasource"]
+import importlib
+
+_MODULES = {
+    "WeatherDatasource": ".weather",
+    "WebScraperDatasource": ".webscraper",
+}
+
+__all__ = list(_MODULES)
+
+
+def __getattr__(name):
+    module_name = _MODULES.get(name)
+    if module_name is None:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    value = getattr(importlib.import_module(module_name, __name__), name)
+    globals()[name] = value
+    return value
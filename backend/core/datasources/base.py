@@ -1,13 +1,17 @@
-from typing import Dict, Any
+from typing import Callable, Dict, Any, List, Optional, Set
 from pydantic import BaseModel
 import datetime
+import asyncio
 import os
 import yaml
 import json
+import hashlib
+import time
 from loguru import logger
 
 from .. import datasources
-from ..utils import RedisKeyValueStore
+from ..utils import RedisKeyValueStore, decode_datetime, fingerprint
+from ..metrics import datasource_update_duration, datasource_update_errors
 
 
 class BaseDatasource:
@@ -21,6 +25,18 @@ class BaseDatasource:
         self.settings_filename = settings_filename
         self.kv_store = kv_store
         self.kv_store.set_instance_key(self.id)
+        self._last_data = None          # decoded data of last_update _last_data_update and the hash of its serialization
+        self._last_data_hash = None
+        self._last_data_update = None
+        self.data_cache_hits = 0
+        self.data_cache_misses = 0
+        self.data_hash = None           # hash and time of the data last written by this process
+        self.data_updated_at = None
+        self._update_future = None      # in-flight update() shared by concurrent callers
+        self._refresh_task = None       # background refresh of stale data started by get_data()
+        self.on_changed: Optional[Callable[[str], None]] = None    # called with the id when an update changed the data, see update_once()
+        self._update_duration = datasource_update_duration.labels(self.id)
+        self._update_errors = datasource_update_errors.labels(self.id)
         self.load_settings()
 
     def load_settings(self):
@@ -37,23 +53,122 @@ class BaseDatasource:
         logger.info(f"Configured datasource id={self.id} settings=({self.settings})")
 
     async def get_data(self):
-        last_update = await self.kv_store.get_kv("last_update")
-        last_update_at = datetime.datetime.fromisoformat(last_update) if last_update else None
-
-        update_needed = last_update_at is None or self.settings is None or self.settings.max_age_s is None or self.settings.max_age_s <= 0
-        if not update_needed:
-            max_age = datetime.timedelta(seconds=self.settings.max_age_s)
-            now = datetime.datetime.now(datetime.timezone.utc)
-            update_needed = (now - last_update_at) >= max_age
-        if update_needed:
-            await self.update()
-        data = await self.kv_store.get_kv_as_json("data")
+        """
+        Returns the decoded data, from the in-process cache as long as
+        last_update in Redis did not change. Stale data is returned
+        immediately while it is refreshed in the background, on_changed()
+        announces the refreshed data. A datasource without any data or
+        without max_age_s waits for the update.
+        """
+        last_update_at = await self.get_last_update()
+        if last_update_at is None or not self._max_age_s():
+            await self.update_once(notify=False)
+            last_update_at = await self.get_last_update()
+        elif self._is_stale(last_update_at):
+            self._refresh_in_background()
+
+        if last_update_at is not None and last_update_at == self._last_data_update:
+            self.data_cache_hits += 1
+            return self._last_data
+        self.data_cache_misses += 1
+        # last_update and data are written together, read both to get a consistent pair
+        values = await self.kv_store.get_kv_multi(["last_update", "data"])
+        data = self.decode(values["data"]) if values["data"] else None
+        self._last_data = data
+        self._last_data_hash = hashlib.sha1(values["data"]).hexdigest() if values["data"] else None
+        self._last_data_update = decode_datetime(values["last_update"])
         return data
 
-    async def set_data(self, data: Dict[str, Any]):
+    def _max_age_s(self) -> int:
+        if self.settings is None or self.settings.max_age_s is None:
+            return 0
+        return max(0, self.settings.max_age_s)
+
+    def _is_stale(self, last_update_at: datetime.datetime) -> bool:
+        max_age = datetime.timedelta(seconds=self._max_age_s())
+        return datetime.datetime.now(datetime.timezone.utc) - last_update_at >= max_age
+
+    def _refresh_in_background(self):
+        if self._update_future is None and self._refresh_task is None:
+            self._refresh_task = asyncio.ensure_future(self.update_once())
+            self._refresh_task.add_done_callback(self._refresh_done)
+
+    def _refresh_done(self, task):
+        self._refresh_task = None
+        if not task.cancelled() and task.exception() is not None:
+            logger.error(f"Error refreshing datasource {self.id}: {task.exception()}")
+
+    @property
+    def tasks(self) -> List[asyncio.Future]:
+        """The running background refresh and update, see cancel()."""
+        return [task for task in (self._refresh_task, self._update_future) if task is not None]
+
+    def cancel(self):
+        """Cancels the background refresh and the running update, e.g. on shutdown."""
+        for task in self.tasks:
+            task.cancel()
+
+    def require(self, parts: Optional[Set[str]]):
+        """Announces the parts of the data a widget uses, None meaning all; datasources may fetch only those."""
+        pass
+
+    def decode(self, raw: bytes):
+        """Decodes the stored data."""
+        return json.loads(raw)
+
+    def get_data_hash(self, data) -> str:
+        """Returns a content hash of data returned by get_data(), cheap for the most recent data."""
+        if data is self._last_data and data is not None:
+            return self._last_data_hash
+        return fingerprint(data)
+
+    async def get_last_update(self) -> Optional[datetime.datetime]:
+        return decode_datetime(await self.kv_store.get_kv_binary("last_update"))
+
+    async def set_data(self, data: Dict[str, Any], extra_values: Optional[Dict[str, Any]] = None):
+        """Stores the data, and optionally further values of this datasource, in one atomic write."""
         dt = datetime.datetime.now(datetime.timezone.utc)
         s = json.dumps(data)
-        await self.kv_store.set_kv_from_dict({"last_update": dt.isoformat(), "data": s})
+        await self.kv_store.set_kv_from_dict(dict(extra_values or {}, last_update=dt.isoformat(), data=s))
+        self.data_hash = hashlib.sha1(s.encode()).hexdigest()
+        self.data_updated_at = dt
+
+    async def touch(self):
+        """Marks the stored data as up to date, e.g. after the source responded "not modified"."""
+        dt = datetime.datetime.now(datetime.timezone.utc)
+        await self.kv_store.set_kv_from_dict({"last_update": dt.isoformat()})
+        self.data_updated_at = dt
+
+    async def update_once(self, notify: bool = True):
+        """
+        Runs update(), concurrent callers wait for the same in-flight update
+        instead of starting another one. If the update changed the data,
+        on_changed() is called unless the caller which started the update
+        draws the data itself (notify=False).
+        """
+        if self._update_future is None:
+            self._update_future = asyncio.ensure_future(self._measured_update(notify))
+            self._update_future.add_done_callback(self._update_done)
+        # shielded, a cancelled caller must not cancel the update for the others
+        await asyncio.shield(self._update_future)
+
+    async def _measured_update(self, notify: bool):
+        previous_hash = self.data_hash
+        start = time.perf_counter()
+        try:
+            await self.update()
+        except Exception:
+            self._update_errors.inc()
+            raise
+        finally:
+            self._update_duration.observe(time.perf_counter() - start)
+        if notify and self.on_changed is not None and self.data_hash != previous_hash:
+            self.on_changed(self.id)
+
+    def _update_done(self, future):
+        self._update_future = None
+        if not future.cancelled():
+            future.exception()  # errors are raised to the callers, mark them as retrieved if all were cancelled
 
     async def update(self):
         """ Updates the data - overwrite this method to do the actual work!"""
@@ -0,0 +1,184 @@
+"""Extraction of values from fetched documents
+
+Extractors are compiled once when the settings are loaded. Regular
+expressions work on the text as it is received, so a download can stop
+as soon as all of them have matched; JSONPath and XPath expressions need
+the complete document. While streaming, each regular expression continues
+its search where the previous one stopped, less an overlap of
+STREAM_OVERLAP characters for matches crossing a chunk boundary.
+"""
+
+from typing import Any, Dict, List, Optional, Tuple
+from functools import cached_property
+import re
+import json
+
+
+STREAM_OVERLAP = 1024   # longest match expected to cross a chunk boundary
+
+class Document:
+    """Received text of a document, parsed on demand and at most once."""
+
+    def __init__(self, text: str, complete: bool):
+        self.text = text
+        self.complete = complete
+
+    @cached_property
+    def json(self):
+        return json.loads(self.text)
+
+    @cached_property
+    def html(self):
+        import lxml.html  # lxml is only loaded if XPath expressions are configured
+        return lxml.html.fromstring(self.text)
+
+
+class RegexExtractor:
+    """Extracts the named groups of the first match of a regular expression."""
+    streaming = True
+
+    def __init__(self, expression: str):
+        self.expression = expression
+        self.pattern = re.compile(expression)
+
+    def extract(self, document: Document) -> Optional[Dict[str, Any]]:
+        values, _ = self.search(document.text, 0, document.complete)
+        return values
+
+    def search(self, text: str, position: int, complete: bool) -> Tuple[Optional[Dict[str, Any]], int]:
+        """Searches text from position, returns the values or None and the position to continue from with more text."""
+        match = self.pattern.search(text, position)
+        if match is None:
+            return None, max(position, len(text) - STREAM_OVERLAP)
+        # a match ending at the end of incomplete text might continue in the next chunk
+        if not complete and match.end() >= len(text):
+            return None, match.start()
+        return match.groupdict(default={}), match.end()
+
+
+_JSON_PATH_TOKEN = re.compile(r"\.([A-Za-z_][\w-]*)|\[(\d+)\]|\['([^']*)'\]|\[\"([^\"]*)\"\]")
+
+
+def compile_json_path(path: str) -> List[Any]:
+    """
+    Compiles the subset of JSONPath selecting a single value, e.g.
+    $.hourly[0].temp or $['delta']['cases'], to a list of keys and indices.
+    """
+    if not path.startswith("$"):
+        raise ValueError(f"JSONPath must start with $: {path}")
+    steps, position = [], 1
+    while position < len(path):
+        match = _JSON_PATH_TOKEN.match(path, position)
+        if match is None:
+            raise ValueError(f"Unsupported JSONPath {path} at position {position}")
+        name, index, quoted, double_quoted = match.groups()
+        steps.append(int(index) if index is not None else next(s for s in (name, quoted, double_quoted) if s is not None))
+        position = match.end()
+    return steps
+
+
+class JsonPathExtractor:
+    """Extracts a single value of a JSON document."""
+    streaming = False
+
+    def __init__(self, name: str, path: str):
+        self.name = name
+        self.expression = path
+        self.steps = compile_json_path(path)
+
+    def extract(self, document: Document) -> Optional[Dict[str, Any]]:
+        value = document.json
+        for step in self.steps:
+            try:
+                value = value[step]
+            except (KeyError, IndexError, TypeError):
+                return None
+        return { self.name: value }
+
+
+class XPathExtractor:
+    """Extracts the text of the first node matching an XPath expression in an HTML document."""
+    streaming = False
+
+    def __init__(self, name: str, expression: str):
+        from lxml import etree
+        self.name = name
+        self.expression = expression
+        self.xpath = etree.XPath(expression)
+
+    def extract(self, document: Document) -> Optional[Dict[str, Any]]:
+        results = self.xpath(document.html)
+        if isinstance(results, list):
+            if not results:
+                return None
+            results = results[0]
+        value = results.text_content() if hasattr(results, "text_content") else str(results)
+        return { self.name: value.strip() }
+
+
+class Extraction:
+    """
+    Collects the values of all extractors from a document received in chunks.
+    The chunks are joined only if the complete text is needed; streaming
+    searches keep the text from the earliest position to continue from.
+    """
+
+    def __init__(self, extractors: List[Any]):
+        self.pending = list(extractors)
+        self.data: Dict[str, Any] = {}
+        self.chunks: List[str] = []
+        self.window = ""            # text from window_start on, searched by streaming extractors
+        self.window_start = 0
+        self.positions: Dict[Any, int] = {}     # pending extractor -> position to continue its search from
+
+    @property
+    def done(self) -> bool:
+        return not self.pending
+
+    @property
+    def streaming(self) -> bool:
+        return all(e.streaming for e in self.pending)
+
+    @property
+    def text(self) -> str:
+        return "".join(self.chunks)
+
+    def feed(self, text: str):
+        """Adds received text, applies the streaming extractors if all pending ones are."""
+        self.chunks.append(text)
+        if self.pending and self.streaming:
+            self._search(text)
+
+    def finish(self) -> Tuple[Dict[str, Any], List[Any]]:
+        """Applies the remaining extractors to the complete text, returns the data and the extractors without match."""
+        if self.pending:
+            self._extract(complete=True)
+        return self.data, self.pending
+
+    def _search(self, text: str):
+        self.window += text
+        pending = []
+        for extractor in self.pending:
+            position = max(self.positions.get(extractor, 0), self.window_start)
+            values, position = extractor.search(self.window, position - self.window_start, complete=False)
+            if values is None:
+                self.positions[extractor] = self.window_start + position
+                pending.append(extractor)
+            else:
+                self.data.update(values)
+        self.pending = pending
+        # drop the text no pending search will look at again
+        start = min((self.positions[extractor] for extractor in pending), default=self.window_start + len(self.window))
+        self.window = self.window[start - self.window_start:]
+        self.window_start = start
+
+    def _extract(self, complete: bool):
+        document = Document(self.text, complete)
+        pending = []
+        for extractor in self.pending:
+            values = extractor.extract(document)
+            if values is None:
+                pending.append(extractor)
+            else:
+                self.data.update(values)
+        self.pending = pending
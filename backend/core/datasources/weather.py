@@ -1,14 +1,58 @@
-from typing import Dict, Any
-import aiohttp
+from typing import Dict, Any, Optional, Set
+import json
 from loguru import logger
 
 from ..settings import global_settings
 from .base import BaseDatasource
 from ..utils import RedisKeyValueStore
+from ..http import get_session
 
 
 BASE_URL = "https://api.openweathermap.org/data/2.5"
 
+ONECALL_PARTS = { "current", "minutely", "hourly", "daily", "alerts" }
+
+# series stored column-wise as one list per field, rounded to the precision of the OpenWeather API
+SERIES_FIELDS = {
+    "minutely": { "dt": None, "precipitation": 2 },
+    "hourly": { "dt": None, "temp": 2, "feels_like": 2, "pressure": None, "humidity": None,
+                "wind_speed": 2, "wind_deg": None, "pop": 2, "icon": None, "description": None },
+}
+
+
+def _field(item: Dict[str, Any], field: str):
+    if field in ("icon", "description"):
+        return item["weather"][0][field] if item.get("weather") else None
+    return item.get(field)
+
+
+def _columns(items, fields: Dict[str, Optional[int]]) -> Dict[str, list]:
+    columns = {}
+    for field, digits in fields.items():
+        values = [_field(item, field) for item in items]
+        columns[field] = [round(v, digits) if digits is not None and v is not None else v for v in values]
+    return columns
+
+
+def compact_onecall(onecall: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Converts the minutely and hourly lists of a onecall document to columns,
+    e.g. hourly["temp"][i] instead of hourly[i]["temp"], keeping only the
+    fields used for drawing. Already compact documents are returned as they are.
+    """
+    compact = dict(onecall)
+    for part, fields in SERIES_FIELDS.items():
+        items = onecall.get(part)
+        if isinstance(items, list):
+            compact[part] = _columns(items, fields)
+    return compact
+
+
+def onecall_series(onecall: Dict[str, Any], part: str) -> Optional[Dict[str, list]]:
+    """Returns the minutely or hourly series column-wise, whether the document is compact or not."""
+    items = onecall.get(part)
+    return _columns(items, SERIES_FIELDS[part]) if isinstance(items, list) else items
+
 
 class WeatherDatasource(BaseDatasource):
 
@@ -21,7 +65,23 @@ class WeatherDatasource(BaseDatasource):
     def __init__(self, settings_filename: str, kv_store: RedisKeyValueStore):
         super().__init__(settings_filename, kv_store)
         self.lang = global_settings.locale.split(".")[0]
-        self.session = aiohttp.ClientSession(raise_for_status=True)
+        self.parts: Optional[Set[str]] = set()  # parts of the onecall document used by the widgets, None = all
+
+    def require(self, parts: Optional[Set[str]]):
+        if parts is None or self.parts is None:
+            self.parts = None
+        else:
+            self.parts |= parts
+
+    @property
+    def compact(self) -> bool:
+        """Whether the series are stored column-wise; widgets using the whole document, e.g. with format strings, get it as fetched."""
+        return self.parts is not None
+
+    def decode(self, raw: bytes):
+        # documents stored before the compact format are converted when read
+        onecall = json.loads(raw)
+        return compact_onecall(onecall) if self.compact else onecall
 
     async def update(self):
         # Fetch now
@@ -40,7 +100,10 @@ class WeatherDatasource(BaseDatasource):
 
         # Fetch one-call
         url = f"{BASE_URL}/onecall?units={global_settings.units}&lang={self.lang}&lat={self.settings.lat}&lon={self.settings.lon}&APPID={self.settings.api_key}"
+        exclude = sorted(ONECALL_PARTS - self.parts) if self.parts is not None else []
+        if exclude:
+            url += f"&exclude={','.join(exclude)}"
         logger.info(f"Updating {self.id} in {self.__class__.__name__}, fetching {url}")
-        async with self.session.get(url) as response:
+        async with get_session().get(url) as response:
             onecall = await response.json()
-        await self.set_data(onecall)
+        await self.set_data(compact_onecall(onecall) if self.compact else onecall)
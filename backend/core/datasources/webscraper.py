@@ -1,43 +1,68 @@
 from typing import Dict, Any
-import aiohttp
-import re
+import codecs
 from loguru import logger
 
 from .base import BaseDatasource
-from ..utils import RedisKeyValueStore
+from .extractors import Extraction, RegexExtractor, JsonPathExtractor, XPathExtractor
+from ..utils import fingerprint
+from ..http import get_session
 
 
-BASE_URL = "https://api.openweathermap.org/data/2.5"
+CHUNK_SIZE = 16 * 1024
 
 
 class WebScraperDatasource(BaseDatasource):
 
     class Settings(BaseDatasource.Settings):
         url: str
-        find_expressions: list[str]
+        find_expressions: list[str] = []    # regular expressions with named groups
+        json_paths: Dict[str, str] = {}     # name -> JSONPath like $.delta.cases
+        xpaths: Dict[str, str] = {}         # name -> XPath into the HTML document
 
-    def __init__(self, settings_filename: str, kv_store: RedisKeyValueStore):
-        super().__init__(settings_filename, kv_store)
-        self.session = aiohttp.ClientSession(raise_for_status=True)
+    def load_settings(self):
+        super().load_settings()
+        self.extractors = []
+        if getattr(self, "settings", None) is None:
+            return
+        self.extractors = [RegexExtractor(e) for e in self.settings.find_expressions] \
+            + [JsonPathExtractor(name, path) for name, path in self.settings.json_paths.items()] \
+            + [XPathExtractor(name, expression) for name, expression in self.settings.xpaths.items()]
+        # the validators of a response only apply to data extracted with the same settings
+        self.extractors_fingerprint = fingerprint(self.settings.url, self.settings.find_expressions, self.settings.json_paths, self.settings.xpaths)
 
     async def update(self):
-        data = {}
         url = self.settings.url
+        validators = await self.kv_store.get_kv_multi(["etag", "last_modified", "extractors"])
+        headers = {}
+        if validators["extractors"] and validators["extractors"].decode() == self.extractors_fingerprint:
+            if validators["etag"]:
+                headers["If-None-Match"] = validators["etag"].decode()
+            if validators["last_modified"]:
+                headers["If-Modified-Since"] = validators["last_modified"].decode()
         logger.info(f"Updating {self.id} in {self.__class__.__name__}, fetching {url}")
-        try:
-            async with self.session.get(url) as response:
-                response_text = await response.text()
-
-                for find_expression in self.settings.find_expressions:
-                    match = re.search(find_expression, response_text)
-                    if match:
-                        data.update(match.groupdict(default={}))
-                    else:
-                        logger.info(f"... no match for '{find_expression}'")
-        except Exception as e:
-            import traceback
-            logger.error(e)
-            logger.error(traceback.format_exc())
 
+        extraction = Extraction(self.extractors)
+        async with get_session().get(url, headers=headers) as response:
+            if response.status == 304:
+                logger.info(f"... {url} not modified")
+                await self.touch()
+                return
+            # stream the body, stop as soon as all regular expressions matched
+            decoder = codecs.getincrementaldecoder(response.charset or "utf-8")(errors="replace")
+            async for chunk in response.content.iter_chunked(CHUNK_SIZE):
+                extraction.feed(decoder.decode(chunk))
+                if extraction.done:
+                    break
+            else:
+                extraction.feed(decoder.decode(b"", final=True))
+            validators = {
+                "etag": response.headers.get("ETag", ""),
+                "last_modified": response.headers.get("Last-Modified", ""),
+                "extractors": self.extractors_fingerprint,
+            }
+
+        data, unmatched = extraction.finish()
+        for extractor in unmatched:
+            logger.info(f"... no match for '{extractor.expression}'")
         logger.debug(f"... collected data='{data}'")
-        await self.set_data(data)
+        await self.set_data(data, validators)
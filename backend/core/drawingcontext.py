@@ -1,44 +1,73 @@
-import os
 import math
+import threading
+from collections import OrderedDict
 from loguru import logger
-from PIL import Image, ImageFont, ImageDraw, ImageColor
+from PIL import Image, ImageDraw, ImageColor
+from .settings import global_settings
+from .resources import resources
 
 
 class FontProvider:
-    cache = {}
 
     def __init__(self, base_path):
         self.base_path = base_path
 
     def get(self, name, fontsize):
-        # Load from cache
-        font = self.cache.get((name, fontsize))
-        if font is not None:
-            return font
-
-        # Create new font
-        fontpath = os.path.join(self.base_path, name)
-        font = ImageFont.truetype(fontpath, fontsize)
-        self.cache[(name, fontsize)] = font
-
-        return font
+        return resources.get_font(self.base_path, name, fontsize)
 
 
 class IconProvider:
-    cache = {}
 
     def __init__(self, base_path):
         self.base_path = base_path
 
     def get(self, name):
-        image = IconProvider.cache.get(name)
-        if image is not None:
-            return image
+        return resources.get_icon(self.base_path, name)
+
+
+class TextMaskCache:
+    """
+    LRU cache of rasterized text runs. The 1-bit masks do not depend on the
+    fill color, which is applied when drawing the mask. Shared by the render
+    threads of all displays and bounded by the size of the masks in bytes.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.masks = OrderedDict()  # (font path, font size, text) -> mask
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, text, font):
+        key = (getattr(font, "path", id(font)), getattr(font, "size", None), text)
+        with self.lock:
+            mask = self.masks.get(key)
+            if mask is not None:
+                self.masks.move_to_end(key)
+                self.hits += 1
+                return mask
+            self.misses += 1
+
+        _, _, width, height = font.getbbox(text)
+        mask = Image.new("1", (width, height), color=0)
+        ImageDraw.Draw(mask).text((0, 0), text, font=font, fill=1)
+
+        with self.lock:
+            if key not in self.masks:
+                self.masks[key] = mask
+                self.bytes += width * height
+            while self.bytes > self.max_bytes and self.masks:
+                _, evicted = self.masks.popitem(last=False)
+                self.bytes -= evicted.width * evicted.height
+        return mask
+
+    def stats(self):
+        return { "entries": len(self.masks), "bytes": self.bytes, "hits": self.hits, "misses": self.misses }
 
-        image = Image.open(os.path.join(self.base_path, name))
-        IconProvider.cache[name] = image
 
-        return image
+text_masks = TextMaskCache(global_settings.text_cache_bytes)
 
 
 class DrawingContext:
@@ -78,28 +107,21 @@ class DrawingContext:
 
 
     def textsize(self, text, font):
-        _, _, width, height = self.draw.textbbox((0,0), text, font)
-        return width, height
+        return text_masks.get(text, font).size
 
 
     def draw_text_centered_xy(self, xy, text, font, **params):
-        _, _, width, height = self.draw.textbbox((0,0), text, font)
-        x,  y  = math.floor(xy[0] - width/2), math.floor(xy[1] - height/2)
-        return self.draw_text_xy( (x, y), text, font, **params)
+        mask = text_masks.get(text, font)
+        x,  y  = math.floor(xy[0] - mask.width/2), math.floor(xy[1] - mask.height/2)
+        return self._draw_mask((x, y), mask, **params)
 
 
     def draw_text_xy(self, xy, text, font, **params):
-        params['fill'] = params.get( 'fill', DrawingContext.FOREGROUND )
-        x, y = self.origin[0] + xy[0], self.origin[1] + xy[1]
+        return self._draw_mask(xy, text_masks.get(text, font), **params)
 
-        _, _, width, height = self.draw.textbbox((0,0), text, font)
-        mask = Image.new("1", (width, height), color=0)
-        draw = ImageDraw.Draw(mask)
-        draw.text((0, 0), text, font=font, fill=1)
-        image = Image.new(self.img.mode, (width, height), color=params['fill'])
-        self.img.paste(image, (x,y), mask=mask)
-        #f = params['fill']
-        #print(f"xy={xy}  text={text}  fill={f}")
-
-        #self.draw.text((x, y), text, font=font, **params)
-        return width, height
+
+    def _draw_mask(self, xy, mask, **params):
+        fill = params.get( 'fill', DrawingContext.FOREGROUND )
+        x, y = self.origin[0] + xy[0], self.origin[1] + xy[1]
+        self.draw.bitmap((x, y), mask, fill=tuple(fill))
+        return mask.size
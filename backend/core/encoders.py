@@ -0,0 +1,121 @@
+"""Image encoders
+
+Rendered images are encoded once per version into several variants. A
+variant is an image format, optionally compressed with a content encoding,
+named "format" or "format.encoding", e.g. "packed.gzip". Clients get the
+smallest variant they accept. Further formats and encodings are added by
+registering them in IMAGE_ENCODERS and CONTENT_ENCODERS.
+"""
+
+from typing import Callable, Dict, Optional, Tuple, NamedTuple
+import io
+import gzip
+import zlib
+import numpy as np
+from PIL import Image
+
+from . import bitmap
+
+
+class ImageEncoder(NamedTuple):
+    media_type: str
+    encode: Callable    # (palette image, bits_per_pixel, colors) -> bytes
+    compressible: bool  # whether content encodings are applied
+
+
+def encode_png(image: Image.Image, bits_per_pixel: int, colors) -> bytes:
+    output = io.BytesIO()
+    image.save(output, format="PNG", bits=bits_per_pixel, compress_level=9)
+    return output.getvalue()
+
+
+def encode_packed(image: Image.Image, bits_per_pixel: int, colors) -> bytes:
+    return bitmap.pack_indices(bitmap.color_indices(image, colors), bits_per_pixel)
+
+
+def encode_planes(image: Image.Image, bits_per_pixel: int, colors) -> bytes:
+    return bitmap.pack_planes(bitmap.color_indices(image, colors), len(colors))
+
+
+def packbits(data: bytes) -> bytes:
+    """
+    Run length encoding as in TIFF PackBits: a header byte n is followed by
+    n+1 literal bytes for 0 <= n <= 127, or by one byte repeated 1-n times
+    for -127 <= n <= -1 (as signed byte).
+    """
+    a = np.frombuffer(data, dtype=np.uint8)
+    if len(a) == 0:
+        return b""
+    # start and length of each run of equal bytes
+    starts = np.concatenate(([0], np.flatnonzero(np.diff(a)) + 1))
+    lengths = np.diff(np.concatenate((starts, [len(a)])))
+    output = bytearray()
+    literal_start = None
+    for start, length in zip(starts.tolist(), lengths.tolist()):
+        if length < 3:
+            if literal_start is None:
+                literal_start = start
+            continue
+        if literal_start is not None:
+            _packbits_literals(output, data, literal_start, start)
+            literal_start = None
+        while length >= 3:
+            n = min(length, 128)
+            output.append(257 - n)
+            output.append(data[start])
+            start += n
+            length -= n
+        if length > 0:
+            literal_start = start
+    if literal_start is not None:
+        _packbits_literals(output, data, literal_start, len(a))
+    return bytes(output)
+
+
+def _packbits_literals(output: bytearray, data: bytes, start: int, end: int):
+    for chunk_start in range(start, end, 128):
+        chunk = data[chunk_start:min(chunk_start + 128, end)]
+        output.append(len(chunk) - 1)
+        output.extend(chunk)
+
+
+# image format -> encoder
+IMAGE_ENCODERS: Dict[str, ImageEncoder] = {
+    "png": ImageEncoder("image/png", encode_png, False),
+    "packed": ImageEncoder("application/octet-stream", encode_packed, True),    # bits_per_pixel bits per pixel, index into colors
+    "planes": ImageEncoder("application/x-epaper-planes", encode_planes, True), # one 1-bpp plane per color except colors[0]
+}
+
+# content encoding as in HTTP Content-Encoding -> compression function
+CONTENT_ENCODERS: Dict[str, Callable[[bytes], bytes]] = {
+    "gzip": lambda data: gzip.compress(data, compresslevel=9, mtime=0),
+    "deflate": lambda data: zlib.compress(data, 9),
+    "x-packbits": packbits,
+}
+
+
+def variant_name(image_format: str, content_encoding: Optional[str] = None) -> str:
+    return f"{image_format}.{content_encoding}" if content_encoding else image_format
+
+
+def parse_variant_name(variant: str) -> Tuple[str, Optional[str]]:
+    image_format, _, content_encoding = variant.partition(".")
+    return image_format, content_encoding or None
+
+
+def encode_variant(image: Image.Image, bits_per_pixel: int, colors, variant: str) -> bytes:
+    image_format, content_encoding = parse_variant_name(variant)
+    data = IMAGE_ENCODERS[image_format].encode(image, bits_per_pixel, colors)
+    return CONTENT_ENCODERS[content_encoding](data) if content_encoding else data
+
+
+def encode_variants(image: Image.Image, bits_per_pixel: int, colors, encoded: Optional[Dict[str, bytes]] = None) -> Dict[str, bytes]:
+    """Encodes the image in all formats and, where useful, all content encodings; formats already encoded are reused."""
+    variants = {}
+    for image_format, encoder in IMAGE_ENCODERS.items():
+        data = (encoded or {}).get(image_format) or encoder.encode(image, bits_per_pixel, colors)
+        variants[image_format] = data
+        if encoder.compressible:
+            for content_encoding, compress in CONTENT_ENCODERS.items():
+                variants[variant_name(image_format, content_encoding)] = compress(data)
+    return variants
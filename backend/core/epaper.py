@@ -1,29 +1,33 @@
-from pydantic import BaseModel, Field
-from typing import Tuple, Dict, List, Tuple, Union, Annotated
-from PIL import Image, ImageChops, ImagePalette
+from pydantic import BaseModel
+from typing import Any, Set, Tuple, Dict, List, Tuple, Optional, NamedTuple, Literal
+from PIL import Image, ImageChops, ImageDraw, ImagePalette
 import random
 import string
 import datetime
+import asyncio
+import time
+import json
+import math
+from collections import OrderedDict
+from concurrent.futures import Executor
 import io
 import os
 import yaml
 from loguru import logger
 from . import widgets
 from .widgets.base import BaseWidget
-from .widgets.text import TextWidgetSettings
-from .widgets.date import DateWidgetSettings
-from .widgets.weather import WeatherNowWidgetSettings, WeatherForecastWidgetSettings, WeatherPrecipitationWidgetSettings, WeatherTemperatureWidgetSettings
 from .settings import global_settings
 from .drawingcontext import DrawingContext
 from .datasources.base import BaseDatasource
-from .utils import RedisKeyValueStore
+from .utils import RedisKeyValueStore, decode_datetime, fingerprint
+from . import encoders
+from .quantizer import Quantizer
+from .profiling import NULL_TRACE, RenderTrace
+from .metrics import render_duration, render_errors, widget_draw_duration, image_responses, image_bytes
 
 
-AnyWidget = Annotated[Union[TextWidgetSettings, 
-                            DateWidgetSettings, 
-                            WeatherNowWidgetSettings, 
-                            WeatherForecastWidgetSettings, WeatherPrecipitationWidgetSettings, WeatherTemperatureWidgetSettings
-                           ], Field(discriminator="widget_class")]
+def _image_key(variant: str) -> str:
+    return "image" if variant == "png" else f"image_{variant}"
 
 
 class EpaperSettings(BaseModel):
@@ -34,10 +38,25 @@ class EpaperSettings(BaseModel):
     update_interval_s: int = 3600   # 0 = update on every request
     client_update_delay_s: int = 30
     font: Tuple[str, int] = ("Roboto-Regular.ttf", 16)
-    widgets: List[AnyWidget] = []
+    dither: Literal["none", "ordered", "floyd-steinberg"] = "none"
+    history_length: int = 4         # number of previous versions kept for delta images
+    widgets: List[Dict[str, Any]] = []     # validated by the settings class of each widget_class
     aliases: List[str] = []
 
 
+class EpaperMetadata(NamedTuple):
+    version: Optional[str]
+    last_update: Optional[datetime.datetime]
+    next_client_update: Optional[datetime.datetime]
+    variants: Dict[str, int]            # size of each encoded variant of the image
+
+
+class ImageDelta(NamedTuple):
+    version: str
+    box: Tuple[int, int, int, int]      # x, y, width, height of the changed region
+    buffers: Dict[str, bytes]           # encoded variants of the changed region
+
+
 class Epaper:
 
     def __init__(self, settings_filename: str, kv_store: RedisKeyValueStore, datasources: Dict[str, BaseDatasource], aliases: Dict[str, str]):
@@ -48,6 +67,32 @@ class Epaper:
         self.datasources = datasources
         self.aliases = aliases
         self.debug = False  # True
+        self._image_buffer_version = None   # in-process copy of the encoded images of this version
+        self._image_buffers = {}            # variant -> encoded image
+        self._metadata = None               # in-process copy of version and update times
+        self._metadata_generation = 0
+        self.metadata_cache_hits = 0
+        self.metadata_cache_misses = 0
+        self.lock = asyncio.Lock()          # serializes renders of this display
+        self.render_duration_s = None
+        self.renders = 0
+        self.renders_skipped = 0            # renders skipped because the fingerprint did not change
+        self._fingerprint = None            # fingerprint, version and quantized image of the last render
+        self._last_image_version = None
+        self._last_image = None
+        self._tiles = {}                    # widget index -> (fingerprint, image)
+        self._history = OrderedDict()       # version -> decoded image, most recent last
+        self._deltas = OrderedDict()        # (from version, to version) -> ImageDelta
+        self._delta_futures = {}            # (from version, to version) -> in-flight computation of the delta
+        self.tiles_drawn = 0
+        self.tiles_reused = 0
+        self.render_duration_metric = render_duration.labels(self.id)
+        self.render_errors_metric = render_errors.labels(self.id)
+        self.image_responses_metric = { status: image_responses.labels(self.id, status) for status in (200, 204, 304) }
+        self.image_bytes_metric = image_bytes.labels(self.id)
+        self._profile_request = None        # (cprofile, tracemalloc) for the next render, see request_profile()
+        self._trace = NULL_TRACE            # trace of the running render
+        self.last_trace = None
         self.load_settings()
 
     def load_settings(self):
@@ -58,21 +103,37 @@ class Epaper:
             logger.error(f"Error loading epaper config from {self.settings_filename}: {e}")
             return
         self.settings = EpaperSettings(**yaml_config)
+        self.image_size = Image.new("1", self.settings.size).rotate(self.settings.rotation, expand=True).size
+        self.quantizer = Quantizer(self.settings.colors, self.settings.dither)
+        self._fingerprint = None
+        self._tiles = {}
 
         # create widgets
         self.widgets = []
-        for id, widget_config in enumerate(self.settings.widgets):
-            logger.info(f"creating widget {widget_config}")
+        for id, widget_dict in enumerate(self.settings.widgets):
+            logger.info(f"creating widget {widget_dict}")
+            widget_class_name = widget_dict.get("widget_class")
+            try:
+                # the widget module is imported on first use
+                widget_class = getattr(widgets, widget_class_name, None)
+                settings_class = getattr(widgets, f"{widget_class_name}Settings", None)
+            except Exception as e:
+                logger.error(f"Error importing widget class {widget_class_name}: {e}")
+                continue
+            if widget_class is None or settings_class is None:
+                logger.error(f"Unknown widget class {widget_class_name}")
+                continue
+            widget_config = settings_class(**widget_dict)
             # inject default values if not set
             widget_config.colors = widget_config.colors if widget_config.colors else self.settings.colors
             widget_config.font = widget_config.font if widget_config.font else self.settings.font
             _datasource  = self.datasources.get(widget_config.datasource) if widget_config.datasource else None
-            widget_class = getattr(widgets, widget_config.widget_class, None)
-            if widget_class is None:
-                logger.error(f"Unknown widget class {widget_config.widget_class}")
-                continue
             widget_obj   = widget_class(id, widget_config, _datasource)
+            if _datasource is not None:
+                _datasource.require(widget_obj.get_data_parts())
             self.widgets.append(widget_obj)
+        self._widget_labels = [f"{w.id}:{w.settings.widget_class}" for w in self.widgets]
+        self._widget_draw_metrics = [widget_draw_duration.labels(self.id, label) for label in self._widget_labels]
         
         # update aliases and configuration shortcuts
         self.aliases.update({ alias: self.id for alias in self.settings.aliases })
@@ -81,6 +142,10 @@ class Epaper:
         logger.info(f"Configured epaper id={self.id} settings=({self.settings})")
 
 
+    def get_datasource_ids(self) -> Set[str]:
+        return { w.datasource.id for w in self.widgets if w.datasource is not None }
+
+
     async def get_image(self):
         image_data = await self.kv_store.get_kv_binary("image")  # encoding might be an issue here
         image = Image.open(io.BytesIO(image_data)) if image_data else None
@@ -104,39 +169,202 @@ class Epaper:
         return next_client_update_at
 
 
-    async def get_image_buffer(self):
-        image = await self.get_image()
+    async def get_metadata(self) -> EpaperMetadata:
+        """
+        Returns version and update times from the in-process cache; Redis is
+        only read after the cache has been invalidated by another process.
+        """
+        if self._metadata is not None:
+            self.metadata_cache_hits += 1
+            return self._metadata
+        self.metadata_cache_misses += 1
+        generation = self._metadata_generation
+        values = await self.kv_store.get_kv_multi(["version", "last_update", "next_client_update", "variants"])
+        metadata = EpaperMetadata(
+            values["version"].decode("utf-8") if values["version"] else None,
+            decode_datetime(values["last_update"]),
+            decode_datetime(values["next_client_update"]),
+            json.loads(values["variants"]) if values["variants"] else {})
+        if generation == self._metadata_generation:
+            self._metadata = metadata
+        return metadata
+
+
+    def invalidate_metadata(self):
+        self._metadata = None
+        self._metadata_generation += 1
+
+
+    def _image_format(self) -> str:
+        """Describes the settings which the stored encodings depend on."""
+        return f"bits={self.settings.bits_per_pixel};colors={self.settings.colors}"
+
+
+    def _encode_image(self, image: Image.Image, variant: str = "png") -> bytes:
+        return encoders.encode_variant(image, self.settings.bits_per_pixel, self.settings.colors, variant)
+
+
+    def _encode_images(self, image: Image.Image, encoded: Optional[Dict[str, bytes]] = None) -> Dict[str, bytes]:
+        return encoders.encode_variants(image, self.settings.bits_per_pixel, self.settings.colors, encoded)
+
+
+    async def get_image_buffer(self, version: Optional[str] = None, variant: str = "png") -> Tuple[Optional[str], Optional[bytes]]:
+        """
+        Returns the current version and its encoded image variant, preferably
+        the in-process copy of the given version. Otherwise, version and image
+        are read together in one round trip and cached. The bytes stored by
+        _update() are served as they are; they are decoded and encoded again
+        only if they are missing or do not match the display settings.
+        """
+        if version is not None and version == self._image_buffer_version and variant in self._image_buffers:
+            return version, self._image_buffers[variant]
+
+        # the PNG is read along to encode a missing variant of the same version
+        key = _image_key(variant)
+        values = await self.kv_store.get_kv_multi(list(dict.fromkeys(["version", "image_format", key, "image"])))
+        version = values["version"].decode("utf-8") if values["version"] else None
+        image_data = values[key]
+        stored_format = values["image_format"].decode("utf-8") if values["image_format"] else None
+        if image_data is None or stored_format != self._image_format():
+            png_data = values["image"]
+            if png_data is None:
+                return version, None
+            logger.info(f"Display {self.id}: encoding stored image with format {stored_format} to {variant} with {self._image_format()}")
+            image_data = self._encode_image(Image.open(io.BytesIO(png_data)), variant)
+        if version != self._image_buffer_version:
+            self._image_buffer_version = version
+            self._image_buffers = {}
+        self._image_buffers[variant] = image_data
+        return version, image_data
+
+
+    def _remember_image(self, version: str, image: Image.Image):
+        self._history[version] = image
+        self._history.move_to_end(version)
+        while len(self._history) > self.settings.history_length:
+            self._history.popitem(last=False)
+
+
+    async def get_history_image(self, version: str) -> Optional[Image.Image]:
+        """Returns the decoded image of the current or one of the last history_length versions."""
+        image = self._history.get(version)
         if image is None:
-            return None
-        output = io.BytesIO()
-        image.save(output, format="PNG", bits=self.settings.bits_per_pixel, compress_level=9)
-        return output.getvalue()
+            # the current version is only stored as image, previous versions as history:{version}
+            values = await self.kv_store.get_kv_multi(["version", "image", f"history:{version}"])
+            image_data = values[f"history:{version}"]
+            if image_data is None and values["version"] is not None and values["version"].decode("utf-8") == version:
+                image_data = values["image"]
+            if image_data is None:
+                return None
+            image = Image.open(io.BytesIO(image_data))
+            image.load()
+            self._remember_image(version, image)
+        return image
 
 
-    async def _create_image(self):
-        # Draw widgets
-        image = Image.new(mode="RGB", size=self.settings.size, color=0xFFFFFF)
-        ctx = DrawingContext(image, global_settings.font_path, global_settings.icon_path, self.settings.colors[0])
-        for w in self.widgets:
-            await w.draw(ctx)
+    def _create_delta(self, version: str, current_image: Image.Image, new_image: Image.Image) -> ImageDelta:
+        bbox = ImageChops.difference(current_image, new_image).getbbox()
+        if bbox is None:
+            return ImageDelta(version, (0, 0, 0, 0), {})
+        # align horizontally to bytes as required by most partial refresh implementations
+        x0 = bbox[0] // 8 * 8
+        x1 = min(math.ceil(bbox[2] / 8) * 8, new_image.width)
+        box = (x0, bbox[1], x1, bbox[3])
+        return ImageDelta(version, (x0, bbox[1], x1 - x0, bbox[3] - bbox[1]), self._encode_images(new_image.crop(box)))
+
+
+    async def get_delta(self, from_version: str, executor: Optional[Executor] = None) -> Optional[ImageDelta]:
+        """
+        Returns the region of the current image which changed since from_version,
+        None if from_version is not in the history. Concurrent requests for the
+        same delta wait for one computation in the executor.
+        """
+        version = (await self.get_metadata()).version
+        if version is None:
+            return None
+        key = (from_version, version)
+        delta = self._deltas.get(key)
+        if delta is not None:
+            return delta
+        future = self._delta_futures.get(key)
+        if future is None:
+            future = self._delta_futures[key] = asyncio.ensure_future(self._compute_delta(from_version, version, executor))
+            future.add_done_callback(lambda f: self._delta_done(key, f))
+        # shielded, a cancelled request must not cancel the computation for the others
+        return await asyncio.shield(future)
+
+
+    def _delta_done(self, key: Tuple[str, str], future):
+        del self._delta_futures[key]
+        if not future.cancelled():
+            future.exception()  # errors are raised to the callers, mark them as retrieved if all were cancelled
+
+
+    async def _compute_delta(self, from_version: str, version: str, executor: Optional[Executor]) -> Optional[ImageDelta]:
+        current_image = await self.get_history_image(from_version)
+        new_image = await self.get_history_image(version)
+        if current_image is None or new_image is None:
+            return None
+        delta = await asyncio.get_running_loop().run_in_executor(executor, self._create_delta, version, current_image, new_image)
+        self._deltas[(from_version, version)] = delta
+        while len(self._deltas) > self.settings.history_length:
+            self._deltas.popitem(last=False)
+        return delta
+
+
+    def request_profile(self, cprofile: bool = False, tracemalloc: bool = False):
+        """Traces the next render, even if its inputs did not change, optionally with cProfile and tracemalloc."""
+        self._profile_request = (cprofile, tracemalloc)
+
+
+    async def _get_widget_data(self, index: int, widget: BaseWidget):
+        # concurrent coroutines, each on its own track of the trace
+        with self._trace.span(self._widget_labels[index], "data", track=f"get_data {self._widget_labels[index]}"):
+            return await widget.get_data()
+
+
+    def _get_tile(self, index: int, widget: BaseWidget, data, widget_fingerprint: Optional[str]) -> Image.Image:
+        """Returns the off-screen image of a widget, redrawn only if its fingerprint changed."""
+        cached_fingerprint, tile = self._tiles.get(index, (None, None))
+        if widget_fingerprint is not None and widget_fingerprint == cached_fingerprint:
+            self.tiles_reused += 1
+            return tile
+        start = time.perf_counter()
+        tile = Image.new(mode="RGB", size=widget.settings.size, color=0xFFFFFF)
+        ctx = DrawingContext(tile, global_settings.font_path, global_settings.icon_path, widget.settings.colors[0])
+        with self._trace.span(self._widget_labels[index], "draw"):
+            widget.draw(ctx, data)
+        self._widget_draw_metrics[index].observe(time.perf_counter() - start)
+        self._tiles[index] = (widget_fingerprint, tile)
+        self.tiles_drawn += 1
+        return tile
+
+
+    def _create_image(self, widgets_data: List, widget_fingerprints: List[Optional[str]]):
+        with self._trace.span("create_image"):
+            with self._trace.span("compose"):
+                image = self._compose_image(widgets_data, widget_fingerprints)
+            with self._trace.span("rotate"):
+                image = image.rotate(self.settings.rotation, expand=True)
+            # Convert image to the colors of the display
+            with self._trace.span("quantize"):
+                return self.quantizer.quantize(image)
+
+
+    def _compose_image(self, widgets_data: List, widget_fingerprints: List[Optional[str]]) -> Image.Image:
+        """
+        Composes the RGB image from the widget tiles, in the unrotated layout of
+        the settings. Tiles are pasted opaquely in configuration order, a later
+        widget covers overlapping earlier ones with its background.
+        """
+        image = Image.new(mode="RGB", size=self.settings.size, color=tuple(self.settings.colors[0]))
+        draw = ImageDraw.Draw(image)
+        for index, (w, data, widget_fingerprint) in enumerate(zip(self.widgets, widgets_data, widget_fingerprints)):
+            image.paste(self._get_tile(index, w, data, widget_fingerprint), w.settings.position)
             r = (w.settings.position[0], w.settings.position[1], w.settings.position[0]+w.settings.size[0]-1, w.settings.position[1]+w.settings.size[1]-1)
             if self.debug:
-                ctx.draw.rectangle(r, outline=ctx.FOREGROUND)
-
-        # for widget in self.widgets:
-        #     # Create image
-        #     widget_image = Image.new(mode="RGB", size=widget.size, color=0xFFFFFF)
-        #     ctx = DrawingContext(widget_image)
-        #     widget.draw(ctx)
-        #     # Paste image into the main image
-        #     image.paste(widget_image, widget.position)
-
-        # Convert image with the right palette
-        pal_img = Image.new("P", (1, 1))
-        pal_img.putpalette([0, 0, 0, 255, 255, 255, 255, 0, 0, 0, 0, 0] * 64)
-
-        return image.rotate(self.settings.rotation, expand=True).quantize(palette=pal_img)
-        # return image.quantize(colors=3, palette=[0, 0, 0, 255, 255, 255, 255, 0, 0])
+                draw.rectangle(r, outline=DrawingContext.FOREGROUND)
+        return image
 
 
     def _image_is_different(self, current_image, new_image):
@@ -145,40 +373,115 @@ class Epaper:
         return ImageChops.difference(current_image, new_image).getbbox() is not None
 
 
-    async def _update(self):
+    def _get_fingerprint(self, widget_fingerprints: List[Optional[str]]) -> Optional[str]:
+        if None in widget_fingerprints:
+            return None
+        return fingerprint(self.settings.model_dump(mode="json"), widget_fingerprints)
+
+
+    def _render(self, current_image, current_buffer, widgets_data: List, widget_fingerprints: List[Optional[str]]):
+        """
+        CPU bound part of _update(), runs in a render worker thread. Returns the
+        new image and its encodings, the latter are None if nothing changed.
+        Without the current image, the PNG encodings are compared instead and
+        the new one is stored as it is.
+        """
+        with self._trace.profile(), self._trace.span("render"):
+            new_image = self._create_image(widgets_data, widget_fingerprints)
+            encoded = {}
+            with self._trace.span("compare"):
+                if current_image is not None:
+                    changed = self._image_is_different(current_image, new_image)
+                else:
+                    encoded["png"] = self._encode_image(new_image)
+                    changed = current_buffer is None or encoded["png"] != current_buffer
+            if not changed:
+                return new_image, None
+            with self._trace.span("encode"):
+                return new_image, self._encode_images(new_image, encoded)
+
+
+    async def _update(self, executor: Optional[Executor] = None):
+        async with self.lock:
+            # a requested profile applies to this render only
+            request, self._profile_request = self._profile_request, None
+            self._trace = RenderTrace(self.id, *request) if request else NULL_TRACE
+            if self._trace.enabled:
+                self._tiles = {}            # draw all widgets to see their cost
+            try:
+                with self._trace.span("update", "update"):
+                    await self._update_locked(executor)
+            finally:
+                if self._trace.enabled:
+                    self.last_trace = self._trace
+                self._trace = NULL_TRACE
+
+
+    async def _update_locked(self, executor: Optional[Executor]):
         logger.debug(f"Updating display {self.id}")
+        start = time.perf_counter()
         now = datetime.datetime.now(datetime.timezone.utc)
+        next_client_update = now + self.update_interval + self.client_update_delay
         data = {
             "last_update": now.isoformat(), 
-            "next_client_update": (now + self.update_interval + self.client_update_delay).isoformat()
+            "next_client_update": next_client_update.isoformat()
         }
 
-        current_image = await self.get_image()
-        new_image = await self._create_image()
-        is_different = self._image_is_different(current_image, new_image)
-        if is_different:
-            new_version = ''.join(random.choices(string.ascii_lowercase + string.digits, k=32))
-            output = io.BytesIO()
-            new_image.save(output, format='PNG', bits=self.settings.bits_per_pixel, compress_level=9)
-            output.seek(0, 0)
-            data.update({
-                "image": output.getvalue(), 
-                "version": new_version,
-            })
-            logger.info(f"Display {self.id} updated to version {new_version}")
+        # fetch the data of all widgets concurrently, skip rendering if no input changed
+        with self._trace.span("get_data", "data"):
+            widgets_data = await asyncio.gather(*(self._get_widget_data(index, w) for index, w in enumerate(self.widgets)))
+        widget_fingerprints = [w.get_fingerprint(data) for w, data in zip(self.widgets, widgets_data)]
+        new_fingerprint = self._get_fingerprint(widget_fingerprints)
+        current_metadata = await self.get_metadata()
+        current_version, variants = current_metadata.version, current_metadata.variants
+        if new_fingerprint is not None and new_fingerprint == self._fingerprint and current_version == self._last_image_version \
+                and not self._trace.enabled:
+            self.renders_skipped += 1
+            new_version = current_version
+            logger.info(f"Display {self.id}: inputs unchanged, still at version {new_version}")
         else:
-            current_version = await self.get_version()
-            logger.info(f"Display {self.id}: still at version {current_version}")
-        await self.kv_store.set_kv_from_dict(data)
-
-
-    async def update_if_needed(self):
-        last_update = await self.kv_store.get_kv("last_update")
-        last_update_at = datetime.datetime.fromisoformat(last_update) if last_update else None
-
-        update_needed = last_update_at is None or self.update_interval is None or self.settings.update_interval_s <= 0
-        if not update_needed:
-            now = datetime.datetime.now(datetime.timezone.utc)
-            update_needed = (now - last_update_at) >= self.update_interval
-        if update_needed:
-            await self._update()
+            # render off the event loop, compare to the last rendered image or the stored encoding
+            current_image = self._last_image if current_version == self._last_image_version else None
+            current_buffer = None
+            if current_image is None and current_version is not None:
+                current_version, current_buffer = await self.get_image_buffer(current_version)
+            new_image, image_buffers = await asyncio.get_running_loop().run_in_executor(
+                executor, self._render, current_image, current_buffer, widgets_data, widget_fingerprints)
+            self.renders += 1
+            if image_buffers is not None:
+                new_version = ''.join(random.choices(string.ascii_lowercase + string.digits, k=32))
+                # the replaced version moves to the history, read as a pair to archive what is replaced even if another process wrote it
+                previous = await self.kv_store.get_kv_multi(["version", "image"])
+                previous_version = previous["version"].decode("utf-8") if previous["version"] else None
+                if previous_version is not None and previous["image"] is not None:
+                    data[f"history:{previous_version}"] = previous["image"]
+                variants = { variant: len(buffer) for variant, buffer in image_buffers.items() }
+                data.update({ _image_key(variant): buffer for variant, buffer in image_buffers.items() })
+                data.update({
+                    "image_format": self._image_format(),
+                    "variants": json.dumps(variants),
+                    "version": new_version,
+                })
+                self._remember_image(new_version, new_image)
+                logger.info(f"Display {self.id} updated to version {new_version}")
+            else:
+                new_version = current_version
+                logger.info(f"Display {self.id}: still at version {new_version}")
+            self._fingerprint = new_fingerprint
+            self._last_image_version = new_version
+            self._last_image = new_image
+        with self._trace.span("store", "redis"):
+            await self.kv_store.set_kv_from_dict(data)
+            if "image" in data:
+                self._image_buffer_version = new_version
+                self._image_buffers = image_buffers
+                if previous_version is not None:
+                    # appended and trimmed atomically, concurrent renders of several processes neither lose nor keep a version
+                    expired = await self.kv_store.push_kv_list("history", previous_version, self.settings.history_length)
+                    await self.kv_store.delete_kv([f"history:{version.decode('utf-8')}" for version in expired])
+            self.invalidate_metadata()
+            self._metadata = EpaperMetadata(new_version, now, next_client_update, variants)
+            await self.kv_store.publish_invalidation()
+        self.render_duration_s = time.perf_counter() - start
+        self.render_duration_metric.observe(self.render_duration_s)
+        logger.info(f"Display {self.id} updated in {self.render_duration_s:.3f}s, {self.renders_skipped} of {self.renders + self.renders_skipped} renders skipped")
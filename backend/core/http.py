@@ -0,0 +1,32 @@
+"""Shared HTTP client session of all datasources
+
+One connection pool with limits per host and timeouts, created on first
+use within the event loop and closed on shutdown.
+"""
+
+from loguru import logger
+from .settings import global_settings
+
+_session = None
+
+
+def get_session():
+    global _session
+    if _session is None or _session.closed:
+        import aiohttp  # imported with the first datasource which fetches something
+        connector = aiohttp.TCPConnector(
+            limit=global_settings.http_connections,
+            limit_per_host=global_settings.http_connections_per_host,
+            ttl_dns_cache=300,
+        )
+        timeout = aiohttp.ClientTimeout(total=global_settings.http_timeout_s, connect=global_settings.http_connect_timeout_s)
+        _session = aiohttp.ClientSession(connector=connector, timeout=timeout, raise_for_status=True)
+        logger.debug(f"Created HTTP session with connector limits {global_settings.http_connections}/{global_settings.http_connections_per_host}")
+    return _session
+
+
+async def close_session():
+    global _session
+    if _session is not None and not _session.closed:
+        await _session.close()
+    _session = None
@@ -0,0 +1,170 @@
+"""Prometheus-style metrics
+
+Metric families are declared once at module level. Code on hot paths binds
+the children for its label values once, e.g. when a display is configured,
+and only calls inc() or observe() afterwards, which neither looks up
+labels nor allocates. Children are not locked; each child is updated by
+one thread at a time, the event loop or the renderer of one display.
+
+Counters kept elsewhere, like cache hits, are exposed by collectors which
+are called when the metrics are scraped.
+"""
+
+from typing import Callable, Dict, Iterable, List, Sequence, Tuple
+import bisect
+import math
+
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+def _format_value(value: float) -> str:
+    if value == math.inf:
+        return "+Inf"
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value)
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str]) -> str:
+    if not names:
+        return ""
+    escaped = (str(v).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n") for v in values)
+    return "{" + ",".join(f'{name}="{value}"' for name, value in zip(names, escaped)) + "}"
+
+
+class Counter:
+    __slots__ = ("value",)
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount: float = 1):
+        self.value += amount
+
+    def samples(self, name: str, labels: str):
+        yield f"{name}_total{labels} {_format_value(self.value)}"
+
+
+class Histogram:
+    __slots__ = ("buckets", "counts", "sum", "count")
+
+    def __init__(self, buckets: Sequence[float]):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)     # the last one counts values above all buckets
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def samples(self, name: str, labels: str):
+        cumulative = 0
+        prefix = labels[:-1] + "," if labels else "{"
+        for bound, count in zip(list(self.buckets) + [math.inf], self.counts):
+            cumulative += count
+            yield f'{name}_bucket{prefix}le="{_format_value(bound)}"}} {cumulative}'
+        yield f"{name}_sum{labels} {_format_value(self.sum)}"
+        yield f"{name}_count{labels} {self.count}"
+
+
+class MetricFamily:
+    """A named metric with label names, its children are created by labels()."""
+
+    def __init__(self, type: str, name: str, help: str, label_names: Sequence[str], factory: Callable):
+        self.type = type
+        self.name = name
+        self.help = help
+        self.label_names = tuple(label_names)
+        self.factory = factory
+        self.children: Dict[Tuple[str, ...], object] = {}
+
+    def labels(self, *values: str):
+        """Returns the child for the label values, bind it once outside of hot paths."""
+        if len(values) != len(self.label_names):
+            raise ValueError(f"Metric {self.name} expects labels {self.label_names}, got {values}")
+        key = tuple(str(v) for v in values)
+        child = self.children.get(key)
+        if child is None:
+            child = self.children[key] = self.factory()
+        return child
+
+    def remove(self, *values: str):
+        self.children.pop(tuple(str(v) for v in values), None)
+
+    def expose(self) -> Iterable[str]:
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} {self.type}"
+        for values, child in list(self.children.items()):
+            yield from child.samples(self.name, _format_labels(self.label_names, values))
+
+
+class Collector:
+    """A metric whose samples are read from a function when scraped, see Registry.collector()."""
+
+    def __init__(self, type: str, name: str, help: str, label_names: Sequence[str], collect: Callable[[], Iterable[Tuple[Sequence[str], float]]]):
+        self.type = type
+        self.name = name
+        self.help = help
+        self.label_names = tuple(label_names)
+        self.collect = collect
+
+    def expose(self) -> Iterable[str]:
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} {self.type}"
+        suffix = "_total" if self.type == "counter" else ""
+        for values, value in self.collect():
+            yield f"{self.name}{suffix}{_format_labels(self.label_names, values)} {_format_value(value)}"
+
+
+class Registry:
+
+    def __init__(self):
+        self.metrics: Dict[str, object] = {}
+
+    def _register(self, metric):
+        if metric.name in self.metrics:
+            raise ValueError(f"Metric {metric.name} is already registered")
+        self.metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, help: str, label_names: Sequence[str] = ()) -> MetricFamily:
+        return self._register(MetricFamily("counter", name, help, label_names, Counter))
+
+    def histogram(self, name: str, help: str, label_names: Sequence[str] = (), buckets: Sequence[float] = DEFAULT_BUCKETS) -> MetricFamily:
+        buckets = tuple(sorted(buckets))
+        return self._register(MetricFamily("histogram", name, help, label_names, lambda: Histogram(buckets)))
+
+    def collector(self, type: str, name: str, help: str, label_names: Sequence[str],
+                  collect: Callable[[], Iterable[Tuple[Sequence[str], float]]]) -> Collector:
+        """Registers a counter or gauge read from collect(), which yields (label values, value) pairs; replaces an earlier one."""
+        self.metrics.pop(name, None)
+        return self._register(Collector(type, name, help, label_names, collect))
+
+    def expose(self) -> str:
+        """Returns all metrics in the Prometheus text exposition format."""
+        lines: List[str] = []
+        for metric in list(self.metrics.values()):
+            lines.extend(metric.expose())
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+# rendering
+render_duration = registry.histogram("epaper_render_duration_seconds", "Duration of display updates", ["display"])
+render_errors = registry.counter("epaper_render_errors", "Failed display updates", ["display"])
+widget_draw_duration = registry.histogram("epaper_widget_draw_duration_seconds", "Duration of drawing a widget tile", ["display", "widget"])
+
+# datasources
+datasource_update_duration = registry.histogram("epaper_datasource_update_duration_seconds", "Duration of datasource updates", ["datasource"])
+datasource_update_errors = registry.counter("epaper_datasource_update_errors", "Failed datasource updates", ["datasource"])
+
+# Redis
+redis_duration = registry.histogram("epaper_redis_operation_duration_seconds", "Duration of Redis operations of the key value store", ["operation"])
+
+# serving
+image_responses = registry.counter("epaper_image_responses", "Image responses by status", ["display", "status"])
+image_bytes = registry.counter("epaper_image_bytes", "Bytes of image responses", ["display"])
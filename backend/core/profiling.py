@@ -0,0 +1,158 @@
+"""Opt-in profiling of the server startup and of single renders
+
+The startup profile is enabled by the startup_profile setting. Phases are
+timed with phase() or recorded with add() and logged as one report once
+the first render of all displays is done.
+
+A RenderTrace records the spans of one render of a display, requested
+through the API, and exports them in the Chrome trace event format for
+chrome://tracing or https://ui.perfetto.dev. Displays which are not
+profiled use NULL_TRACE, whose spans do nothing.
+"""
+
+from typing import Any, Dict, List, Optional, Tuple
+import cProfile
+import datetime
+import io
+import os
+import pstats
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+from loguru import logger
+from .settings import global_settings
+
+
+class StartupProfile:
+
+    def __init__(self, enabled: bool):
+        self.enabled = enabled
+        self.phases: List[Tuple[str, float]] = []
+
+    def add(self, name: str, duration_s: float):
+        self.phases.append((name, duration_s))
+
+    @contextmanager
+    def phase(self, name: str):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - started)
+
+    def report(self):
+        if not self.enabled:
+            return
+        total = sum(duration for _, duration in self.phases)
+        lines = [f"  {name:<32} {duration * 1000:9.1f} ms" for name, duration in self.phases]
+        logger.info("Startup profile:\n" + "\n".join(lines) + f"\n  {'total':<32} {total * 1000:9.1f} ms")
+
+
+startup_profile = StartupProfile(global_settings.startup_profile)
+
+
+class _NullSpan:
+
+    def __enter__(self):
+        return None
+
+    def __exit__(self, *args):
+        return False
+
+
+_NULL_SPAN = _NullSpan()
+
+
+class NullTrace:
+    """Trace of a render which is not profiled, its spans are shared no-op context managers."""
+    enabled = False
+
+    def span(self, name: str, category: str = "render", track: Optional[str] = None):
+        return _NULL_SPAN
+
+    def profile(self):
+        return _NULL_SPAN
+
+
+NULL_TRACE = NullTrace()
+
+
+class RenderTrace:
+    """
+    Spans of one render, timed in the thread they run in. Spans of
+    coroutines running concurrently on the event loop are put on their own
+    track to keep the spans of each track nested. With cprofile or
+    tracemalloc, profile() also profiles the enclosed code.
+    """
+    enabled = True
+
+    def __init__(self, name: str, cprofile: bool = False, tracemalloc: bool = False):
+        self.name = name
+        self.cprofile = cprofile
+        self.tracemalloc = tracemalloc
+        self.created_at = datetime.datetime.now(datetime.timezone.utc)
+        self.started = time.perf_counter()
+        self.events: List[Dict[str, Any]] = []
+        self.tracks: Dict[Any, Tuple[int, str]] = {}   # thread ident or track name -> (tid, name)
+        self.other: Dict[str, Any] = {}
+
+    def _tid(self, track: Optional[str]) -> int:
+        key = track if track is not None else threading.get_ident()
+        if key not in self.tracks:
+            self.tracks[key] = (len(self.tracks) + 1, track if track is not None else threading.current_thread().name)
+        return self.tracks[key][0]
+
+    def add(self, name: str, category: str, start: float, end: float, track: Optional[str] = None):
+        self.events.append({
+            "name": name, "cat": category, "ph": "X", "pid": os.getpid(), "tid": self._tid(track),
+            "ts": round((start - self.started) * 1e6, 1), "dur": round((end - start) * 1e6, 1),
+        })
+
+    @contextmanager
+    def span(self, name: str, category: str = "render", track: Optional[str] = None):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, category, start, time.perf_counter(), track)
+
+    @contextmanager
+    def profile(self, top: int = 40):
+        """Runs cProfile in the current thread and traces allocations of all threads, as requested."""
+        profiler = cProfile.Profile() if self.cprofile else None
+        start_tracing = self.tracemalloc and not tracemalloc.is_tracing()
+        if start_tracing:
+            tracemalloc.start()
+        if self.tracemalloc:
+            tracemalloc.reset_peak()
+            before = tracemalloc.take_snapshot()
+        if profiler:
+            profiler.enable()
+        try:
+            yield
+        finally:
+            if profiler:
+                profiler.disable()
+            # snapshot before formatting the statistics, which allocates itself
+            if self.tracemalloc:
+                self.other["tracemalloc_peak_bytes"] = tracemalloc.get_traced_memory()[1]
+                differences = tracemalloc.take_snapshot().compare_to(before, "lineno")
+                if start_tracing:
+                    tracemalloc.stop()
+                self.other["tracemalloc"] = [str(d) for d in differences[:top]]
+            if profiler:
+                out = io.StringIO()
+                pstats.Stats(profiler, stream=out).sort_stats(pstats.SortKey.CUMULATIVE).print_stats(top)
+                self.other["cprofile"] = out.getvalue()
+
+    def to_chrome_trace(self) -> Dict[str, Any]:
+        names = [
+            { "name": "thread_name", "ph": "M", "pid": os.getpid(), "tid": tid, "args": { "name": name } }
+            for tid, name in self.tracks.values()
+        ]
+        return {
+            "traceEvents": names + self.events,
+            "displayTimeUnit": "ms",
+            "otherData": dict(self.other, display=self.name, created_at=self.created_at.isoformat()),
+        }
@@ -0,0 +1,69 @@
+"""Mapping of rendered RGB images to the colors of an epaper panel
+
+The nearest color of every RGB value is looked up in a precomputed table
+covering the RGB cube with LUT_BITS bits per channel, so a frame is
+quantized in one vectorized pass instead of a distance computation per pixel.
+"""
+
+from typing import List, Tuple
+import numpy as np
+from PIL import Image
+
+
+LUT_BITS = 5
+DITHER_MODES = ("none", "ordered", "floyd-steinberg")
+
+# 4x4 Bayer matrix, normalized to thresholds in [-0.5, 0.5)
+BAYER_4X4 = (np.array([
+    [ 0,  8,  2, 10],
+    [12,  4, 14,  6],
+    [ 3, 11,  1,  9],
+    [15,  7, 13,  5],
+], dtype=np.float32) + 0.5) / 16 - 0.5
+
+
+def nearest_color_lut(colors: List[Tuple[int, int, int]], bits: int = LUT_BITS) -> np.ndarray:
+    """Returns a (2**bits)**3 table with the index of the nearest color for the center of each cell."""
+    cells = 1 << bits
+    centers = (np.arange(cells, dtype=np.int32) << (8 - bits)) + (1 << (7 - bits))
+    r, g, b = np.meshgrid(centers, centers, centers, indexing="ij")
+    cube = np.stack([r, g, b], axis=-1).reshape(-1, 1, 3)
+    distances = ((cube - np.array(colors, dtype=np.int32)[None, :, :]) ** 2).sum(axis=2)
+    return distances.argmin(axis=1).astype(np.uint8)
+
+
+class Quantizer:
+    """Converts RGB images to palette images whose palette are the given colors, in this order."""
+
+    def __init__(self, colors: List[Tuple[int, int, int]], dither: str = "none"):
+        if dither not in DITHER_MODES:
+            raise ValueError(f"Unknown dither mode {dither}, use one of {DITHER_MODES}")
+        self.colors = [tuple(c) for c in colors]
+        self.dither = dither
+        self.lut = nearest_color_lut(self.colors)
+        self.palette = [v for c in self.colors for v in c]
+        # amplitude of the ordered dither, about the distance between neighbouring colors
+        self.spread = 255 / max(1, len(self.colors) - 1)
+        self._palette_image = Image.new("P", (1, 1))
+        self._palette_image.putpalette(self.palette)
+
+    def indices(self, image: Image.Image) -> np.ndarray:
+        """Returns the index of the nearest color for each pixel of an RGB image."""
+        rgb = np.asarray(image.convert("RGB"))
+        if self.dither == "ordered":
+            h, w = rgb.shape[:2]
+            threshold = np.tile(BAYER_4X4, ((h + 3) // 4, (w + 3) // 4))[:h, :w, None]
+            rgb = np.clip(rgb + threshold * self.spread, 0, 255).astype(np.uint8)
+        shift = 8 - LUT_BITS
+        cells = (rgb[..., 0] >> shift).astype(np.intp) << (2 * LUT_BITS)
+        cells |= (rgb[..., 1] >> shift).astype(np.intp) << LUT_BITS
+        cells |= rgb[..., 2] >> shift
+        return self.lut[cells]
+
+    def quantize(self, image: Image.Image) -> Image.Image:
+        if self.dither == "floyd-steinberg":
+            # error diffusion is sequential, leave it to Pillow's C implementation
+            return image.convert("RGB").quantize(palette=self._palette_image, dither=Image.Dither.FLOYDSTEINBERG)
+        result = Image.fromarray(self.indices(image), mode="P")
+        result.putpalette(self.palette)
+        return result
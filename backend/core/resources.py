@@ -0,0 +1,101 @@
+"""Process-wide cache of fonts and icons used for drawing
+
+Icons are decoded completely and converted to the mode of the widget tiles
+when loaded, so pasting them neither reads files nor converts pixels. The
+fonts and icons referenced by the configured widgets are preloaded at startup.
+"""
+
+from typing import Dict, Iterable, Tuple
+import os
+import glob
+import threading
+from collections import OrderedDict
+from loguru import logger
+from PIL import Image, ImageFont
+from .settings import global_settings
+
+
+class ResourceManager:
+
+    def __init__(self, max_bytes: int, icon_mode: str = "RGB"):
+        self.max_bytes = max_bytes
+        self.icon_mode = icon_mode
+        self.fonts = {}                 # (path, size) -> font
+        self.font_bytes = {}            # path -> size of the font file, shared by all sizes
+        self.icons = OrderedDict()      # path -> decoded icon, least recently used first
+        self.icon_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    @property
+    def bytes(self) -> int:
+        return self.icon_bytes + sum(self.font_bytes.values())
+
+    def get_font(self, base_path: str, name: str, size: int) -> ImageFont.FreeTypeFont:
+        path = os.path.join(base_path, name)
+        with self.lock:
+            font = self.fonts.get((path, size))
+            if font is not None:
+                self.hits += 1
+                return font
+            self.misses += 1
+        font = ImageFont.truetype(path, size)
+        with self.lock:
+            font = self.fonts.setdefault((path, size), font)
+            self.font_bytes[path] = os.path.getsize(path)
+        return font
+
+    def get_icon(self, base_path: str, name: str) -> Image.Image:
+        path = os.path.join(base_path, name)
+        with self.lock:
+            icon = self.icons.get(path)
+            if icon is not None:
+                self.icons.move_to_end(path)
+                self.hits += 1
+                return icon
+            self.misses += 1
+        with Image.open(path) as image:
+            icon = image.convert(self.icon_mode)
+        with self.lock:
+            if path not in self.icons:
+                self.icons[path] = icon
+                self.icon_bytes += _image_bytes(icon)
+            # fonts are few and small, only icons are evicted
+            while self.bytes > self.max_bytes and len(self.icons) > 1:
+                _, evicted = self.icons.popitem(last=False)
+                self.icon_bytes -= _image_bytes(evicted)
+        return icon
+
+    def preload(self, font_path: str, icon_path: str, fonts: Iterable[Tuple[str, int]], icons: Iterable[str]):
+        """Loads the given fonts and icons, logging the ones which do not exist."""
+        available_fonts = { os.path.relpath(fn, font_path) for fn in glob.glob(os.path.join(font_path, "**", "*"), recursive=True) }
+        available_icons = { os.path.relpath(fn, icon_path) for fn in glob.glob(os.path.join(icon_path, "**", "*"), recursive=True) }
+        for name, size in set(fonts):
+            if name not in available_fonts:
+                logger.error(f"Font {name} not found in {font_path}")
+                continue
+            self.get_font(font_path, name, size)
+        for name in set(icons):
+            if name not in available_icons:
+                logger.error(f"Icon {name} not found in {icon_path}")
+                continue
+            self.get_icon(icon_path, name)
+        logger.info(f"Preloaded resources: {self.stats()}")
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "fonts": len(self.fonts),
+            "icons": len(self.icons),
+            "bytes": self.bytes,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+        }
+
+
+def _image_bytes(image: Image.Image) -> int:
+    return image.width * image.height * len(image.getbands())
+
+
+resources = ResourceManager(global_settings.resource_cache_bytes)
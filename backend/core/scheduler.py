@@ -0,0 +1,210 @@
+from typing import Dict, List, Set, Tuple, Optional
+from abc import ABC, abstractmethod
+import asyncio
+import datetime
+import email.utils
+import heapq
+import random
+from concurrent.futures import ThreadPoolExecutor
+from loguru import logger
+
+from .epaper import Epaper
+from .datasources.base import BaseDatasource
+
+
+class DeadlineScheduler(ABC):
+    """
+    Runs _update(id) for each id when it is due. Deadlines are kept in a
+    priority queue, the scheduler sleeps until the earliest deadline or until
+    an id is scheduled or triggered.
+    """
+
+    def __init__(self):
+        self.queue: List[Tuple[datetime.datetime, str]] = []   # heap of (due_at, id)
+        self.due_at: Dict[str, datetime.datetime] = {}          # valid queue entry per id
+        self.wakeup = asyncio.Event()
+        self.tasks: Set[asyncio.Task] = set()                   # running _update() tasks
+        self._run_task: Optional[asyncio.Task] = None
+
+    def schedule(self, id: str, due_at: datetime.datetime):
+        """(Re)schedules the id, replacing an earlier deadline."""
+        self.due_at[id] = due_at
+        heapq.heappush(self.queue, (due_at, id))
+        self.wakeup.set()
+
+    def trigger(self, id: str):
+        """Updates the id as soon as possible."""
+        self.schedule(id, datetime.datetime.now(datetime.timezone.utc))
+
+    def _pop_due(self, now: datetime.datetime) -> List[str]:
+        due = []
+        while self.queue and self.queue[0][0] <= now:
+            due_at, id = heapq.heappop(self.queue)
+            if self.due_at.get(id) == due_at:   # skip entries replaced by a later schedule()
+                del self.due_at[id]
+                due.append(id)
+        return due
+
+    async def _seed(self):
+        """Schedules the initial deadlines when run() starts, none by default."""
+
+    @abstractmethod
+    async def _update(self, id: str):
+        """Updates the id when it is due; scheduling the next deadline is up to the subclass."""
+
+    def _update_done(self, task: asyncio.Task):
+        self.tasks.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            logger.opt(exception=task.exception()).error(f"Error in {self.__class__.__name__}: {task.exception()}")
+
+    def cancel(self):
+        """Stops the run loop and cancels the running updates."""
+        if self._run_task is not None:
+            self._run_task.cancel()
+        for task in list(self.tasks):
+            task.cancel()
+
+    async def run(self):
+        self._run_task = asyncio.current_task()
+        await self._seed()
+        while True:
+            self.wakeup.clear()
+            now = datetime.datetime.now(datetime.timezone.utc)
+            for id in self._pop_due(now):
+                task = asyncio.ensure_future(self._update(id))
+                self.tasks.add(task)
+                task.add_done_callback(self._update_done)
+            timeout = (self.queue[0][0] - now).total_seconds() if self.queue else None
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+
+class RenderScheduler(DeadlineScheduler):
+    """
+    Renders each epaper when it is due, the queue is seeded from the last
+    update of each epaper.
+
+    Drawing, quantization and encoding run in a bounded pool of worker threads
+    to keep the event loop responsive, each epaper's lock ensures that a
+    display is not rendered twice at the same time.
+    """
+
+    def __init__(self, epapers: Dict[str, Epaper], max_workers: int, retry_interval_s: int):
+        super().__init__()
+        self.epapers = epapers
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="render")
+        self.retry_interval = datetime.timedelta(seconds=retry_interval_s)
+
+    def _interval(self, epaper: Epaper) -> datetime.timedelta:
+        # update_interval_s <= 0 means update as often as possible
+        return epaper.update_interval if epaper.settings.update_interval_s > 0 else self.retry_interval
+
+    async def _seed(self):
+        now = datetime.datetime.now(datetime.timezone.utc)
+        for epaper_id, epaper in self.epapers.items():
+            try:
+                last_update_at = await epaper.get_last_update()
+            except Exception as e:
+                logger.error(f"Error reading last update of epaper {epaper_id}: {e}")
+                last_update_at = None
+            self.schedule(epaper_id, last_update_at + self._interval(epaper) if last_update_at else now)
+
+    async def _update(self, epaper_id: str):
+        epaper = self.epapers[epaper_id]
+        try:
+            await epaper._update(self.executor)
+            next_due_at = datetime.datetime.now(datetime.timezone.utc) + self._interval(epaper)
+        except Exception as e:
+            epaper.render_errors_metric.inc()
+            logger.exception(f"Error updating epaper {epaper_id}: {e}", exception=e)
+            next_due_at = datetime.datetime.now(datetime.timezone.utc) + self.retry_interval
+        if epaper_id not in self.due_at:   # keep a manual trigger received while rendering
+            self.schedule(epaper_id, next_due_at)
+
+    def shutdown(self):
+        # stop scheduling renders before the executor refuses them
+        self.cancel()
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+
+def retry_after_s(e: Exception) -> Optional[float]:
+    """Returns the delay requested by the Retry-After header of an HTTP error like aiohttp's ClientResponseError."""
+    headers = getattr(e, "headers", None)
+    value = headers.get("Retry-After") if headers else None
+    if value is None:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        retry_at = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(0.0, (retry_at - datetime.datetime.now(datetime.timezone.utc)).total_seconds())
+
+
+class DatasourceScheduler(DeadlineScheduler):
+    """
+    Refreshes each datasource lead_time_s before its data exceeds max_age_s,
+    so renders find fresh data instead of waiting for the external API.
+    Datasources with max_age_s <= 0 are updated on demand only.
+
+    Failed updates are retried with exponential backoff and full jitter,
+    starting at retry_interval_s; rate limits announced by a Retry-After
+    header take precedence. Changed data is announced by the datasource,
+    see BaseDatasource.on_changed.
+    """
+
+    def __init__(self, datasources: Dict[str, BaseDatasource], lead_time_s: int, retry_interval_s: int, max_backoff_s: int):
+        super().__init__()
+        self.datasources = datasources
+        self.lead_time = datetime.timedelta(seconds=lead_time_s)
+        self.retry_interval_s = retry_interval_s
+        self.max_backoff_s = max_backoff_s
+        self.failures: Dict[str, int] = {}
+
+    def _max_age(self, datasource: BaseDatasource) -> Optional[datetime.timedelta]:
+        max_age_s = datasource.settings.max_age_s if datasource.settings else None
+        return datetime.timedelta(seconds=max_age_s) if max_age_s and max_age_s > 0 else None
+
+    def _next_refresh(self, datasource: BaseDatasource, last_update_at: Optional[datetime.datetime]) -> Optional[datetime.datetime]:
+        max_age = self._max_age(datasource)
+        if max_age is None:
+            return None
+        now = datetime.datetime.now(datetime.timezone.utc)
+        if last_update_at is None:
+            return now
+        return max(now, last_update_at + max_age - min(self.lead_time, max_age / 2))
+
+    def _backoff_s(self, failures: int) -> float:
+        return random.uniform(0, min(self.max_backoff_s, self.retry_interval_s * 2 ** (failures - 1)))
+
+    async def _seed(self):
+        for datasource_id, datasource in self.datasources.items():
+            try:
+                last_update_at = await datasource.get_last_update()
+            except Exception as e:
+                logger.error(f"Error reading last update of datasource {datasource_id}: {e}")
+                last_update_at = None
+            due_at = self._next_refresh(datasource, last_update_at)
+            if due_at is not None:
+                self.schedule(datasource_id, due_at)
+
+    async def _update(self, datasource_id: str):
+        datasource = self.datasources[datasource_id]
+        try:
+            await datasource.update_once()
+            self.failures.pop(datasource_id, None)
+            next_due_at = self._next_refresh(datasource, datasource.data_updated_at)
+        except Exception as e:
+            failures = self.failures[datasource_id] = self.failures.get(datasource_id, 0) + 1
+            delay_s = retry_after_s(e)
+            if delay_s is None:
+                delay_s = self._backoff_s(failures)
+            logger.error(f"Error refreshing datasource {datasource_id} ({failures} failures), retrying in {delay_s:.0f}s: {e}")
+            next_due_at = datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(seconds=delay_s)
+        if next_due_at is not None and datasource_id not in self.due_at:
+            self.schedule(datasource_id, next_due_at)
@@ -7,6 +7,7 @@ class Settings(BaseSettings):
     model_config = SettingsConfigDict(env_file='epaper.env')
 
     redis_url: str = "redis://redis"
+    redis_use_hash: bool = False    # store the values of each display/datasource in one Redis hash
     epaper_config_file_pattern: str = "./config/ep_*.yml"
     datasource_config_file_pattern: str = "./config/ds_*.yml"
     font_path: str = "backend/resources/fonts"
@@ -20,8 +21,20 @@ class Settings(BaseSettings):
     date_format: str = 'EEEE, dd.MM.yyyy'
 
     log_level: Literal['DEBUG', 'INFO', 'WARNING', 'ERROR', 'CRITICAL'] = 'INFO'
-    cyclic_interval_s: int = 10
+    cyclic_interval_s: int = 10     # render interval for update_interval_s <= 0 and retry interval after errors
+    render_workers: int = 2
+    datasource_refresh_lead_s: int = 60     # refresh datasources this long before max_age_s expires
+    datasource_max_backoff_s: int = 3600    # upper bound of the retry delay after failed refreshes
+    resource_cache_bytes: int = 32 * 1024 * 1024  # bound of the decoded fonts and icons
+    text_cache_bytes: int = 4 * 1024 * 1024     # bound of the rasterized text cache shared by all displays
     minimum_client_update_interval_s: int = 30
+    client_stagger_window_s: int = 0        # spread client updates over this many seconds after the display update, 0 to disable
+    client_max_arrivals_per_s: int = 0      # bound of the planned client arrivals per second within the window, 0 for no bound
+    http_timeout_s: float = 30              # total timeout of a datasource request
+    http_connect_timeout_s: float = 10
+    http_connections: int = 20              # connection pool shared by all datasources
+    http_connections_per_host: int = 4
+    startup_profile: bool = False   # log a timing report of the startup phases and first renders
 
 
 global_settings = Settings()
@@ -0,0 +1,108 @@
+"""Staggering of client updates
+
+All clients of a display would otherwise return right after its update,
+in the same second. With a stagger window, each client returns at a
+deterministic offset into the window, derived from its identity, so the
+same device keeps its phase from cycle to cycle. Devices are identified by
+an X-Device-Id header or else by their address, together with the alias
+or display id they poll, see client_identity(). The planned arrivals are
+counted per second; with a limit of arrivals per second, a client whose
+second is full is moved to the next second with capacity within the
+window. The plan is kept per process, past arrivals are forgotten.
+"""
+
+from typing import Dict, List, Optional, Tuple
+import hashlib
+import math
+import time
+from .settings import global_settings
+
+
+def client_identity(id: str, device_id: Optional[str], address: Optional[str]) -> str:
+    """Identifies a device polling the display id or alias, several devices may share one alias."""
+    return f"{id}/{device_id or address or ''}"
+
+
+class ClientStagger:
+
+    def __init__(self, window_s: int, max_arrivals_per_s: int):
+        self.window_s = window_s
+        self.max_arrivals_per_s = max_arrivals_per_s
+        self.arrivals: Dict[int, int] = {}      # UNIX second -> planned arrivals
+        self.planned: Dict[str, int] = {}       # client id -> planned UNIX second
+        self.overbooked = 0                     # clients planned into a full second, the window was full
+        self._pruned_at = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.window_s > 0
+
+    def offset_s(self, client_id: str) -> int:
+        """Returns the preferred offset of the client into the window, stable across processes and restarts."""
+        digest = hashlib.blake2b(client_id.encode("utf-8"), digest_size=8).digest()
+        return int.from_bytes(digest, "big") % self.window_s
+
+    def plan(self, client_id: str, earliest: float, now: float = None) -> int:
+        """
+        Returns the UNIX second in [earliest, earliest + window) at which the
+        client should return. Called for every poll, also those answered with
+        304; a client polling again before its planned second keeps it if it
+        is still within the window, otherwise it is planned anew.
+        """
+        now = time.time() if now is None else now
+        self._prune(now)
+        start = math.ceil(earliest)
+        planned = self.planned.get(client_id)
+        if planned is not None and start <= planned < start + self.window_s:
+            return planned
+        self._forget(client_id)
+        offset = self.offset_s(client_id)
+        second = start + offset
+        if self.max_arrivals_per_s > 0:
+            for i in range(self.window_s):
+                candidate = start + (offset + i) % self.window_s
+                if self.arrivals.get(candidate, 0) < self.max_arrivals_per_s:
+                    second = candidate
+                    break
+            else:
+                self.overbooked += 1
+        self.arrivals[second] = self.arrivals.get(second, 0) + 1
+        self.planned[client_id] = second
+        return second
+
+    def _forget(self, client_id: str):
+        # a client returning early, e.g. after a reset, replaces its planned arrival
+        second = self.planned.pop(client_id, None)
+        if second in self.arrivals:
+            self.arrivals[second] -= 1
+            if self.arrivals[second] <= 0:
+                del self.arrivals[second]
+
+    def _prune(self, now: float):
+        second = math.floor(now)
+        if second <= self._pruned_at:
+            return
+        self._pruned_at = second
+        for past in [s for s in self.arrivals if s < second]:
+            del self.arrivals[past]
+        for client_id in [c for c, planned in self.planned.items() if planned < second]:
+            del self.planned[client_id]
+
+    def forecast(self, now: float = None) -> List[Tuple[int, int]]:
+        """Returns (UNIX second, planned arrivals) of all future seconds with arrivals, in order."""
+        now = time.time() if now is None else now
+        self._prune(now)
+        return sorted(self.arrivals.items())
+
+    def stats(self, now: float = None):
+        forecast = self.forecast(now)
+        return {
+            "window_s": self.window_s,
+            "max_arrivals_per_s": self.max_arrivals_per_s,
+            "planned": sum(count for _, count in forecast),
+            "peak_per_s": max((count for _, count in forecast), default=0),
+            "overbooked": self.overbooked,
+        }
+
+
+client_stagger = ClientStagger(global_settings.client_stagger_window_s, global_settings.client_max_arrivals_per_s)
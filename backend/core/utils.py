@@ -1,21 +1,52 @@
-from typing import Optional, Dict
+from typing import Optional, Dict, List, Any, Callable
 import os
 import base64
 import json
+import asyncio
+import datetime
+import hashlib
+import time
 from loguru import logger
 import redis.asyncio as redis
 
 from fastapi import Request
+from .metrics import redis_duration
 
 
 async def get_redis(request: Request):
     return request.app.redis
 
 
+def decode_datetime(value: Optional[bytes]) -> Optional[datetime.datetime]:
+    return datetime.datetime.fromisoformat(value.decode("utf-8")) if value else None
+
+
+def fingerprint(*parts) -> str:
+    """Returns a content hash of JSON serializable parts."""
+    s = json.dumps(parts, sort_keys=True, default=str)
+    return hashlib.sha1(s.encode("utf-8")).hexdigest()
+
+
+# identifies this process as sender of invalidation messages
+PROCESS_ID = base64.urlsafe_b64encode(os.urandom(9)).decode('utf-8')
+
+_redis_get = redis_duration.labels("get")
+_redis_get_multi = redis_duration.labels("get_multi")
+_redis_set = redis_duration.labels("set")
+_redis_delete = redis_duration.labels("delete")
+_redis_publish = redis_duration.labels("publish")
+
+
 class RedisKeyValueStore:
-    def __init__(self, redis: redis.Redis, class_key: str, instance_key: Optional[str] = None):
+    """
+    Stores the values of an instance under keys "class_key:instance_key:subkey"
+    or, with use_hash, as fields of the hash "class_key:instance_key".
+    """
+
+    def __init__(self, redis: redis.Redis, class_key: str, instance_key: Optional[str] = None, use_hash: bool = False):
         self.redis = redis
         self.class_key = class_key
+        self.use_hash = use_hash
         self.instance_key = instance_key if instance_key else base64.urlsafe_b64encode(os.urandom(9)).decode('utf-8')
         self.base_key = f"{self.class_key}:{self.instance_key}"
 
@@ -23,20 +54,76 @@ class RedisKeyValueStore:
         self.instance_key = instance_key
         self.base_key = f"{self.class_key}:{self.instance_key}"
 
+    def _key(self, subkey: str):
+        return f"{self.base_key}:{subkey}"
+
     async def get_kv_binary(self, subkey: str):
-        key = f"{self.base_key}:{subkey}"
-        value = await self.redis.get(key)
-        return value
+        start = time.perf_counter()
+        try:
+            if self.use_hash:
+                return await self.redis.hget(self.base_key, subkey)
+            return await self.redis.get(self._key(subkey))
+        finally:
+            _redis_get.observe(time.perf_counter() - start)
 
     async def get_kv(self, subkey: str):
-        key = f"{self.base_key}:{subkey}"
-        value = await self.redis.get(key)
+        value = await self.get_kv_binary(subkey)
         return value.decode("utf-8") if value else None
 
-    async def set_kv_from_dict(self, subkeys_values_dict: Dict[str, str]):
-        for subkey, value in subkeys_values_dict.items():
-            key = f"{self.base_key}:{subkey}"
-            await self.redis.set(key, value)
+    async def get_kv_multi(self, subkeys: List[str]) -> Dict[str, Optional[bytes]]:
+        """Reads the binary values of several subkeys in one round trip."""
+        start = time.perf_counter()
+        try:
+            if self.use_hash:
+                values = await self.redis.hmget(self.base_key, subkeys)
+            else:
+                values = await self.redis.mget([self._key(subkey) for subkey in subkeys])
+        finally:
+            _redis_get_multi.observe(time.perf_counter() - start)
+        return dict(zip(subkeys, values))
+
+    async def set_kv_from_dict(self, subkeys_values_dict: Dict[str, Any]):
+        """Writes all values atomically in one round trip, readers never see a partial update."""
+        if not subkeys_values_dict:
+            return
+        start = time.perf_counter()
+        try:
+            if self.use_hash:
+                await self.redis.hset(self.base_key, mapping=subkeys_values_dict)
+            else:
+                await self.redis.mset({self._key(subkey): value for subkey, value in subkeys_values_dict.items()})
+        finally:
+            _redis_set.observe(time.perf_counter() - start)
+
+    async def delete_kv(self, subkeys: List[str]):
+        if not subkeys:
+            return
+        start = time.perf_counter()
+        try:
+            if self.use_hash:
+                await self.redis.hdel(self.base_key, *subkeys)
+            else:
+                await self.redis.delete(*[self._key(subkey) for subkey in subkeys])
+        finally:
+            _redis_delete.observe(time.perf_counter() - start)
+
+    async def push_kv_list(self, subkey: str, value, max_length: int) -> List[bytes]:
+        """
+        Appends the value to a list and trims it to its last max_length values
+        in one transaction, returns the values trimmed. Lists are kept in keys
+        of their own, also with use_hash.
+        """
+        key = self._key(subkey)
+        start = time.perf_counter()
+        try:
+            async with self.redis.pipeline(transaction=True) as pipe:
+                pipe.lrange(key, 0, -max(1, max_length))
+                pipe.rpush(key, value)
+                pipe.ltrim(key, -max(1, max_length), -1)
+                trimmed, _, _ = await pipe.execute()
+        finally:
+            _redis_set.observe(time.perf_counter() - start)
+        return trimmed
 
     async def get_kv_as_json(self, subkey: str):
         s = await self.get_kv(subkey)
@@ -47,6 +134,58 @@ class RedisKeyValueStore:
         s = json.dumps(data)
         await self.set_kv_from_dict({subkey: s})
 
+    def invalidation_channel(self):
+        return f"{self.class_key}:invalidate"
+
+    async def publish_invalidation(self):
+        """Tells other processes that values of this instance changed, see RedisInvalidationListener."""
+        start = time.perf_counter()
+        try:
+            await self.redis.publish(self.invalidation_channel(), f"{PROCESS_ID}:{self.instance_key}")
+        finally:
+            _redis_publish.observe(time.perf_counter() - start)
+
+
+class RedisInvalidationListener:
+    """
+    Subscribes to the invalidation channel of a class key and calls the
+    callback registered for the instance key of each message. Messages
+    published by this process are ignored. After a lost connection, all
+    callbacks are called because messages might have been missed.
+    """
+
+    def __init__(self, redis: redis.Redis, class_key: str):
+        self.redis = redis
+        self.channel = f"{class_key}:invalidate"
+        self.callbacks: Dict[str, Callable[[], None]] = {}
+
+    def register(self, instance_key: str, callback: Callable[[], None]):
+        self.callbacks[instance_key] = callback
+
+    def _invalidate_all(self):
+        for callback in self.callbacks.values():
+            callback()
+
+    async def run(self):
+        while True:
+            try:
+                async with self.redis.pubsub() as pubsub:
+                    await pubsub.subscribe(self.channel)
+                    logger.info(f"Listening for invalidations on {self.channel}")
+                    self._invalidate_all()
+                    async for message in pubsub.listen():
+                        if message["type"] != "message":
+                            continue
+                        sender, _, instance_key = message["data"].decode("utf-8").partition(":")
+                        callback = self.callbacks.get(instance_key)
+                        if sender != PROCESS_ID and callback is not None:
+                            callback()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Error listening for invalidations on {self.channel}: {e}")
+                await asyncio.sleep(1)
+
 
 # # Strongly inspired by JP's Blog: Automagically storing Python objects in Redis
 # # https://blog.jverkamp.com/2015/07/16/automagically-storing-python-objects-in-redis/
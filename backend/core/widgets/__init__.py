@@ -1,8 +1,29 @@
-from .date import DateWidget
-from .text import TextWidget
-from .weather import WeatherNowWidget
-from .weather import WeatherForecastWidget
-from .weather import WeatherTemperatureWidget
-from .exchange import ExchangeCalendarWidget
-
-__all__ = ["DateWidget", "TextWidget", "WeatherNowWidget", "WeatherForecastWidget", "WeatherTemperatureWidget", "ExchangeCalendarWidget"]
+"""Widgets by class name
+
+The widget modules are imported when a widget class or its settings class
+is first accessed, so the dependencies of widgets which are not configured
+(e.g. exchangelib or matplotlib) are never loaded.
+"""
+
+import importlib
+
+_MODULES = {
+    "DateWidget": ".date",
+    "TextWidget": ".text",
+    "WeatherNowWidget": ".weather",
+    "WeatherForecastWidget": ".weather",
+    "WeatherTemperatureWidget": ".weather",
+    "WeatherPrecipitationWidget": ".weather",
+    "ExchangeCalendarWidget": ".exchange",
+}
+
+__all__ = list(_MODULES)
+
+
+def __getattr__(name):
+    module_name = _MODULES.get(name.removesuffix("Settings"))
+    if module_name is None:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    value = getattr(importlib.import_module(module_name, __name__), name)
+    globals()[name] = value
+    return value
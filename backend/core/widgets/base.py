@@ -1,9 +1,10 @@
 from pydantic import BaseModel
-from typing import Optional, Tuple, List, Literal
+from typing import Optional, Set, Tuple, List, Literal
 from loguru import logger
 from ..settings import global_settings
 from ..datasources.base import BaseDatasource
 from ..drawingcontext import DrawingContext
+from ..utils import fingerprint
 
 
 class BaseWidgetSettings(BaseModel):
@@ -22,12 +23,33 @@ class BaseWidget:
         self.settings = settings
         self.datasource = datasource
         self.init_background = True
-    
-    async def draw(self, ctx: DrawingContext):
-        """Draws the widget using the given drawing context (which is attached to an image) using the datasource."""
+        self.settings_fingerprint = fingerprint(settings.model_dump(mode="json"))
+
+    async def get_data(self):
+        """Fetches the data to be drawn from the datasource; runs on the event loop before draw()."""
+        if self.datasource is None:
+            return None
+        return await self.datasource.get_data()
+
+    def get_fingerprint(self, data) -> Optional[str]:
+        """Returns a hash of everything the drawing depends on: the settings and the data from get_data().
+        Widgets which cannot be fingerprinted return None and are drawn every time."""
+        data_hash = self.datasource.get_data_hash(data) if self.datasource else fingerprint(data)
+        return fingerprint(self.settings_fingerprint, data_hash)
+
+    def get_data_parts(self) -> Optional[Set[str]]:
+        """Returns the parts of the datasource's data this widget uses, None if it might use everything."""
+        return None
+
+    def get_resources(self) -> Tuple[List[Tuple[str, int]], List[str]]:
+        """Returns the fonts as (name, size) and the icon names this widget draws with, for preloading."""
+        return [tuple(self.settings.font)], []
+
+    def draw(self, ctx: DrawingContext, data):
+        """Draws the widget using the given drawing context (which is attached to the widget's own image) using the data from get_data().
+        Runs in a render worker thread, so it must not touch the event loop."""
         logger.debug(f"Drawing widget type {self.settings.widget_class}::{self.id}@{self.settings.position} size {self.settings.size}")
-        ctx.origin = self.settings.position
-        p0 = self.settings.position
-        p1 = tuple(sum(x)-1 for x in zip(self.settings.position, self.settings.size))
+        p0 = ctx.origin
+        p1 = tuple(sum(x)-1 for x in zip(ctx.origin, self.settings.size))
         ctx.draw.rectangle([p0, p1], fill=tuple(self.settings.colors[0]))
         #ctx.draw.rectangle([p0, p1], outline=(255,0,0))
@@ -20,11 +20,13 @@ class DateWidget(BaseWidget):
         super().__init__(id, settings, datasource)
         self.timezone = get_timezone(global_settings.timezone)
 
-    async def draw(self, ctx: DrawingContext):
-        await super().draw(ctx)
-        font = ctx.get_font(self.settings.font[0], self.settings.font[1])
+    async def get_data(self):
         now = datetime.now(self.timezone)
-        text = format_date(now, self.settings.date_format or global_settings.date_format, locale=global_settings.locale)
+        return format_date(now, self.settings.date_format or global_settings.date_format, locale=global_settings.locale)
+
+    def draw(self, ctx: DrawingContext, text):
+        super().draw(ctx, text)
+        font = ctx.get_font(self.settings.font[0], self.settings.font[1])
         position = ( self.settings.size[0]/2, self.settings.size[1]/2 )
         ctx.draw_text_centered_xy(position, text, font=font, fill=tuple(self.settings.colors[1]))
 
@@ -22,8 +22,12 @@ class ExchangeCalendarWidget(BaseWidget):
         self.date_colors = self.config.get('datefont', self.colors)
 
 
-    async def draw(self, ctx: DrawingContext):
-        await super().draw(ctx)
+    def get_fingerprint(self, data):
+        # the calendar is read while drawing
+        return None
+
+    def draw(self, ctx: DrawingContext, data):
+        super().draw(ctx, data)
         item_font   = ctx.get_font(self.font[0], self.font[1])
         item_height = self.font[1] + 2
         date_font   = ctx.get_font(self.date_font[0], self.date_font[1])
@@ -16,12 +16,11 @@ class TextWidget(BaseWidget):
     def __init__(self, id: str, settings: TextWidgetSettings, datasource: Optional[BaseDatasource] = None):
         super().__init__(id, settings, datasource)
 
-    async def draw(self, ctx: DrawingContext):
-        await super().draw(ctx)
+    def draw(self, ctx: DrawingContext, data):
+        super().draw(ctx, data)
         font = ctx.get_font(self.settings.font[0], self.settings.font[1])
 
         if self.datasource:
-            data = await self.datasource.get_data()
             logger.debug(f"data: {data}")
             try:
                 text = self.settings.format.format(**data)
@@ -3,18 +3,19 @@
 The drawing code in this widget is heavily based on https://github.com/ugomeda/esp32-epaper-display
 """
 
-from typing import Literal, Optional
+from typing import Literal, Optional, Tuple
+from abc import ABC, abstractmethod
 import math
 import pytz
 from datetime import datetime, timedelta
 from babel.dates import format_time, get_timezone
 from loguru import logger
-import matplotlib.pyplot as plt
-import matplotlib.dates as md
 import PIL
 from ..settings import global_settings
 from ..datasources.base import BaseDatasource
+from ..datasources.weather import onecall_series
 from ..drawingcontext import DrawingContext
+from ..charts import Chart, time_ticks, value_ticks
 from .base import BaseWidget, BaseWidgetSettings
 
 
@@ -70,15 +71,20 @@ class WeatherNowWidget(BaseWidget):
         self.temperature_format = "{:.0f}°F" if global_settings.units == "imperial" else "{:.0f}°C"
         self.timezone = get_timezone(global_settings.timezone)
 
+    def get_data_parts(self):
+        return { "current" }
+
+    def get_resources(self):
+        return [fonts["main_temp"], fonts["details"]], [f"weather/{name}.png" for name in WEATHER_CODES_TO_IMAGES.values()]
+
     def _wind_to_kn(self, speed):
         if global_settings.units == "imperial":
             return speed * 0.868976
         else:
             return speed * 1.94384
 
-    async def draw(self, ctx: DrawingContext):
-        await super().draw(ctx)
-        data = await self.datasource.get_data()
+    def draw(self, ctx: DrawingContext, data):
+        super().draw(ctx, data)
         weather = data["current"]
         logger.debug(f"current weather: {weather}")
 
@@ -125,24 +131,31 @@ class WeatherForecastWidget(BaseWidget):
         self.temperature_format = "{:.0f}°F" if global_settings.units == "imperial" else "{:.0f}°C"
         self.timezone = get_timezone(global_settings.timezone)
 
-    async def draw(self, ctx: DrawingContext):
-        await super().draw(ctx)
+    def get_data_parts(self):
+        return { "hourly" }
+
+    def get_resources(self):
+        return [fonts["next"], fonts["next_bold"]], [f"weather_small/{name}.png" for name in WEATHER_CODES_TO_IMAGES.values()]
+
+    def draw(self, ctx: DrawingContext, data):
+        super().draw(ctx, data)
         # Display the weather for the rest of the day
-        data = await self.datasource.get_data()
-        items_count = math.floor(self.settings.size[0] / MIN_WIDTH)
+        hourly = onecall_series(data, "hourly")
+        # wide panels must not ask for more 3-hour steps than the forecast has
+        items_count = min(math.floor(self.settings.size[0] / MIN_WIDTH), (len(hourly["temp"]) - 1) // 3)
         for i in range(0, items_count):
             x = i * self.settings.size[0] / items_count
             w = self.settings.size[0] / items_count
 
-            weather = data["hourly"][3*(i+1)]
-            logger.debug(f"hourly weather[{i}]: {weather}")
+            index = 3*(i+1)
+            logger.debug(f"hourly weather[{i}]: {hourly['temp'][index]} {hourly['icon'][index]}")
 
             # Icon (47x47)
             ctx.draw_image_centered( (x + w / 2, SMALL_IMAGE_HEIGHT / 2),
-                f"weather_small/{WEATHER_CODES_TO_IMAGES[weather['weather'][0]['icon']]}.png" )
+                f"weather_small/{WEATHER_CODES_TO_IMAGES[hourly['icon'][index]]}.png" )
 
             # Temperature
-            temperature = self.temperature_format.format(weather["temp"])
+            temperature = self.temperature_format.format(hourly["temp"][index])
             ctx.draw_text_centered_xy(
                 (x + w / 2, SMALL_IMAGE_HEIGHT + 5),
                 temperature,
@@ -150,7 +163,7 @@ class WeatherForecastWidget(BaseWidget):
             )
 
             # Date
-            date = datetime.fromtimestamp(weather["dt"], pytz.UTC) # OWM timestamps are in UTC
+            date = datetime.fromtimestamp(hourly["dt"][index], pytz.UTC) # OWM timestamps are in UTC
             ctx.draw_text_centered_xy(
                 (x + w / 2, SMALL_IMAGE_HEIGHT + 25),
                 format_time(
@@ -161,67 +174,110 @@ class WeatherForecastWidget(BaseWidget):
 
 ##############################################################################
 
-class WeatherPrecipitationWidgetSettings(BaseWidgetSettings):
-    widget_class: Literal['WeatherPrecipitationWidget']
+class WeatherChartWidgetSettings(BaseWidgetSettings):
     datasource: str
+    chart_backend: Literal['native', 'matplotlib'] = 'native'
+    tick_font: Optional[Tuple[str, int]] = None     # defaults to the widget font in size 12
 
-class WeatherPrecipitationWidget(BaseWidget):
+class WeatherChartWidget(BaseWidget, ABC):
+    """Base class of widgets plotting a time series of the weather data."""
+    y_range = (0, 1)
+    style = "line"
 
-    def __init__(self, id: str, settings: WeatherPrecipitationWidgetSettings, datasource: Optional[BaseDatasource] = None):
+    def __init__(self, id: str, settings: WeatherChartWidgetSettings, datasource: Optional[BaseDatasource] = None):
         if datasource is None:
             raise ValueError("datasource must be set")
-        super().__init__(id, id, settings, datasource)
+        super().__init__(id, settings, datasource)
         self.timezone = get_timezone(global_settings.timezone)
-
-    async def draw(self, ctx: DrawingContext):
-        await super().draw(ctx)
-        onecall = await self.datasource.get_data()
-        precipitation = [(datetime.fromtimestamp(f['dt'], pytz.UTC).astimezone(self.timezone), f['precipitation']) for f in onecall['minutely']]
-        fig, ax = plt.subplots(nrows=1, ncols=1, figsize=(self.settings.size[0]/100.0, self.settings.size[1]/100.0), dpi=100)
-        ax.set_ylim(0,10)
-        ax.plot(*zip(*precipitation), 'k')
+        self.tick_font = tuple(settings.tick_font) if settings.tick_font else (settings.font[0], 12)
+
+    def get_resources(self):
+        return [self.tick_font], []
+
+    @abstractmethod
+    def get_series(self, onecall):
+        """Returns the UNIX timestamps and values to plot."""
+
+    def draw(self, ctx: DrawingContext, onecall):
+        super().draw(ctx, onecall)
+        xs, ys = self.get_series(onecall)
+        if len(xs) < 2:
+            return
+        if self.settings.chart_backend == 'matplotlib':
+            self._draw_matplotlib(ctx, xs, ys)
+        else:
+            self._draw_native(ctx, xs, ys)
+
+    def _draw_native(self, ctx: DrawingContext, xs, ys):
+        font = ctx.get_font(*self.tick_font)
+        color = self.settings.colors[1]
+        y_ticks = value_ticks(*self.y_range, max_ticks=4)
+        y_labels = [f"{v:g}" for v in y_ticks]
+        label_width = max(ctx.textsize(label, font)[0] for label in y_labels)
+        label_height = ctx.textsize("0:", font)[1]
+        box = (label_width + 3, label_height // 2, self.settings.size[0] - label_width - 3 - 12, self.settings.size[1] - label_height - label_height // 2 - 1)
+        chart = Chart(ctx, box, (xs[0], xs[-1]), self.y_range, color)
+        x_ticks = time_ticks(xs[0], xs[-1], max_ticks=box[2] // 50, tz=self.timezone)
+        chart.grid(x_ticks, y_ticks)
+        if self.style == "bars":
+            chart.bars(xs, ys, bar_width=xs[1] - xs[0], baseline=self.y_range[0])
+        elif self.style == "area":
+            chart.area(xs, ys, baseline=self.y_range[0])
+        else:
+            chart.line(xs, ys, width=2)
+        chart.frame()
+        chart.x_labels(x_ticks, [datetime.fromtimestamp(t, self.timezone).strftime("%H:%M") for t in x_ticks], font)
+        chart.y_labels(y_ticks, y_labels, font)
+
+    def _draw_matplotlib(self, ctx: DrawingContext, xs, ys):
+        # matplotlib is optional and slow to import, so it is only loaded if configured
+        from matplotlib.figure import Figure
+        from matplotlib.backends.backend_agg import FigureCanvasAgg
+        import matplotlib.dates as md
+        times = [datetime.fromtimestamp(x, self.timezone) for x in xs]
+        fig = Figure(figsize=(self.settings.size[0]/100.0, self.settings.size[1]/100.0), dpi=100)
+        canvas = FigureCanvasAgg(fig)
+        ax = fig.subplots(nrows=1, ncols=1)
+        ax.set_ylim(*self.y_range)
+        ax.plot(times, ys, 'k')
         ax.grid()
         ax.tick_params(direction='in')
-        xfmt = md.DateFormatter('%H:%M')
+        xfmt = md.DateFormatter('%H:%M', tz=self.timezone)
         ax.xaxis.set_major_formatter(xfmt)
         ax.set_xticks(ax.get_xticks()[::2])
         fig.tight_layout()
         fig.subplots_adjust(bottom=0.24)
-        fig.canvas.draw()
-        img = PIL.Image.frombytes('RGB', fig.canvas.get_width_height(),fig.canvas.tostring_rgb())
-        ctx.img.paste(img, self.position)
-        plt.close()
+        canvas.draw()
+        img = PIL.Image.frombuffer('RGBA', canvas.get_width_height(), canvas.buffer_rgba()).convert('RGB')
+        ctx.img.paste(img, ctx.origin)
+
+##############################################################################
+
+class WeatherPrecipitationWidgetSettings(WeatherChartWidgetSettings):
+    widget_class: Literal['WeatherPrecipitationWidget']
+
+class WeatherPrecipitationWidget(WeatherChartWidget):
+    y_range = (0, 10)
+    style = "bars"
+
+    def get_data_parts(self):
+        return { "minutely" }
+
+    def get_series(self, onecall):
+        minutely = onecall_series(onecall, 'minutely') or { 'dt': [], 'precipitation': [] }
+        return minutely['dt'], minutely['precipitation']
 
 ##############################################################################
 
-class WeatherTemperatureWidgetSettings(BaseWidgetSettings):
+class WeatherTemperatureWidgetSettings(WeatherChartWidgetSettings):
     widget_class: Literal['WeatherTemperatureWidget']
-    datasource: str
 
-class WeatherTemperatureWidget(BaseWidget):
-    def __init__(self, id: str, settings: WeatherTemperatureWidgetSettings, datasource: Optional[BaseDatasource] = None):
-        if datasource is None:
-            raise ValueError("datasource must be set")
-        super().__init__(id, settings, datasource)
-        self.timezone = get_timezone(global_settings.timezone)
+class WeatherTemperatureWidget(WeatherChartWidget):
+    y_range = (-10, 40)
 
-    async def draw(self, ctx: DrawingContext):
-        await super().draw(ctx)
-        onecall = await self.datasource.get_data()
-        temp = [(datetime.fromtimestamp(f['dt'], pytz.UTC).astimezone(self.timezone), f['temp']) for f in onecall['hourly']]
-        pressure = [(datetime.fromtimestamp(f['dt'], pytz.UTC).astimezone(self.timezone), f['pressure']) for f in onecall['hourly']]
-        humidity = [(datetime.fromtimestamp(f['dt'], pytz.UTC).astimezone(self.timezone), f['humidity']) for f in onecall['hourly']]
-        fig, ax = plt.subplots(nrows=1, ncols=1, figsize=(self.settings.size[0]/100.0, self.settings.size[1]/100.0), dpi=100)
-        ax.set_ylim(-10,40)
-        ax.plot(*zip(*temp), 'k')
-        ax.grid()
-        ax.tick_params(direction='in')
-        xfmt = md.DateFormatter('%H:%M')
-        ax.xaxis.set_major_formatter(xfmt)
-        ax.set_xticks(ax.get_xticks()[::2])
-        fig.tight_layout()
-        fig.subplots_adjust(bottom=0.24)
-        fig.canvas.draw()
-        img = PIL.Image.frombytes('RGB', fig.canvas.get_width_height(),fig.canvas.tostring_rgb())
-        ctx.img.paste(img, self.settings.position)
-        plt.close()
+    def get_data_parts(self):
+        return { "hourly" }
+
+    def get_series(self, onecall):
+        hourly = onecall_series(onecall, 'hourly')
+        return hourly['dt'], hourly['temp']
@@ -1,3 +1,6 @@
+import time
+_import_started = time.perf_counter()
+
 from fastapi import FastAPI, Request, Depends
 import asyncio
 import redis.asyncio as redis
@@ -10,11 +13,18 @@ from loguru import logger
 
 from typing import Dict, Any
 from .core.epaper import Epaper
+from .core.scheduler import RenderScheduler, DatasourceScheduler
+from .core.resources import resources
+from .core.profiling import startup_profile
+from .core.metrics import registry
+from .core.stagger import client_stagger
+from .core.drawingcontext import text_masks
+from .core import http
 from .core.settings import global_settings
 from .core import datasources
 from .core.datasources.base import BaseDatasource
 from .routers import router
-from .core.utils import RedisKeyValueStore
+from .core.utils import RedisKeyValueStore, RedisInvalidationListener
 
 ##############################################################################
 
@@ -87,12 +97,16 @@ def init_logging(log_level):
 class Context:
     count = 0
 
-    def __init__(self, global_settings, redis, datasources, aliases, epapers):
+    def __init__(self, global_settings, redis, datasources, aliases, epapers, epaper_listener, render_scheduler, datasource_scheduler, tasks):
         self.global_settings = global_settings
         self.redis = redis
         self.datasources = datasources
         self.aliases = aliases
         self.epapers = epapers
+        self.epaper_listener = epaper_listener
+        self.render_scheduler = render_scheduler
+        self.datasource_scheduler = datasource_scheduler
+        self.tasks = tasks      # background tasks, cancelled on shutdown
 
 ##############################################################################
 
@@ -114,7 +128,7 @@ def create_datasources(glob_pattern: str, redis) -> Dict[str, BaseDatasource]:
             logger.error(f"Unknown datasource class {ds_class_name}")
             continue
 
-        kv_store = RedisKeyValueStore(redis, ds_class_name)
+        kv_store = RedisKeyValueStore(redis, ds_class_name, use_hash=global_settings.redis_use_hash)
         ds_instance = ds_class(fn, kv_store)
         ds[ds_instance.id] = ds_instance
     return ds
@@ -132,22 +146,72 @@ def create_epapers(glob_pattern: str, redis, datasources, aliases) -> Dict[str,
             logger.error(f"Error loading epaper config from {fn}: {e}")
             continue
 
-        kv_store = RedisKeyValueStore(redis, 'Epaper')
+        kv_store = RedisKeyValueStore(redis, 'Epaper', use_hash=global_settings.redis_use_hash)
         epaper_instance = Epaper(fn, kv_store, datasources, aliases)
         eps[epaper_instance.id] = epaper_instance
     return eps
 
 
-async def cyclic_func():
-    while True:
-        if app is not None and hasattr(app, 'context') and app.context:
-            #logger.info(f"cyclic_func executing for: {app.context.epapers.keys()}")
-            for epaper_id in app.context.epapers:
-                try:
-                    await app.context.epapers[epaper_id].update_if_needed()
-                except Exception as e:
-                    logger.exception(f"Error updating epaper {epaper_id}: {e}", exception=e)
-        await asyncio.sleep(global_settings.cyclic_interval_s)
+def preload_resources(epapers: Dict[str, Epaper]):
+    fonts, icons = [], []
+    for epaper in epapers.values():
+        for widget in epaper.widgets:
+            widget_fonts, widget_icons = widget.get_resources()
+            fonts.extend(widget_fonts)
+            icons.extend(widget_icons)
+    resources.preload(global_settings.font_path, global_settings.icon_path, fonts, icons)
+
+def register_metrics(epapers: Dict[str, Epaper], datasources: Dict[str, BaseDatasource]):
+    """Exposes the counters kept by displays, datasources and caches, read when the metrics are scraped."""
+    def renders():
+        for epaper_id, epaper in epapers.items():
+            yield (epaper_id, "rendered"), epaper.renders
+            yield (epaper_id, "skipped"), epaper.renders_skipped
+
+    def tiles():
+        for epaper_id, epaper in epapers.items():
+            yield (epaper_id, "drawn"), epaper.tiles_drawn
+            yield (epaper_id, "reused"), epaper.tiles_reused
+
+    def cache_requests():
+        for epaper_id, epaper in epapers.items():
+            yield ("metadata", epaper_id, "hit"), epaper.metadata_cache_hits
+            yield ("metadata", epaper_id, "miss"), epaper.metadata_cache_misses
+        for datasource_id, datasource in datasources.items():
+            yield ("data", datasource_id, "hit"), datasource.data_cache_hits
+            yield ("data", datasource_id, "miss"), datasource.data_cache_misses
+        for cache, name in ((text_masks, "text"), (resources, "resources")):
+            yield (name, "", "hit"), cache.hits
+            yield (name, "", "miss"), cache.misses
+
+    def cache_bytes():
+        yield ("text",), text_masks.bytes
+        yield ("resources",), resources.bytes
+
+    def client_arrivals():
+        stats = client_stagger.stats()
+        yield ("planned",), stats["planned"]
+        yield ("peak_per_s",), stats["peak_per_s"]
+
+    def overbooked():
+        yield (), client_stagger.overbooked
+
+    registry.collector("counter", "epaper_renders", "Display updates by result", ["display", "result"], renders)
+    registry.collector("counter", "epaper_tiles", "Widget tiles by result", ["display", "result"], tiles)
+    registry.collector("counter", "epaper_cache_requests", "Cache lookups by result", ["cache", "instance", "result"], cache_requests)
+    registry.collector("gauge", "epaper_cache_bytes", "Memory used by caches", ["cache"], cache_bytes)
+    registry.collector("gauge", "epaper_client_arrivals", "Planned client arrivals in total and in the busiest second", ["scope"], client_arrivals)
+    registry.collector("counter", "epaper_client_arrivals_overbooked", "Clients planned into a full second", [], overbooked)
+
+async def profile_first_render(epapers: Dict[str, Epaper], render_scheduler: RenderScheduler):
+    """Renders all epapers once, timed for the startup profile."""
+    for epaper_id, epaper in epapers.items():
+        try:
+            with startup_profile.phase(f"first render {epaper_id}"):
+                await epaper._update(render_scheduler.executor)
+        except Exception as e:
+            logger.error(f"Error rendering epaper {epaper_id} for the startup profile: {e}")
+    startup_profile.report()
 
 ##############################################################################
 
@@ -161,13 +225,59 @@ app = FastAPI(
     # root_path=base_url
     )
 app.include_router(router)
-asyncio.ensure_future(cyclic_func())
+startup_profile.add("imports", time.perf_counter() - _import_started)
 
 @app.on_event('startup')
 async def startup_event():
     logger.info("Starting up")
-    _redis = await redis.from_url(global_settings.redis_url) # encoding='utf-8' decode_responses=True
-    _datasources = create_datasources(global_settings.datasource_config_file_pattern, _redis)
+    with startup_profile.phase("redis connect"):
+        _redis = await redis.from_url(global_settings.redis_url) # encoding='utf-8' decode_responses=True
+        if startup_profile.enabled:
+            await _redis.ping()    # from_url connects lazily
+    with startup_profile.phase("datasource configs"):
+        _datasources = create_datasources(global_settings.datasource_config_file_pattern, _redis)
     _aliases = {}
-    _epapers = create_epapers(global_settings.epaper_config_file_pattern, _redis, _datasources, _aliases)
-    app.context = Context(global_settings, _redis, _datasources, _aliases, _epapers)
+    with startup_profile.phase("epaper configs and widget imports"):
+        _epapers = create_epapers(global_settings.epaper_config_file_pattern, _redis, _datasources, _aliases)
+    with startup_profile.phase("preload fonts and icons"):
+        preload_resources(_epapers)
+    register_metrics(_epapers, _datasources)
+    _epaper_listener = RedisInvalidationListener(_redis, 'Epaper')
+    for epaper in _epapers.values():
+        _epaper_listener.register(epaper.id, epaper.invalidate_metadata)
+    _tasks = [asyncio.ensure_future(_epaper_listener.run())]
+    _render_scheduler = RenderScheduler(_epapers, global_settings.render_workers, global_settings.cyclic_interval_s)
+    if startup_profile.enabled:
+        _tasks.append(asyncio.ensure_future(profile_first_render(_epapers, _render_scheduler)))
+    _tasks.append(asyncio.ensure_future(_render_scheduler.run()))
+
+    def on_datasource_changed(datasource_id: str):
+        # re-render only the displays drawing data of this datasource
+        for epaper in _epapers.values():
+            if datasource_id in epaper.get_datasource_ids():
+                _render_scheduler.trigger(epaper.id)
+    for datasource in _datasources.values():
+        datasource.on_changed = on_datasource_changed
+    _datasource_scheduler = DatasourceScheduler(_datasources,
+        global_settings.datasource_refresh_lead_s, global_settings.cyclic_interval_s, global_settings.datasource_max_backoff_s)
+    _tasks.append(asyncio.ensure_future(_datasource_scheduler.run()))
+    app.context = Context(global_settings, _redis, _datasources, _aliases, _epapers, _epaper_listener, _render_scheduler, _datasource_scheduler, _tasks)
+
+
+@app.on_event('shutdown')
+async def shutdown_event():
+    logger.info("Shutting down")
+    context = app.context
+    # stop everything which might still render or fetch before the executor and the HTTP session go away
+    schedulers = [context.render_scheduler, context.datasource_scheduler]
+    for scheduler in schedulers:
+        scheduler.cancel()
+    for task in context.tasks:
+        task.cancel()
+    datasource_tasks = [task for datasource in context.datasources.values() for task in datasource.tasks]
+    for datasource in context.datasources.values():
+        datasource.cancel()
+    await asyncio.gather(*context.tasks, *(task for scheduler in schedulers for task in scheduler.tasks), *datasource_tasks,
+        return_exceptions=True)
+    context.render_scheduler.shutdown()
+    await http.close_session()
@@ -1,4 +1,4 @@
-from typing import Optional
+from typing import Optional, Dict
 import datetime
 import json
 from loguru import logger
@@ -6,10 +6,15 @@ import os
 
 from ..core.settings import global_settings
 from ..core.epaper import Epaper
+from ..core.drawingcontext import text_masks
+from ..core.resources import resources
+from ..core.metrics import registry
+from ..core.stagger import client_stagger, client_identity
+from ..core.encoders import IMAGE_ENCODERS, variant_name, parse_variant_name
 
 import uvicorn
-from fastapi import APIRouter, Request, Response, status, Header, HTTPException, Path
-from fastapi.responses import FileResponse
+from fastapi import APIRouter, Request, Response, status, Header, HTTPException, Path, Query
+from fastapi.responses import FileResponse, PlainTextResponse, JSONResponse
 
 router = APIRouter()
 
@@ -60,10 +65,22 @@ async def get_display(
         raise HTTPException(status_code=404, detail="Display/alias not found")
 
     display_kv = display.settings.model_dump(exclude=["widgets", "font"])
+    metadata = await display.get_metadata()
+    display_kv.update(metadata._asdict())
     display_kv.update({
-        "version": await display.get_version(),
-        "last_update": await display.get_last_update(),
-        "next_client_update": await display.get_next_client_update_at()
+        "render_duration_s": display.render_duration_s,
+        "render_stats": {
+            "rendered": display.renders,
+            "skipped": display.renders_skipped,
+            "tiles_drawn": display.tiles_drawn,
+            "tiles_reused": display.tiles_reused
+        },
+        "metadata_cache": {
+            "hits": display.metadata_cache_hits,
+            "misses": display.metadata_cache_misses
+        },
+        "text_cache": text_masks.stats(),
+        "resources": resources.stats()
     })
     display_kv.update({
         "links": {
@@ -73,38 +90,292 @@ async def get_display(
     return display_kv
 
 
+async def get_image_headers(request: Request, display: Epaper, client_id: str):
+    """
+    Returns the ETag and Cache-Control header fields from the in-process
+    metadata cache. With client staggering, max-age is extended by the
+    offset of the client, see client_identity().
+    """
+    metadata = await display.get_metadata()
+    etag = metadata.version
+    next_client_update = metadata.next_client_update
+    minimum_s = request.app.context.global_settings.minimum_client_update_interval_s
+    now = datetime.datetime.now(datetime.timezone.utc)
+    if client_stagger.enabled:
+        earliest = now.timestamp() + minimum_s
+        if next_client_update:
+            earliest = max(earliest, next_client_update.timestamp())
+        max_age = max(minimum_s, round(client_stagger.plan(client_id, earliest, now.timestamp()) - now.timestamp()))
+    elif next_client_update:
+        seconds_till_update = (next_client_update - now).total_seconds()
+        max_age = max(minimum_s, round(seconds_till_update))
+    else:
+        max_age = minimum_s
+    return {
+        "ETag": etag, 
+        "Cache-Control": f"max-age={max_age}"
+        # "Content-Disposition": f'inline; filename="{etag}.png"'
+    }
+
+
+def _header_tokens(header: Optional[str]):
+    """Yields the media types or codings of an Accept* header which are not excluded by q=0."""
+    for item in (header or "").split(","):
+        token, *params = [part.strip() for part in item.split(";")]
+        q = [param.split("=", 1)[1] for param in params if param.replace(" ", "").startswith("q=")]
+        try:
+            excluded = bool(q) and float(q[0]) == 0
+        except ValueError:
+            excluded = False
+        if token and not excluded:
+            yield token
+
+
+def negotiate_variant(variants: Dict[str, int], image_format: Optional[str], accept: Optional[str], accept_encoding: Optional[str]) -> str:
+    """
+    Selects the smallest image variant in a format and content encoding the
+    client accepts. The format query parameter overrides Accept; without a
+    matching media type in Accept, PNG is served.
+    """
+    if image_format is not None:
+        if image_format not in IMAGE_ENCODERS:
+            raise HTTPException(status_code=400, detail=f"Unknown image format, use one of {list(IMAGE_ENCODERS)}")
+        image_formats = [image_format]
+    else:
+        media_types = set(_header_tokens(accept))
+        image_formats = [f for f, encoder in IMAGE_ENCODERS.items() if encoder.media_type in media_types] or ["png"]
+    content_encodings = {None} | set(_header_tokens(accept_encoding))
+    candidates = [
+        variant for variant in variants
+        if parse_variant_name(variant)[0] in image_formats and parse_variant_name(variant)[1] in content_encodings
+    ]
+    return min(candidates, key=variants.get) if candidates else variant_name(image_formats[0])
+
+
+def raise_image_unavailable(request: Request):
+    """The display was not rendered yet or its image is missing in Redis, the client should try again later."""
+    retry_after_s = request.app.context.global_settings.minimum_client_update_interval_s
+    raise HTTPException(status_code=503, detail="Image not rendered yet", headers={ "Retry-After": str(retry_after_s) })
+
+
+def get_variant_headers(display: Epaper, variant: str, size):
+    image_format, content_encoding = parse_variant_name(variant)
+    headers = { "Vary": "Accept, Accept-Encoding" }
+    if content_encoding:
+        headers["Content-Encoding"] = content_encoding
+    if image_format != "png":
+        headers.update({
+            "X-Image-Size": f"{size[0]}x{size[1]}",
+            "X-Bits-Per-Pixel": str(display.settings.bits_per_pixel if image_format == "packed" else 1),
+            "X-Planes": str(1 if image_format == "packed" else len(display.settings.colors) - 1),
+        })
+    return headers
+
+
 @router.get(
     "/displays/{id}/image",
     summary="Get the current image for a display",
-    response_description="PNG image formatted and optimized for the display"
+    response_description="PNG image or raw bitmap formatted and optimized for the display"
 )
-async def get_display_image(request: Request, id: str, response: Response, if_none_match: Optional[str] = Header(None)):
+async def get_display_image(
+    request: Request, id: str, response: Response,
+    if_none_match: Optional[str] = Header(None),
+    x_device_id: Optional[str] = Header(None),
+    accept: Optional[str] = Header(None),
+    accept_encoding: Optional[str] = Header(None),
+    image_format: Optional[str] = Query(None, alias="format", description="png, packed or planes; overrides Accept")
+):
+    """
+    Returns the current image as PNG or as raw bitmap in the native layout of
+    the panel: "packed" with bits_per_pixel bits per pixel, each an index
+    into the display colors; "planes" with one 1-bpp plane per color except
+    the background, bits are 0 where the pixel has the plane's color. Rows
+    are padded to full bytes, the leftmost pixel is in the most significant
+    bits.
+
+    Raw bitmaps are available with the content encodings gzip, deflate and
+    x-packbits (TIFF PackBits run length encoding). All variants are encoded
+    when rendering, the smallest one accepted by the client is returned.
+    """
     # determine rendering with optional alias lookup
     logger.info(f"GET /api/displays/{id}/image with If-None-Match={if_none_match}")
     display = get_display_by_id(request.app.context, id)
     if display is None:
         raise HTTPException(status_code=404, detail="Display/alias not found")
 
-    # collect new response header fields
-    etag = await display.get_version()
-    next_client_update = await display.get_next_client_update_at()
-    if next_client_update:
-        now = datetime.datetime.now(datetime.timezone.utc)
-        seconds_till_update = (next_client_update - now).total_seconds()
-        max_age = max(request.app.context.global_settings.minimum_client_update_interval_s, round(seconds_till_update))
-    else:
-        max_age = request.app.context.global_settings.minimum_client_update_interval_s
-    headers = {
-        "ETag": etag, 
-        "Cache-Control": f"max-age={max_age}"
-        # "Content-Disposition": f'inline; filename="{etag}.png"'
-    }
-
     # Return 304 if content did not change
-    if if_none_match != None and if_none_match == etag:
+    client_id = client_identity(id, x_device_id, request.client.host if request.client else None)
+    headers = await get_image_headers(request, display, client_id)
+    if if_none_match != None and if_none_match == headers["ETag"]:
+        display.image_responses_metric[304].inc()
+        return Response("", status.HTTP_304_NOT_MODIFIED, headers=headers)
+
+    # return the stored image as it is, its version might be newer than the cached one
+    variant = negotiate_variant((await display.get_metadata()).variants, image_format, accept, accept_encoding)
+    headers["ETag"], image_buffer = await display.get_image_buffer(headers["ETag"], variant)
+    if image_buffer is None:
+        raise_image_unavailable(request)
+    headers.update(get_variant_headers(display, variant, display.image_size))
+    media_type = IMAGE_ENCODERS[parse_variant_name(variant)[0]].media_type
+    display.image_responses_metric[200].inc()
+    display.image_bytes_metric.inc(len(image_buffer))
+    return Response(content=image_buffer, media_type=media_type, headers=headers)
+
+
+@router.get(
+    "/displays/{id}/image/delta",
+    summary="Get the region of the current image which changed since the client's version",
+    response_description="PNG image or raw bitmap of the changed region, its position in the X-Delta-Box header"
+)
+async def get_display_image_delta(
+    request: Request, id: str,
+    if_none_match: Optional[str] = Header(None),
+    x_device_id: Optional[str] = Header(None),
+    accept: Optional[str] = Header(None),
+    accept_encoding: Optional[str] = Header(None),
+    image_format: Optional[str] = Query(None, alias="format", description="png, packed or planes; overrides Accept")
+):
+    """
+    Supports the partial refresh of epaper panels. Relative to the version in
+    the If-None-Match header, only the changed rectangle is returned. The
+    X-Delta-Box header contains its position and size as "x,y,width,height";
+    x and width are multiples of 8. If the client's version is unknown, the
+    full image is returned with a box covering the whole panel. If the
+    versions differ but their images do not, 204 No Content with the new
+    ETag and an empty box is returned. Image formats and content encodings
+    are negotiated as for the full image.
+    """
+    logger.info(f"GET /api/displays/{id}/image/delta with If-None-Match={if_none_match}")
+    display = get_display_by_id(request.app.context, id)
+    if display is None:
+        raise HTTPException(status_code=404, detail="Display/alias not found")
+
+    client_id = client_identity(id, x_device_id, request.client.host if request.client else None)
+    headers = await get_image_headers(request, display, client_id)
+    if if_none_match != None and if_none_match == headers["ETag"]:
+        display.image_responses_metric[304].inc()
         return Response("", status.HTTP_304_NOT_MODIFIED, headers=headers)
 
-    # return response
-    image_buffer = await display.get_image_buffer()
-    return Response(content=image_buffer, media_type="image/png", headers=headers)
+    delta = await display.get_delta(if_none_match, request.app.context.render_scheduler.executor) if if_none_match else None
+    if delta is None:
+        variant = negotiate_variant((await display.get_metadata()).variants, image_format, accept, accept_encoding)
+        headers["ETag"], image_buffer = await display.get_image_buffer(headers["ETag"], variant)
+        if image_buffer is None:
+            raise_image_unavailable(request)
+        box = (0, 0, *display.image_size)
+    elif delta.box[2] == 0:
+        headers.update({ "ETag": delta.version, "X-Delta-Box": "0,0,0,0" })
+        display.image_responses_metric[204].inc()
+        return Response(status_code=status.HTTP_204_NO_CONTENT, headers=headers)
+    else:
+        variant = negotiate_variant({ v: len(b) for v, b in delta.buffers.items() }, image_format, accept, accept_encoding)
+        headers["ETag"], image_buffer = delta.version, delta.buffers[variant]
+        box = delta.box
+    headers["X-Delta-Box"] = ",".join(str(v) for v in box)
+    headers.update(get_variant_headers(display, variant, box[2:]))
+    media_type = IMAGE_ENCODERS[parse_variant_name(variant)[0]].media_type
+    display.image_responses_metric[200].inc()
+    display.image_bytes_metric.inc(len(image_buffer))
+    return Response(content=image_buffer, media_type=media_type, headers=headers)
+
+
+@router.post(
+    "/displays/{id}/render",
+    summary="Render the image for a display now",
+    status_code=status.HTTP_202_ACCEPTED,
+    response_description="JSON dictionary confirming the display id scheduled for rendering"
+)
+async def render_display(
+    request: Request,
+    id: str = Path(..., title="Display_id or alias")
+):
+    """
+    Schedules an immediate render of the display regardless of its update
+    interval. The next regular render is scheduled relative to this one.
+    """
+    display = get_display_by_id(request.app.context, id)
+    if display is None:
+        raise HTTPException(status_code=404, detail="Display/alias not found")
+    request.app.context.render_scheduler.trigger(display.id)
+    return { "scheduled": display.id }
+
+
+@router.post(
+    "/displays/{id}/profile",
+    summary="Profile the next render of a display",
+    status_code=status.HTTP_202_ACCEPTED,
+    response_description="JSON dictionary confirming the display id scheduled for a profiled render"
+)
+async def profile_display(
+    request: Request,
+    id: str = Path(..., title="Display_id or alias"),
+    cprofile: bool = Query(False, description="Run cProfile in the render thread"),
+    tracemalloc: bool = Query(False, description="Trace memory allocations while rendering")
+):
+    """
+    Renders the display now, with all widgets redrawn even if their data did
+    not change, and records the duration of data retrieval, each widget's
+    draw, quantization, encoding and storage. The trace is available from
+    GET /api/displays/{id}/profile once the render is done.
+    """
+    display = get_display_by_id(request.app.context, id)
+    if display is None:
+        raise HTTPException(status_code=404, detail="Display/alias not found")
+    display.request_profile(cprofile, tracemalloc)
+    request.app.context.render_scheduler.trigger(display.id)
+    return { "scheduled": display.id, "cprofile": cprofile, "tracemalloc": tracemalloc }
+
 
+@router.get(
+    "/displays/{id}/profile",
+    summary="Get the trace of the last profiled render of a display",
+    response_description="Trace in the Chrome trace event format, for chrome://tracing or https://ui.perfetto.dev"
+)
+async def get_display_profile(
+    request: Request,
+    id: str = Path(..., title="Display_id or alias")
+):
+    """
+    Returns the spans of the last profiled render as Chrome trace JSON. The
+    cProfile statistics and the largest allocations are in otherData.
+    """
+    display = get_display_by_id(request.app.context, id)
+    if display is None:
+        raise HTTPException(status_code=404, detail="Display/alias not found")
+    if display.last_trace is None:
+        raise HTTPException(status_code=404, detail="No profiled render yet, request one with POST")
+    filename = f"{display.id}-{display.last_trace.created_at.strftime('%Y%m%dT%H%M%S')}.json"
+    return JSONResponse(display.last_trace.to_chrome_trace(), headers={ "Content-Disposition": f'attachment; filename="{filename}"' })
+
+
+# *** Operation **************************************************************
+
+@router.get(
+    "/clients/arrivals",
+    summary="Get the planned client arrivals",
+    response_description="JSON dictionary with the stagger settings, totals and the planned arrivals per second"
+)
+async def get_client_arrivals():
+    """
+    With client staggering enabled, clients are told to return at planned
+    seconds. Returns their number per UNIX second, future seconds only, as
+    planned by this server process.
+    """
+    stats = client_stagger.stats()
+    stats["arrivals"] = client_stagger.forecast()
+    return stats
+
+
+@router.get(
+    "/metrics",
+    summary="Get metrics in the Prometheus text format",
+    response_class=PlainTextResponse,
+    response_description="Counters and histograms of rendering, datasources, Redis and image responses"
+)
+async def get_metrics():
+    """
+    Returns render and widget draw durations, datasource update durations and
+    errors, Redis operation durations, image responses and bytes served per
+    display as well as the hits and misses of the in-process caches.
+    """
+    return PlainTextResponse(registry.expose(), media_type="text/plain; version=0.0.4")
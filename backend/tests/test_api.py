@@ -0,0 +1,32 @@
+import pytest
+from fastapi import HTTPException
+
+from ..routers.api import negotiate_variant
+
+
+VARIANTS = { "png": 900, "packed": 1200, "packed.gzip": 300, "packed.deflate": 290, "planes": 1200, "planes.x-packbits": 250 }
+
+
+def test_smallest_accepted_variant_is_chosen():
+    assert negotiate_variant(VARIANTS, None, "application/octet-stream", "gzip, deflate") == "packed.deflate"
+    assert negotiate_variant(VARIANTS, None, "application/octet-stream, application/x-epaper-planes", "x-packbits") == "planes.x-packbits"
+    assert negotiate_variant(VARIANTS, None, "application/octet-stream", None) == "packed"
+
+
+def test_q_zero_excludes_media_types_and_codings():
+    assert negotiate_variant(VARIANTS, None, "application/octet-stream", "gzip, deflate;q=0") == "packed.gzip"
+    assert negotiate_variant(VARIANTS, None, "application/octet-stream;q=0, application/x-epaper-planes", "gzip") == "planes"
+
+
+def test_png_is_the_fallback():
+    assert negotiate_variant(VARIANTS, None, "*/*", "gzip") == "png"
+    assert negotiate_variant(VARIANTS, None, None, None) == "png"
+    assert negotiate_variant({}, None, "application/octet-stream", None) == "packed"
+
+
+def test_format_overrides_accept():
+    assert negotiate_variant(VARIANTS, "planes", "image/png", "x-packbits") == "planes.x-packbits"
+    assert negotiate_variant(VARIANTS, "png", "application/octet-stream", "gzip") == "png"
+    with pytest.raises(HTTPException) as e:
+        negotiate_variant(VARIANTS, "bmp", None, None)
+    assert e.value.status_code == 400
@@ -0,0 +1,25 @@
+import numpy as np
+from PIL import Image
+
+from ..core.bitmap import color_indices, pack_indices, pack_planes
+
+
+WHITE, BLACK, RED = (255, 255, 255), (0, 0, 0), (255, 0, 0)
+
+
+def test_color_indices_follow_the_configured_colors():
+    image = Image.new("P", (3, 1))
+    image.putpalette([0, 0, 0, 250, 250, 250, 200, 10, 0])
+    image.putdata([0, 1, 2])
+    assert color_indices(image, [WHITE, BLACK, RED]).tolist() == [[1, 0, 2]]
+
+
+def test_pack_indices_pads_rows_to_full_bytes():
+    indices = np.array([[1] + [0] * 8, [0] * 8 + [1]], dtype=np.uint8)
+    assert pack_indices(indices, 1) == bytes([0x80, 0x00, 0x00, 0x80])
+    assert pack_indices(np.array([[1, 2, 0, 3]], dtype=np.uint8), 2) == bytes([0b01100011])
+
+
+def test_pack_planes_clears_bits_of_colored_pixels():
+    indices = np.array([[0, 1, 2, 0, 0, 0, 0, 0]], dtype=np.uint8)
+    assert pack_planes(indices, 3) == bytes([0b10111111, 0b11011111])
@@ -0,0 +1,35 @@
+import datetime
+from PIL import Image
+
+from ..core.charts import Chart, time_ticks, value_ticks
+from ..core.drawingcontext import DrawingContext
+from ..core.settings import global_settings
+
+
+def test_transform_maps_ranges_to_the_box_and_clips():
+    ctx = DrawingContext(Image.new("RGB", (120, 60)), global_settings.font_path, global_settings.icon_path, (255, 255, 255))
+    ctx.origin = (10, 5)
+    chart = Chart(ctx, (20, 0, 101, 51), (0, 100), (-10, 40))
+    xs, ys = chart.transform([0, 50, 100, 200], [40, 15, -10, -50])
+    assert xs.tolist() == [30, 80, 130, 130]
+    assert ys.tolist() == [5, 30, 55, 55]
+
+
+def test_ticks_are_at_round_values():
+    tz = datetime.timezone(datetime.timedelta(hours=1))
+    start = datetime.datetime(2023, 10, 1, 10, 20, tzinfo=tz).timestamp()
+    ticks = time_ticks(start, start + 10 * 3600, max_ticks=4, tz=tz)
+    assert [datetime.datetime.fromtimestamp(t, tz).hour for t in ticks] == [12, 15, 18]
+    assert value_ticks(-10, 40, 4).tolist() == [0, 20, 40]
+
+
+def test_bars_are_centered_and_start_at_the_baseline():
+    image = Image.new("RGB", (101, 51), (255, 255, 255))
+    ctx = DrawingContext(image, global_settings.font_path, global_settings.icon_path, (255, 255, 255))
+    chart = Chart(ctx, (0, 0, 101, 51), (0, 100), (0, 10), color=(0, 0, 0))
+    chart.bars([20, 60, 80], [5, 10, 0], bar_width=10)
+    pixels = image.load()
+    assert all(pixels[x, y] == (0, 0, 0) for x in range(15, 25) for y in range(25, 51))
+    assert pixels[14, 40] == pixels[25, 40] == pixels[20, 24] == (255, 255, 255)
+    assert all(pixels[x, y] == (0, 0, 0) for x in range(55, 65) for y in range(0, 51))
+    assert all(pixels[80, y] == (255, 255, 255) for y in range(51))
@@ -1,35 +1,135 @@
-import pytest
-import os
-
-from ..core.datasources.base import BaseSource
-
-
-REDIS_URL = os.environ.get("EPAPER_REDIS", 'redis://localhost')
-TEST_DATASOURCE_TYPE = 'TestBaseDatasource'
-
-
-@pytest.fixture(scope="module")
-def config():
-    config = {'source': TEST_DATASOURCE_TYPE, 'max_age': 3600}
-    return config
-
-@pytest.fixture(scope="function")
-async def redis():
-    import aioredis
-    redis = await aioredis.create_redis_pool(REDIS_URL)
-    yield redis
-    async for key in redis.iscan(match=f'datasource:{TEST_DATASOURCE_TYPE}*'):
-        print(f'Teardown redis: deleting {key}')
-        await redis.delete(key)
-    redis.close()
-    await redis.wait_closed()
-    print("Teardown redis: complete")
-
-@pytest.mark.asyncio
-async def test_last_update(config, redis):
-    import datetime
-    datasource = BaseSource(id='test_ds_id', config=config, redis=redis)
-    timestamp_set = await datasource.set_last_update_timestamp_now()
-    timestamp_get = await datasource.get_last_update_timestamp()
-    print(f"set {timestamp_set}, got {timestamp_get}")
-    assert abs(timestamp_set - timestamp_get) < datetime.timedelta(seconds=1)
+import asyncio
+import datetime
+
+from ..core.datasources.base import BaseDatasource
+from ..core.utils import RedisKeyValueStore
+from ..benchmarks.fakes import MemoryRedis
+
+
+class CountingDatasource(BaseDatasource):
+
+    class Settings(BaseDatasource.Settings):
+        pass
+
+    def load_settings(self):
+        self.settings = self.Settings(datasource_class=self.__class__.__name__, max_age_s=3600)
+
+    async def update(self):
+        self.updates = getattr(self, "updates", 0) + 1
+        await asyncio.sleep(0)
+        await self.set_data({ "value": self.updates })
+
+
+def create_datasource():
+    return CountingDatasource("ds_test.yml", RedisKeyValueStore(MemoryRedis(), "CountingDatasource"))
+
+
+def test_last_update():
+    async def run():
+        datasource = create_datasource()
+        assert await datasource.get_last_update() is None
+        await datasource.set_data({ "value": 1 })
+        last_update = await datasource.get_last_update()
+        assert abs(datetime.datetime.now(datetime.timezone.utc) - last_update) < datetime.timedelta(seconds=1)
+    asyncio.run(run())
+
+
+def test_get_data_updates_once_and_caches():
+    async def run():
+        datasource = create_datasource()
+        results = await asyncio.gather(*(datasource.get_data() for _ in range(5)))
+        assert datasource.updates == 1
+        assert all(data == { "value": 1 } for data in results)
+        assert await datasource.get_data() is results[-1]
+        assert datasource.data_cache_hits >= 1
+    asyncio.run(run())
+
+
+class GatedDatasource(CountingDatasource):
+    """Updates only when released, to look at the data served while a refresh is running."""
+
+    error = None
+
+    async def update(self):
+        await self.release.wait()
+        if self.error is not None:
+            raise self.error
+        await super().update()
+
+
+def create_gated_datasource(max_age_s: int):
+    datasource = GatedDatasource("ds_test.yml", RedisKeyValueStore(MemoryRedis(), "GatedDatasource"))
+    datasource.settings.max_age_s = max_age_s
+    datasource.release = asyncio.Event()
+    return datasource
+
+
+def test_stale_data_is_returned_while_one_refresh_runs():
+    async def run():
+        datasource = create_gated_datasource(3600)
+        changed = []
+        datasource.on_changed = changed.append
+        await datasource.set_data({ "value": 0 })
+        stale = datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(hours=2)
+        await datasource.kv_store.set_kv_from_dict({ "last_update": stale.isoformat() })
+
+        results = await asyncio.gather(*(datasource.get_data() for _ in range(5)))
+        assert all(data == { "value": 0 } for data in results)
+        await asyncio.sleep(0)
+        assert await datasource.get_data() == { "value": 0 }
+        datasource.release.set()
+        await asyncio.sleep(0.01)
+        assert datasource.updates == 1 and changed == ["ds_test"]
+        assert await datasource.get_data() == { "value": 1 }
+    asyncio.run(run())
+
+
+def test_without_max_age_get_data_waits_for_fresh_data():
+    async def run():
+        datasource = create_gated_datasource(0)
+        changed = []
+        datasource.on_changed = changed.append
+        await datasource.set_data({ "value": 0 })
+        readers = asyncio.gather(*(datasource.get_data() for _ in range(3)))
+        await asyncio.sleep(0.01)
+        assert not readers.done()
+        datasource.release.set()
+        assert await readers == [{ "value": 1 }] * 3
+        assert datasource.updates == 1
+        # the caller draws the fresh data itself, no re-render is needed
+        assert changed == [] and datasource.tasks == []
+    asyncio.run(run())
+
+
+def test_concurrent_callers_share_one_update_and_its_error():
+    async def run():
+        datasource = create_gated_datasource(3600)
+        readers = asyncio.gather(*(datasource.get_data() for _ in range(5)))
+        await asyncio.sleep(0.01)
+        datasource.release.set()
+        assert await readers == [{ "value": 1 }] * 5
+        assert datasource.updates == 1
+
+        failing = create_gated_datasource(3600)
+        failing.error = RuntimeError("unavailable")
+        readers = [asyncio.ensure_future(failing.get_data()) for _ in range(5)]
+        await asyncio.sleep(0.01)
+        failing.release.set()
+        results = await asyncio.gather(*readers, return_exceptions=True)
+        assert all(result is failing.error for result in results)
+        assert failing.tasks == []
+    asyncio.run(run())
+
+
+def test_cancelled_caller_does_not_cancel_the_shared_update():
+    async def run():
+        datasource = create_gated_datasource(3600)
+        cancelled, waiting = asyncio.ensure_future(datasource.get_data()), asyncio.ensure_future(datasource.get_data())
+        await asyncio.sleep(0.01)
+        cancelled.cancel()
+        await asyncio.gather(cancelled, return_exceptions=True)
+        assert not datasource._update_future.done()
+        datasource.release.set()
+        assert await waiting == { "value": 1 }
+        assert cancelled.cancelled() and datasource.updates == 1
+    asyncio.run(run())
@@ -0,0 +1,28 @@
+from PIL import Image, ImageFont
+
+from ..core.drawingcontext import DrawingContext, TextMaskCache, text_masks
+from ..core.settings import global_settings
+
+
+def _font(size=16):
+    return ImageFont.truetype(f"{global_settings.font_path}/Roboto-Regular.ttf", size)
+
+
+def test_text_masks_are_reused_and_evicted_by_size():
+    cache = TextMaskCache(max_bytes=2000)
+    font = _font()
+    first = cache.get("12°C", font)
+    assert cache.get("12°C", font) is first
+    assert (cache.hits, cache.misses) == (1, 1)
+    for i in range(20):
+        cache.get(f"{i} km/h", font)
+    assert cache.bytes <= 2000
+    assert cache.get("12°C", font) is not first
+
+
+def test_draw_text_uses_the_fill_color():
+    image = Image.new("RGB", (60, 30))
+    ctx = DrawingContext(image, global_settings.font_path, global_settings.icon_path, (255, 255, 255))
+    width, height = ctx.draw_text_xy((0, 0), "Hg", _font(), fill=(255, 0, 0))
+    assert (width, height) == text_masks.get("Hg", _font()).size
+    assert set(image.getdata()) == {(255, 255, 255), (255, 0, 0)}
@@ -0,0 +1,27 @@
+import os
+
+from ..core.encoders import packbits
+
+
+def unpackbits(data: bytes) -> bytes:
+    output, i = bytearray(), 0
+    while i < len(data):
+        n = data[i] - 256 if data[i] > 127 else data[i]
+        if n >= 0:
+            output.extend(data[i+1:i+2+n])
+            i += 2 + n
+        else:
+            output.extend(data[i+1:i+2] * (1 - n))
+            i += 2
+    return bytes(output)
+
+
+def test_packbits_matches_reference_example():
+    data = bytes.fromhex("aaaaaa80002aaaaaaaaa80002a22aaaaaaaaaaaaaaaaaaaa")
+    assert packbits(data) == bytes.fromhex("feaa0280002afdaa0380002a22f7aa")
+
+
+def test_packbits_roundtrip_long_runs_and_literals():
+    data = b"\x00" * 300 + os.urandom(300) + b"\xff" * 129 + b"\x01\x02"
+    assert unpackbits(packbits(data)) == data
+    assert packbits(b"") == b""
@@ -0,0 +1,253 @@
+import asyncio
+import io
+from concurrent.futures import ThreadPoolExecutor
+import yaml
+from PIL import Image, ImageChops, ImageDraw
+
+from ..core import encoders
+from ..core.datasources.base import BaseDatasource
+from ..core.epaper import Epaper
+from ..core.utils import RedisKeyValueStore, RedisInvalidationListener
+from ..benchmarks.fakes import MemoryRedis
+
+
+class ValueDatasource(BaseDatasource):
+
+    class Settings(BaseDatasource.Settings):
+        pass
+
+    def load_settings(self):
+        self.settings = self.Settings(datasource_class=self.__class__.__name__, max_age_s=3600)
+
+    async def update(self):
+        pass
+
+
+class CountingExecutor(ThreadPoolExecutor):
+
+    def __init__(self):
+        super().__init__(max_workers=1)
+        self.submitted = 0
+
+    def submit(self, *args, **kwargs):
+        self.submitted += 1
+        return super().submit(*args, **kwargs)
+
+
+def create_datasource(redis):
+    return ValueDatasource("ds_value.yml", RedisKeyValueStore(redis, "ValueDatasource"))
+
+
+def create_epaper(tmp_path, widgets=(), size=(61, 16), datasources=None, redis=None):
+    filename = tmp_path / "ep_test.yml"
+    with open(filename, "w") as f:
+        yaml.safe_dump({
+            "size": list(size),
+            "bits_per_pixel": 1,
+            "colors": [[255, 255, 255], [0, 0, 0]],
+            "widgets": list(widgets),
+        }, f)
+    return Epaper(str(filename), RedisKeyValueStore(redis or MemoryRedis(), "Epaper"), datasources or {}, {})
+
+
+def quantized(epaper, box=None):
+    image = Image.new("RGB", epaper.settings.size, (255, 255, 255))
+    if box:
+        ImageDraw.Draw(image).rectangle(box, fill=(0, 0, 0))
+    return epaper.quantizer.quantize(image)
+
+
+def test_delta_applied_to_the_old_image_gives_the_new_image(tmp_path):
+    async def run():
+        epaper = create_epaper(tmp_path)
+        old_image, new_image = quantized(epaper), quantized(epaper, (13, 3, 20, 7))
+        epaper._remember_image("v1", old_image)
+        epaper._remember_image("v2", new_image)
+        await epaper.kv_store.set_kv_from_dict({ "version": "v2" })
+
+        delta = await epaper.get_delta("v1")
+        x, y, width, height = delta.box
+        assert delta.version == "v2"
+        assert x % 8 == 0 and width % 8 == 0 and (x, y, width, height) == (8, 3, 16, 5)
+        patched = old_image.convert("RGB")
+        patched.paste(Image.open(io.BytesIO(delta.buffers["png"])).convert("RGB"), (x, y))
+        assert ImageChops.difference(patched, new_image.convert("RGB")).getbbox() is None
+    asyncio.run(run())
+
+
+def test_concurrent_delta_requests_compute_once(tmp_path):
+    async def run():
+        epaper = create_epaper(tmp_path)
+        epaper._remember_image("v1", quantized(epaper))
+        epaper._remember_image("v2", quantized(epaper, (0, 0, 60, 15)))
+        await epaper.kv_store.set_kv_from_dict({ "version": "v2" })
+        calls = []
+        create_delta = epaper._create_delta
+        epaper._create_delta = lambda *args: calls.append(args) or create_delta(*args)
+
+        deltas = await asyncio.gather(*(epaper.get_delta("v1") for _ in range(10)))
+        assert len(calls) == 1
+        assert all(delta is deltas[0] for delta in deltas)
+        assert await epaper.get_delta("v1") is deltas[0]
+        assert await epaper.get_delta("unknown") is None
+    asyncio.run(run())
+
+
+def test_unchanged_inputs_skip_the_render_executor(tmp_path):
+    async def run():
+        redis = MemoryRedis()
+        datasource = create_datasource(redis)
+        widget = { "widget_class": "TextWidget", "position": [0, 0], "size": [61, 16], "datasource": "ds_value", "format": "{value}" }
+        epaper = create_epaper(tmp_path, [widget], datasources={ "ds_value": datasource }, redis=redis)
+        executor = CountingExecutor()
+        await datasource.set_data({ "value": 1 })
+        await epaper._update(executor)
+        version = (await epaper.get_metadata()).version
+        await epaper._update(executor)
+        assert executor.submitted == 1 and epaper.renders_skipped == 1
+        assert (await epaper.get_metadata()).version == version
+
+        await datasource.set_data({ "value": 2 })
+        await epaper._update(executor)
+        assert executor.submitted == 2
+        assert (await epaper.get_metadata()).version != version
+        executor.shutdown()
+    asyncio.run(run())
+
+
+def test_changed_image_gets_a_new_version_encoded_once(tmp_path, monkeypatch):
+    async def run():
+        redis = MemoryRedis()
+        datasource = create_datasource(redis)
+        widget = { "widget_class": "TextWidget", "position": [0, 0], "size": [61, 16], "datasource": "ds_value", "format": "{value}" }
+        await datasource.set_data({ "value": 1 })
+        await create_epaper(tmp_path, [widget], datasources={ "ds_value": datasource }, redis=redis)._update()
+
+        # another process knows the stored PNG only, it compares and stores the new PNG without encoding twice
+        epaper = create_epaper(tmp_path, [widget], datasources={ "ds_value": datasource }, redis=redis)
+        version = (await epaper.get_metadata()).version
+        encoded = []
+        png_encoder = encoders.IMAGE_ENCODERS["png"]
+        monkeypatch.setitem(encoders.IMAGE_ENCODERS, "png",
+            png_encoder._replace(encode=lambda *args: encoded.append(args) or png_encoder.encode(*args)))
+        await datasource.set_data({ "value": 2 })
+        await epaper._update()
+        new_version, png = await epaper.get_image_buffer()
+        assert new_version != version and len(encoded) == 1
+        assert png == png_encoder.encode(epaper._last_image, 1, epaper.settings.colors)
+        assert png == await epaper.kv_store.get_kv_binary("image")
+    asyncio.run(run())
+
+
+def test_unchanged_widgets_reuse_their_tiles_and_redrawn_ones_are_clipped(tmp_path):
+    async def run():
+        redis = MemoryRedis()
+        datasource = create_datasource(redis)
+        widgets = [
+            { "widget_class": "TextWidget", "position": [0, 0], "size": [32, 16], "format": "A" },
+            { "widget_class": "TextWidget", "position": [32, 0], "size": [32, 16], "datasource": "ds_value", "format": "{value}" },
+        ]
+        epaper = create_epaper(tmp_path, widgets, size=(64, 16), datasources={ "ds_value": datasource }, redis=redis)
+        await datasource.set_data({ "value": 1 })
+        await epaper._update()
+        old_image = epaper._last_image
+        assert (epaper.tiles_drawn, epaper.tiles_reused) == (2, 0)
+
+        # the text is wider than its widget and must not spill into the fixed widget on its left
+        await datasource.set_data({ "value": "WWWWWWWWWW" })
+        await epaper._update()
+        assert (epaper.tiles_drawn, epaper.tiles_reused) == (3, 1)
+        left, top, right, bottom = ImageChops.difference(old_image.convert("RGB"), epaper._last_image.convert("RGB")).getbbox()
+        assert left >= 32
+    asyncio.run(run())
+
+
+def test_invalidations_of_other_processes_clear_the_metadata_cache(tmp_path):
+    async def run():
+        redis = MemoryRedis()
+        epaper = create_epaper(tmp_path, redis=redis)
+        listener = RedisInvalidationListener(redis, "Epaper")
+        listener.register(epaper.id, epaper.invalidate_metadata)
+        listening = asyncio.ensure_future(listener.run())
+        await asyncio.sleep(0)
+        await epaper.kv_store.set_kv_from_dict({ "version": "v1" })
+        assert (await epaper.get_metadata()).version == "v1"
+
+        # another process stores a new version and publishes with its own process id
+        other = RedisKeyValueStore(redis, "Epaper")
+        other.set_instance_key(epaper.id)
+        await other.set_kv_from_dict({ "version": "v2" })
+        assert (await epaper.get_metadata()).version == "v1"
+        await redis.publish(other.invalidation_channel(), f"other-process:{epaper.id}")
+        await asyncio.sleep(0)
+        assert (await epaper.get_metadata()).version == "v2"
+
+        # messages published by this process are ignored, it updated its cache itself
+        misses = epaper.metadata_cache_misses
+        await epaper.kv_store.publish_invalidation()
+        await asyncio.sleep(0)
+        await epaper.get_metadata()
+        assert epaper.metadata_cache_misses == misses
+        listening.cancel()
+        await asyncio.gather(listening, return_exceptions=True)
+    asyncio.run(run())
+
+
+def test_history_keeps_one_png_per_previous_version(tmp_path):
+    async def run():
+        redis = MemoryRedis()
+        datasource = create_datasource(redis)
+        widget = { "widget_class": "TextWidget", "position": [0, 0], "size": [61, 16], "datasource": "ds_value", "format": "{value}" }
+        epapers = [create_epaper(tmp_path, [widget], datasources={ "ds_value": datasource }, redis=redis) for _ in range(2)]
+        versions = []
+        for value in range(7):
+            # two processes take turns, each writing over the version of the other
+            await datasource.set_data({ "value": value })
+            await epapers[value % 2]._update()
+            versions.append((await epapers[value % 2].get_metadata()).version)
+
+        history = [version.decode("utf-8") for version in redis.lists["Epaper:ep_test:history"]]
+        assert history == versions[-5:-1]
+        assert sorted(key for key in redis.values if ":history:" in key) == sorted(f"Epaper:ep_test:history:{v}" for v in history)
+        other = create_epaper(tmp_path, redis=redis)
+        assert all([await other.get_history_image(version) for version in versions[-5:]])
+        assert await other.get_history_image(versions[-6]) is None
+    asyncio.run(run())
+
+
+def test_delta_of_equal_images_is_empty(tmp_path):
+    async def run():
+        epaper = create_epaper(tmp_path)
+        epaper._remember_image("v1", quantized(epaper))
+        epaper._remember_image("v2", quantized(epaper))
+        await epaper.kv_store.set_kv_from_dict({ "version": "v2" })
+        delta = await epaper.get_delta("v1")
+        assert delta.version == "v2" and delta.box == (0, 0, 0, 0) and delta.buffers == {}
+    asyncio.run(run())
+
+
+def test_missing_variant_is_encoded_from_the_png_of_the_same_version(tmp_path):
+    async def run():
+        redis = MemoryRedis()
+        epaper = create_epaper(tmp_path, redis=redis)
+        image = quantized(epaper, (0, 0, 30, 15))
+        await epaper.kv_store.set_kv_from_dict({ "version": "v1", "image_format": epaper._image_format(), "image": epaper._encode_image(image) })
+        commands = redis.commands
+        version, packed = await epaper.get_image_buffer(variant="packed")
+        assert version == "v1" and packed == epaper._encode_image(image, "packed")
+        assert redis.commands == commands + 1
+    asyncio.run(run())
+
+
+def test_later_widgets_cover_overlapping_ones(tmp_path):
+    async def run():
+        widgets = [
+            { "widget_class": "TextWidget", "position": [0, 0], "size": [64, 16], "format": "WWWWWW" },
+            { "widget_class": "TextWidget", "position": [0, 0], "size": [32, 16], "format": "" },
+        ]
+        epaper = create_epaper(tmp_path, widgets, size=(64, 16))
+        await epaper._update()
+        image = epaper._last_image.convert("RGB")
+        assert image.crop((0, 0, 32, 16)).getcolors() == [(32 * 16, (255, 255, 255))]
+        assert len(image.crop((32, 0, 64, 16)).getcolors()) == 2
+    asyncio.run(run())
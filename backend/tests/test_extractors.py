@@ -0,0 +1,40 @@
+import pytest
+
+from ..core.datasources.extractors import Extraction, RegexExtractor, JsonPathExtractor, XPathExtractor, compile_json_path, STREAM_OVERLAP
+
+
+def test_regex_extraction_stops_when_all_expressions_matched():
+    extraction = Extraction([RegexExtractor(r'"incidence":(?P<incidence>[0-9.]+)'), RegexExtractor(r'"cases":(?P<cases>\d+)')])
+    extraction.feed('{"incidence":12')
+    assert extraction.data == {}    # the number might continue in the next chunk
+    extraction.feed('3.4,"cases":5')
+    assert extraction.data == {"incidence": "123.4"} and not extraction.done
+    extraction.feed('6}')
+    assert extraction.done
+    assert extraction.finish() == ({"incidence": "123.4", "cases": "56"}, [])
+
+
+def test_streaming_search_continues_where_it_stopped():
+    extraction = Extraction([RegexExtractor(r'"cases":(?P<cases>\d+)'), RegexExtractor(r'"never":(?P<never>\d+)')])
+    chunk = "x" * 16384
+    for _ in range(100):
+        extraction.feed(chunk)
+        assert len(extraction.window) <= STREAM_OVERLAP + len(chunk)
+    extraction.feed(chunk + '"ca')      # a match crossing the chunk boundary
+    extraction.feed('ses":42,')
+    assert extraction.data == {"cases": "42"}
+    assert extraction.finish() == ({"cases": "42"}, extraction.pending)
+    assert len(extraction.text) == 101 * len(chunk) + len('"cases":42,')
+
+
+def test_json_path_and_xpath_extraction():
+    assert compile_json_path("$.hourly[2]['temp']") == ["hourly", 2, "temp"]
+    with pytest.raises(ValueError):
+        compile_json_path("$..temp")
+    extraction = Extraction([JsonPathExtractor("cases", "$.delta.cases"), JsonPathExtractor("missing", "$.x[3]")])
+    extraction.feed('{"delta": {"cases": 5}}')
+    data, unmatched = extraction.finish()
+    assert data == {"cases": 5} and [e.expression for e in unmatched] == ["$.x[3]"]
+    extraction = Extraction([XPathExtractor("title", "//h1")])
+    extraction.feed("<html><body><h1> Fallzahlen <b>heute</b></h1></body></html>")
+    assert extraction.finish() == ({"title": "Fallzahlen heute"}, [])
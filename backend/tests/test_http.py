@@ -0,0 +1,15 @@
+import asyncio
+
+from ..core import http
+
+
+def test_session_is_shared_and_recreated_after_closing():
+    async def run():
+        session = http.get_session()
+        assert http.get_session() is session
+        await http.close_session()
+        assert session.closed
+        renewed = http.get_session()
+        assert renewed is not session and not renewed.closed
+        await http.close_session()
+    asyncio.run(run())
@@ -0,0 +1,30 @@
+from ..core.metrics import Registry
+
+
+def test_counter_and_histogram_exposition():
+    registry = Registry()
+    requests = registry.counter("requests", "Requests", ["display", "status"])
+    duration = registry.histogram("duration_seconds", "Duration", ["display"], buckets=[0.1, 1])
+    ok = requests.labels("ep_1", 200)
+    assert requests.labels("ep_1", "200") is ok
+    ok.inc()
+    ok.inc(2)
+    child = duration.labels('a "b"')
+    for value in (0.05, 0.1, 0.5, 3):
+        child.observe(value)
+
+    lines = registry.expose().splitlines()
+    assert "# TYPE requests counter" in lines
+    assert 'requests_total{display="ep_1",status="200"} 3' in lines
+    assert 'duration_seconds_bucket{display="a \\"b\\"",le="0.1"} 2' in lines
+    assert 'duration_seconds_bucket{display="a \\"b\\"",le="1"} 3' in lines
+    assert 'duration_seconds_bucket{display="a \\"b\\"",le="+Inf"} 4' in lines
+    assert 'duration_seconds_count{display="a \\"b\\""} 4' in lines
+
+
+def test_collector_is_read_when_exposed():
+    registry = Registry()
+    stats = { "hits": 1 }
+    registry.collector("counter", "cache_requests", "Cache lookups", ["result"], lambda: [(("hit",), stats["hits"])])
+    stats["hits"] = 5
+    assert 'cache_requests_total{result="hit"} 5' in registry.expose().splitlines()
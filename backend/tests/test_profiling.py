@@ -0,0 +1,26 @@
+from ..core.profiling import NULL_TRACE, RenderTrace
+
+
+def test_render_trace_exports_nested_spans():
+    trace = RenderTrace("ep_test", cprofile=True)
+    with trace.profile(), trace.span("render"):
+        with trace.span("draw", "draw"):
+            sum(range(1000))
+    with trace.span("get_data", "data", track="get_data 0"):
+        pass
+
+    chrome_trace = trace.to_chrome_trace()
+    spans = { e["name"]: e for e in chrome_trace["traceEvents"] if e["ph"] == "X" }
+    assert spans["draw"]["tid"] == spans["render"]["tid"] != spans["get_data"]["tid"]
+    assert spans["render"]["ts"] <= spans["draw"]["ts"]
+    assert spans["draw"]["ts"] + spans["draw"]["dur"] <= spans["render"]["ts"] + spans["render"]["dur"]
+    names = [e["args"]["name"] for e in chrome_trace["traceEvents"] if e["ph"] == "M"]
+    assert "get_data 0" in names
+    assert "function calls" in chrome_trace["otherData"]["cprofile"]
+    assert chrome_trace["otherData"]["display"] == "ep_test"
+
+
+def test_null_trace_does_nothing():
+    with NULL_TRACE.profile(), NULL_TRACE.span("render"):
+        pass
+    assert not NULL_TRACE.enabled
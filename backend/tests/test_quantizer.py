@@ -0,0 +1,30 @@
+import numpy as np
+from PIL import Image
+
+from ..core.quantizer import Quantizer
+
+
+WHITE, BLACK, RED = (255, 255, 255), (0, 0, 0), (255, 0, 0)
+
+
+def test_quantize_uses_the_configured_colors_as_palette():
+    image = Image.new("RGB", (4, 1))
+    image.putdata([(250, 250, 250), (5, 5, 5), (200, 20, 10), (90, 90, 90)])
+    result = Quantizer([WHITE, BLACK, RED]).quantize(image)
+    assert result.mode == "P"
+    assert result.getpalette()[:9] == [*WHITE, *BLACK, *RED]
+    assert list(result.getdata()) == [0, 1, 2, 1]
+
+
+def test_ordered_dither_approximates_gray_levels():
+    gray = Image.new("RGB", (16, 16), (128, 128, 128))
+    indices = Quantizer([WHITE, BLACK], "ordered").indices(gray)
+    assert 0.4 < (indices == 1).mean() < 0.6
+    assert (Quantizer([WHITE, BLACK], "ordered").indices(Image.new("RGB", (8, 8), WHITE)) == 0).all()
+
+
+def test_floyd_steinberg_dither_keeps_the_palette():
+    gray = Image.new("RGB", (16, 16), (128, 128, 128))
+    result = Quantizer([WHITE, BLACK], "floyd-steinberg").quantize(gray)
+    indices = np.asarray(result)
+    assert set(np.unique(indices)) == {0, 1}
@@ -0,0 +1,21 @@
+from ..core.resources import ResourceManager
+from ..core.settings import global_settings
+
+
+def test_icons_are_decoded_in_the_tile_mode_and_bounded():
+    manager = ResourceManager(max_bytes=50000)
+    icon = manager.get_icon(global_settings.icon_path, "weather/wi-fog.png")
+    assert icon.mode == "RGB"
+    assert manager.get_icon(global_settings.icon_path, "weather/wi-fog.png") is icon
+    for name in ["wi-cloud", "wi-snow", "wi-day-sunny"]:
+        manager.get_icon(global_settings.icon_path, f"weather/{name}.png")
+    assert manager.bytes <= 50000 or len(manager.icons) == 1
+    assert manager.stats()["hits"] == 1
+
+
+def test_preload_skips_missing_resources():
+    manager = ResourceManager(max_bytes=1 << 20)
+    manager.preload(global_settings.font_path, global_settings.icon_path,
+                    [("Roboto-Regular.ttf", 16), ("Missing.ttf", 16)], ["weather_small/wi-fog.png", "missing.png"])
+    assert manager.stats()["fonts"] == 1
+    assert manager.stats()["icons"] == 1
@@ -0,0 +1,102 @@
+import asyncio
+import datetime
+import pytest
+
+from ..core.scheduler import DeadlineScheduler, RenderScheduler, DatasourceScheduler
+
+
+def test_pop_due_orders_by_deadline_and_skips_replaced_entries():
+    scheduler = RenderScheduler({}, max_workers=1, retry_interval_s=10)
+    now = datetime.datetime.now(datetime.timezone.utc)
+    scheduler.schedule("a", now - datetime.timedelta(seconds=5))
+    scheduler.schedule("b", now - datetime.timedelta(seconds=10))
+    scheduler.schedule("c", now + datetime.timedelta(seconds=60))
+    scheduler.schedule("a", now + datetime.timedelta(seconds=30))    # replaces the first deadline of a
+    assert scheduler._pop_due(now) == ["b"]
+    assert scheduler._pop_due(now + datetime.timedelta(seconds=45)) == ["a"]
+    assert scheduler.due_at.keys() == {"c"}
+    scheduler.shutdown()
+
+
+def test_trigger_makes_epaper_due_now():
+    scheduler = RenderScheduler({}, max_workers=1, retry_interval_s=10)
+    scheduler.schedule("a", datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(hours=1))
+    scheduler.trigger("a")
+    assert scheduler._pop_due(datetime.datetime.now(datetime.timezone.utc)) == ["a"]
+    scheduler.shutdown()
+
+
+class _Datasource:
+    def __init__(self, max_age_s, error=None):
+        self.settings = type("Settings", (), { "max_age_s": max_age_s })()
+        self.error = error
+        self.data_hash = None
+        self.data_updated_at = None
+
+    async def update_once(self):
+        if self.error:
+            raise self.error
+        self.data_hash = "new"
+        self.data_updated_at = datetime.datetime.now(datetime.timezone.utc)
+
+
+class _RateLimited(Exception):
+    headers = { "Retry-After": "120" }
+
+
+def test_datasource_refresh_schedules_before_expiry():
+    scheduler = DatasourceScheduler({ "ds": _Datasource(3600) }, 60, 10, 3600)
+    asyncio.run(scheduler._update("ds"))
+    lead = scheduler.due_at["ds"] - datetime.datetime.now(datetime.timezone.utc)
+    assert datetime.timedelta(seconds=3530) < lead <= datetime.timedelta(seconds=3540)
+
+
+def test_datasource_failures_back_off_and_honor_retry_after():
+    scheduler = DatasourceScheduler({ "a": _Datasource(600, RuntimeError()), "b": _Datasource(600, _RateLimited()) }, 60, 10, 3600)
+    for _ in range(3):
+        asyncio.run(scheduler._update("a"))
+        del scheduler.due_at["a"]
+    asyncio.run(scheduler._update("a"))
+    asyncio.run(scheduler._update("b"))
+    now = datetime.datetime.now(datetime.timezone.utc)
+    assert scheduler.failures["a"] == 4
+    assert scheduler.due_at["a"] - now <= datetime.timedelta(seconds=80)
+    assert datetime.timedelta(seconds=115) < scheduler.due_at["b"] - now <= datetime.timedelta(seconds=120)
+
+
+class _Epaper:
+    def __init__(self):
+        self.settings = type("Settings", (), { "update_interval_s": 0 })()
+        self.update_interval = datetime.timedelta(0)
+        self.updates = 0
+
+    async def get_last_update(self):
+        return None
+
+    async def _update(self, executor):
+        self.updates += 1
+        await asyncio.sleep(0)
+
+
+def test_shutdown_stops_the_run_loop_and_running_updates():
+    async def run():
+        epaper = _Epaper()
+        scheduler = RenderScheduler({ "a": epaper }, max_workers=1, retry_interval_s=0.01)
+        running = asyncio.ensure_future(scheduler.run())
+        await asyncio.sleep(0.05)
+        assert epaper.updates > 0
+        scheduler.shutdown()
+        await asyncio.gather(running, return_exceptions=True)
+        assert running.cancelled()
+        updates = epaper.updates
+        await asyncio.sleep(0.05)
+        assert epaper.updates == updates
+        assert not scheduler.tasks
+    asyncio.run(run())
+
+
+def test_scheduler_without_update_cannot_be_created():
+    class Incomplete(DeadlineScheduler):
+        pass
+    with pytest.raises(TypeError):
+        Incomplete()
@@ -0,0 +1,50 @@
+from ..core.stagger import ClientStagger, client_identity
+
+
+def test_offsets_are_deterministic_and_within_the_window():
+    stagger = ClientStagger(window_s=600, max_arrivals_per_s=0)
+    offsets = [stagger.offset_s(f"e32-{i:012x}") for i in range(1000)]
+    assert offsets == [ClientStagger(600, 0).offset_s(f"e32-{i:012x}") for i in range(1000)]
+    assert all(0 <= offset < 600 for offset in offsets)
+    assert len(set(offsets)) > 450     # about 487 expected for uniform offsets
+    assert stagger.plan("e32-000000000001", 1000.2, now=0) == 1001 + stagger.offset_s("e32-000000000001")
+
+
+def test_arrivals_per_second_are_bounded():
+    stagger = ClientStagger(window_s=100, max_arrivals_per_s=3)
+    seconds = [stagger.plan(f"device-{i}", 1000, now=0) for i in range(300)]
+    assert all(1000 <= second < 1100 for second in seconds)
+    assert max(count for _, count in stagger.forecast(now=0)) == 3
+    assert stagger.overbooked == 0
+    stagger.plan("device-300", 1000, now=0)
+    assert stagger.overbooked == 1
+
+
+def test_client_replans_and_past_arrivals_expire():
+    stagger = ClientStagger(window_s=10, max_arrivals_per_s=0)
+    stagger.plan("device", 1000, now=0)
+    stagger.plan("device", 2000, now=0)
+    assert stagger.stats(now=0)["planned"] == 1
+    assert stagger.forecast(now=3000) == []
+    assert stagger.planned == {}
+
+
+def test_polls_before_the_planned_second_keep_it():
+    stagger = ClientStagger(window_s=100, max_arrivals_per_s=1)
+    second = stagger.plan("device", 1000, now=900)
+    assert stagger.plan("device", 1001, now=950) == second
+    assert stagger.stats(now=950)["planned"] == 1
+    assert stagger.plan("device", second + 1, now=second) > second
+
+
+def test_devices_sharing_an_alias_are_planned_separately():
+    stagger = ClientStagger(window_s=60, max_arrivals_per_s=1)
+    first = client_identity("e32-alias", None, "192.168.1.10")
+    second = client_identity("e32-alias", None, "192.168.1.11")
+    assert first != second
+    assert client_identity("e32-alias", "device-1", "10.0.0.1") != client_identity("e32-alias", "device-2", "10.0.0.1")
+    seconds = [stagger.plan(first, 1000, now=0), stagger.plan(second, 1000, now=0)]
+    assert seconds[0] != seconds[1]
+    assert stagger.stats(now=0)["planned"] == 2
+    stagger.plan(first, 1000, now=0)
+    assert stagger.stats(now=0)["planned"] == 2
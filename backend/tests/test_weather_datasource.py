@@ -0,0 +1,46 @@
+import json
+
+from ..core.datasources.weather import WeatherDatasource, compact_onecall, onecall_series
+from ..core.utils import RedisKeyValueStore
+from ..benchmarks.fakes import MemoryRedis
+
+
+ONECALL = {
+    "current": { "temp": 12.34 },
+    "hourly": [
+        { "dt": 100, "temp": 10.123, "pressure": 1010, "weather": [{ "icon": "01d", "description": "klar" }] },
+        { "dt": 3700, "temp": 11.0, "pressure": 1011, "weather": [{ "icon": "04n", "description": "bewölkt" }] },
+    ],
+    "minutely": [{ "dt": 100, "precipitation": 0.5 }],
+}
+
+
+def create_datasource(tmp_path):
+    filename = tmp_path / "ds_weather_test.yml"
+    filename.write_text("datasource_class: WeatherDatasource\napi_key: key\ncity_id: '1'\nlat: 52.3\nlon: 10.5\n")
+    return WeatherDatasource(str(filename), RedisKeyValueStore(MemoryRedis(), "WeatherDatasource"))
+
+
+def test_compact_onecall_stores_series_column_wise():
+    compact = compact_onecall(ONECALL)
+    assert compact["current"] == { "temp": 12.34 }
+    assert compact["hourly"]["dt"] == [100, 3700]
+    assert compact["hourly"]["temp"] == [10.12, 11.0]
+    assert compact["hourly"]["icon"] == ["01d", "04n"]
+    assert compact["minutely"] == { "dt": [100], "precipitation": [0.5] }
+    assert compact_onecall(compact) == compact
+
+
+def test_onecall_series_reads_both_layouts():
+    assert onecall_series(ONECALL, "hourly") == onecall_series(compact_onecall(ONECALL), "hourly")
+    assert onecall_series(ONECALL, "minutely") == { "dt": [100], "precipitation": [0.5] }
+    assert onecall_series({ "current": {} }, "minutely") is None
+
+
+def test_rows_are_kept_for_widgets_using_the_whole_document(tmp_path):
+    datasource = create_datasource(tmp_path)
+    raw = json.dumps(ONECALL).encode("utf-8")
+    datasource.require({ "hourly" })
+    assert datasource.decode(raw)["hourly"]["temp"] == [10.12, 11.0]
+    datasource.require(None)    # e.g. a TextWidget with format "{hourly[0][temp]}"
+    assert "{hourly[0][temp]}".format(**datasource.decode(raw)) == "10.123"
@@ -0,0 +1,50 @@
+import asyncio
+import yaml
+from aiohttp import web
+
+from ..core.datasources.webscraper import WebScraperDatasource
+from ..core.utils import RedisKeyValueStore
+from ..core import http
+from ..benchmarks.fakes import MemoryRedis
+
+
+def test_changed_extractors_fetch_the_page_unconditionally(tmp_path):
+    requests = []
+
+    async def page(request):
+        requests.append(request.headers.get("If-None-Match"))
+        if request.headers.get("If-None-Match") == '"v1"':
+            return web.Response(status=304)
+        return web.json_response({ "cases": 12, "deaths": 3 }, headers={ "ETag": '"v1"' })
+
+    async def run():
+        app = web.Application()
+        app.router.add_get("/page", page)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        await web.TCPSite(runner, "127.0.0.1", 0).start()
+        url = f"http://127.0.0.1:{runner.addresses[0][1]}/page"
+        filename = tmp_path / "ds_web.yml"
+
+        def configure(expression):
+            with open(filename, "w") as f:
+                yaml.safe_dump({ "datasource_class": "WebScraperDatasource", "url": url, "find_expressions": [expression] }, f)
+
+        try:
+            configure('"cases": (?P<cases>\\d+)')
+            datasource = WebScraperDatasource(str(filename), RedisKeyValueStore(MemoryRedis(), "WebScraperDatasource"))
+            await datasource.update_once()
+            await datasource.update_once()
+            assert requests == [None, '"v1"']
+            assert await datasource.get_data() == { "cases": "12" }
+
+            configure('"deaths": (?P<deaths>\\d+)')
+            datasource.load_settings()
+            await datasource.update_once()
+            assert requests[-1] is None
+            assert await datasource.get_data() == { "deaths": "3" }
+            assert (await datasource.kv_store.get_kv("etag")) == '"v1"'
+        finally:
+            await http.close_session()
+            await runner.cleanup()
+    asyncio.run(run())